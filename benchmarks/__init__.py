@@ -0,0 +1,10 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# Keep the caches and the catalogue of the benchmarks away from the real
+# ones (this runs before the benchmarks import grabba_grabba_hey)
+os.environ["GRABBA_CACHE_DIR"] = tempfile.mkdtemp(prefix="grabba_bench_")
+atexit.register(shutil.rmtree, os.environ["GRABBA_CACHE_DIR"],
+                ignore_errors=True)
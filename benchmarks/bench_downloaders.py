@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Throughput of each of the downloaders against the local archive stand-in:
+files/s, MB/s, number of requests made and peak (Python) memory, so that
+performance regressions can be caught without a network connection. Run
+from the top of the repository with
+
+    python -m benchmarks.bench_downloaders [--latency ms] [--bandwidth MB/s]
+                                           [--error-rate p] [--scale x]
+                                           [downloader ...]
+
+where the downloaders are any of sentinel, s2aws, s2aws-async, modis and
+laads (all of them by default). ``--scale`` multiplies the number of
+files of every case.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+from grabba_grabba_hey import (cache, get_laads, modis_downloader,
+                               sentinel_downloader)
+from grabba_grabba_hey.catalogue import Catalogue, _catalogues
+from grabba_grabba_hey.modis_index import _indices
+
+from tests.standin import StandinServer
+
+
+def sentinel(server, output_dir, scale):
+    """Search the hub and download the products."""
+    for i in range(int(20 * scale)):
+        server.products["S2A_MSIL1C_%04d" % i] = os.urandom(2 * 1048576)
+    with mock.patch.object(sentinel_downloader, "hub_url",
+                           server.url + "/apihub/search?q="):
+        granules, files = sentinel_downloader.download_sentinel(
+            "29TNJ", "2017.01.01", "S2", output_dir, rows=10)
+    return files
+
+
+def _s2_tiles(server, scale):
+    tiles = ["29/T/NJ", "29/T/NH", "29/T/PJ", "30/T/UN"]
+    names = ["B%02d.jp2" % i for i in range(1, 13)] + \
+        ["metadata.xml", "tileInfo.json", "preview.jpg",
+         "qi/MSK_CLOUDS_B00.gml", "aux/AUX_ECMWFT"]
+    for tile in tiles:
+        for day in range(1, 1 + int(10 * scale)):
+            for name in names:
+                server.files["/tiles/%s/2017/1/%d/0/%s" % (tile, day, name)] = \
+                    os.urandom(32768)
+    return [tile.replace("/", "") for tile in tiles]
+
+
+def s2aws(server, output_dir, scale, engine="threads"):
+    """Scan a batch of tiles in the S2 bucket and download their files."""
+    tiles = _s2_tiles(server, scale)
+    with mock.patch.object(sentinel_downloader, "aws_url_dload",
+                           server.url + "/"):
+        return sentinel_downloader.download_sentinel_amazon(
+            datetime.datetime(2017, 1, 1), output_dir, tile=tiles,
+            end_date=datetime.datetime(2017, 1, 31), engine=engine)
+
+
+def s2aws_async(server, output_dir, scale):
+    return s2aws(server, output_dir, scale, engine="async")
+
+
+def modis(server, output_dir, scale):
+    """List the MODIS archive and download granules behind the login."""
+    server.earthdata = ("user", "secret")
+    start_date = datetime.datetime(2017, 1, 1)
+    for day in range(int(30 * scale)):
+        the_date = start_date + datetime.timedelta(days=day)
+        for tile in ["h17v04", "h17v05", "h18v04"]:
+            fname = "MOD09GA.A%s.%s.006.2017003043436.hdf" % (
+                the_date.strftime("%Y%j"), tile)
+            path = "/MOLT/MOD09GA.006/%s/%s" % (the_date.strftime("%Y.%m.%d"),
+                                                fname)
+            server.files[path] = os.urandom(262144)
+            server.files[path + ".xml"] = b"<GranuleMetaDataFile/>"
+    catalogue = Catalogue(os.path.join(output_dir, "catalogue.sqlite"))
+    with mock.patch.object(modis_downloader, "BASE_URL", server.url + "/"):
+        files = modis_downloader.get_modis_data(
+            "user", "secret", "MOLT", "MOD09GA.006", ["h17v04", "h18v04"],
+            output_dir, start_date, end_date=the_date, catalogue=catalogue)
+    catalogue.close()
+    return files
+
+
+def laads(server, output_dir, scale):
+    """Download the granules of a LAADS query."""
+    query = {"query": "standin"}
+    for i in range(int(100 * scale)):
+        path = "/archive/allData/61/MOD021KM/2017/001/MOD021KM.%04d.hdf" % i
+        server.files[path] = os.urandom(131072)
+        query[str(i)] = {"url": path}
+    query_file = os.path.join(output_dir, "query.json")
+    with open(query_file, "w") as fp:
+        json.dump(query, fp)
+    catalogue = Catalogue(os.path.join(output_dir, "catalogue.sqlite"))
+    with mock.patch.object(get_laads, "LAADS_URL", server.url + "/"):
+        files = get_laads.get_laads_files(query_file, output_dir,
+                                          catalogue=catalogue)
+    catalogue.close()
+    return files
+
+
+DOWNLOADERS = {"sentinel": sentinel, "s2aws": s2aws,
+               "s2aws-async": s2aws_async, "modis": modis, "laads": laads}
+
+
+@contextlib.contextmanager
+def cold_caches():
+    """Use an empty cache directory (so no cached responses, catalogue or
+    MODIS indices) for the length of the block, so that every run does all
+    the work."""
+    cache_dir = tempfile.mkdtemp()
+    try:
+        with mock.patch.object(cache, "CACHE_DIR", cache_dir), \
+                mock.patch.object(cache, "_response_cache", None), \
+                mock.patch.dict(_catalogues, clear=True), \
+                mock.patch.dict(_indices, clear=True):
+            try:
+                yield
+            finally:
+                for db in (list(_catalogues.values()) +
+                           list(_indices.values()) +
+                           [cache._response_cache]):
+                    if db is not None:
+                        db.close()
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def run(downloader, args, trace=False):
+    """Run a downloader against a fresh stand-in, with cold caches."""
+    output_dir = tempfile.mkdtemp()
+    try:
+        with cold_caches(), StandinServer() as server:
+            server.latency = args.latency / 1000.
+            server.bandwidth = args.bandwidth and args.bandwidth * 1e6
+            server.error_rate = args.error_rate
+            if trace:
+                tracemalloc.start()
+            t0 = time.perf_counter()
+            files = downloader(server, output_dir, args.scale)
+            elapsed = time.perf_counter() - t0
+            peak = 0
+            if trace:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            n_bytes = sum(os.path.getsize(fname) for fname in files)
+            return len(files), n_bytes, elapsed, server.total_requests, peak
+    finally:
+        shutil.rmtree(output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--latency", type=float, default=20.)
+    parser.add_argument("--bandwidth", type=float, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.)
+    parser.add_argument("--scale", type=float, default=1.)
+    parser.add_argument("downloaders", nargs="*", default=list(DOWNLOADERS))
+    args = parser.parse_args()
+    for name in args.downloaders:
+        if name not in DOWNLOADERS:
+            parser.error("Unknown downloader %s (choose from %s)" %
+                         (name, ", ".join(DOWNLOADERS)))
+    print("%.0f ms latency, %s bandwidth, %.0f %% errors" % (
+        args.latency, "%g MB/s" % args.bandwidth if args.bandwidth else "no",
+        100 * args.error_rate))
+    print("%-12s %7s %9s %9s %9s %9s %10s" % (
+        "downloader", "files", "time (s)", "files/s", "MB/s", "requests",
+        "peak (MB)"))
+    for name in args.downloaders:
+        n_files, n_bytes, elapsed, n_requests, _ = run(DOWNLOADERS[name],
+                                                       args)
+        # Memory is measured in another run, as tracing slows things down
+        peak = run(DOWNLOADERS[name], args, trace=True)[4]
+        print("%-12s %7d %9.2f %9.1f %9.1f %9d %10.1f" % (
+            name, n_files, elapsed, n_files / elapsed,
+            n_bytes / 1e6 / elapsed, n_requests, peak / 1e6))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Download throughput for the different write durability modes of
+``download_product``, against the local archive stand-in. Run from the top
+of the repository with
+
+    python -m benchmarks.bench_durability [--size MiB] [--repeat N] [dir]
+
+Point ``dir`` at the filesystem you care about (e.g. Lustre scratch), as
+that is where the difference between the modes shows up.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from grabba_grabba_hey import sentinel_downloader
+
+from tests.standin import StandinServer
+
+SETTINGS = [("chunk", False), ("close", False), ("close", True),
+            ("none", False)]
+
+
+def run(size, repeat, output_dir):
+    data = os.urandom(size * 1048576)
+    with StandinServer() as server:
+        server.products["S1A_BENCH"] = data
+        print("%-8s %-12s %10s" % ("mode", "preallocate", "MB/s"))
+        for durability, preallocate in SETTINGS:
+            timings = []
+            for i in range(repeat):
+                target = os.path.join(output_dir, "S1A_BENCH.zip")
+                t0 = time.perf_counter()
+                sentinel_downloader.download_product(
+                    server.product_url("S1A_BENCH"), target,
+                    durability=durability, preallocate=preallocate)
+                timings.append(time.perf_counter() - t0)
+                os.remove(target)
+            print("%-8s %-12s %10.1f" % (durability, preallocate,
+                                         len(data) / 1e6 / min(timings)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--size", type=int, default=256,
+                        help="Product size in MiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("output_dir", nargs="?", default=None)
+    args = parser.parse_args()
+    output_dir = args.output_dir or tempfile.mkdtemp()
+    try:
+        run(args.size, args.repeat, output_dir)
+    finally:
+        if args.output_dir is None:
+            shutil.rmtree(output_dir)
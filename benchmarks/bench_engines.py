@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Files per second downloading lots of small files (like the bits of an S2
+tile on AWS) with the thread pool and with the asyncio engine, against the
+local archive stand-in with some added latency per request. Run from the
+top of the repository with
+
+    python -m benchmarks.bench_engines [--files N] [--size KiB]
+                                       [--latency ms] [--threads N]
+                                       [--in-flight N]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from functools import partial
+
+from grabba_grabba_hey import aio, sentinel_downloader
+from grabba_grabba_hey.retry import run_with_requeue
+from grabba_grabba_hey.sessions import get_session
+
+from tests.standin import StandinServer
+
+
+def with_threads(urls, output_dir, n_threads):
+    get_session(pool_size=n_threads)
+    grabber = partial(sentinel_downloader.aws_grabber, output_dir=output_dir)
+    return list(run_with_requeue(grabber, urls, n_threads=n_threads))
+
+
+def with_asyncio(urls, output_dir, max_in_flight):
+    jobs = [(url, os.path.join(output_dir, url.split("tiles/")[-1]))
+            for url in urls]
+    return aio.download_files(jobs, max_in_flight=max_in_flight)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=50.)
+    parser.add_argument("--threads", type=int, default=15)
+    parser.add_argument("--in-flight", type=int, default=200)
+    args = parser.parse_args()
+    engines = [("threads (%d)" % args.threads,
+                partial(with_threads, n_threads=args.threads)),
+               ("asyncio (%d)" % args.in_flight,
+                partial(with_asyncio, max_in_flight=args.in_flight))]
+    with StandinServer() as server:
+        server.latency = args.latency / 1000.
+        data = os.urandom(args.size * 1024)
+        urls = []
+        for i in range(args.files):
+            path = "/tiles/29/T/NJ/2017/1/%d/0/B%02d.jp2" % (i // 50, i % 50)
+            server.files[path] = data
+            urls.append(server.url + path)
+        print("%d files of %d KiB, %.0f ms latency" % (args.files, args.size,
+                                                      args.latency))
+        print("%-16s %10s %10s %8s" % ("engine", "time (s)", "files/s",
+                                        "errors"))
+        for name, engine in engines:
+            output_dir = tempfile.mkdtemp()
+            for i in range(args.files // 50 + 1):
+                os.makedirs(os.path.join(output_dir, "29/T/NJ/2017/1/%d/0" %
+                                         i))
+            t0 = time.perf_counter()
+            results = engine(urls, output_dir)
+            elapsed = time.perf_counter() - t0
+            errors = sum(err is not None for _, _, err in results)
+            print("%-16s %10.2f %10.0f %8d" % (name, elapsed,
+                                               args.files / elapsed, errors))
+            shutil.rmtree(output_dir)
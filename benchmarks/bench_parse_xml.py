@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Time and peak memory of parsing a large OData feed, comparing the streaming
+``iter_granules`` parser with building the whole element tree first. Run
+from the top of the repository with
+
+    python -m benchmarks.bench_parse_xml [--entries N]
+"""
+import argparse
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+from grabba_grabba_hey import sentinel_downloader
+
+ENTRY = """<entry>
+<title>S1A_IW_GRDH_1SDV_{0:06d}</title>
+<link href="https://scihub.copernicus.eu/apihub/odata/v1/Products('{0:06d}')/$value"/>
+<link rel="alternative" href="https://scihub.copernicus.eu/apihub/odata/v1/Products('{0:06d}')/"/>
+<link rel="icon" href="https://scihub.copernicus.eu/apihub/odata/v1/Products('{0:06d}')/Products('Quicklook')/$value"/>
+<id>{0:06d}</id>
+<summary>Date: 2017-01-11T11:23:42.026Z, Instrument: SAR-C SAR, Mode: VV VH, Satellite: Sentinel-1, Size: 1.64 GB</summary>
+<date name="ingestiondate">2017-01-11T13:31:53.503Z</date>
+<date name="beginposition">2017-01-11T11:23:42.026Z</date>
+<date name="endposition">2017-01-11T11:24:07.025Z</date>
+<int name="missiondatatakeid">{0:d}</int>
+<int name="orbitnumber">{0:d}</int>
+<int name="lastorbitnumber">{0:d}</int>
+<int name="relativeorbitnumber">147</int>
+<str name="filename">S1A_IW_GRDH_1SDV_{0:06d}.SAFE</str>
+<str name="identifier">S1A_IW_GRDH_1SDV_{0:06d}</str>
+<str name="instrumentshortname">SAR-C SAR</str>
+<str name="orbitdirection">ASCENDING</str>
+<str name="producttype">GRD</str>
+<str name="footprint">POLYGON ((-8.1 42.1,-5.2 42.5,-4.8 40.9,-7.7 40.5,-8.1 42.1))</str>
+</entry>
+"""
+
+
+def make_feed(n_entries):
+    return ('<?xml version="1.0" encoding="utf-8"?>' +
+            '<feed xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/" ' +
+            'xmlns="http://www.w3.org/2005/Atom">' +
+            "<opensearch:totalResults>%d</opensearch:totalResults>" %
+            n_entries +
+            "".join(ENTRY.format(i) for i in range(n_entries)) + "</feed>")
+
+
+def tree_parser(xml):
+    """Build the whole tree and make a dictionary per entry, the way the
+    parser used to."""
+    fields = set(sentinel_downloader.GRANULE_FIELDS)
+    granules = []
+    tree = ET.ElementTree(ET.fromstring(xml))
+    for elem in tree.iter(tag=sentinel_downloader.ATOM_ENTRY):
+        granule = {}
+        for img in elem:
+            if img.tag.find("id") >= 0:
+                granule['id'] = img.text
+            if "href" in img.attrib:
+                if img.attrib['href'].find("Quicklook") >= 0:
+                    granule['quicklook'] = img.attrib['href']
+                elif img.attrib['href'].find("$value") >= 0:
+                    granule['link'] = img.attrib['href'].replace("$value", "")
+            if img.attrib.get("name") in fields:
+                granule[img.attrib['name']] = img.text
+        granules.append(granule)
+    return granules
+
+
+def measure(parser, xml, repeat=3):
+    """Best time out of ``repeat`` runs, and peak memory of another run (as
+    tracing memory slows things down)."""
+    timings = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        granules = parser(xml)
+        timings.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    parser(xml)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return len(granules), min(timings), peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--entries", type=int, default=10000)
+    args = parser.parse_args()
+    xml = make_feed(args.entries)
+    print("Feed with %d entries, %.1f MB" % (args.entries, len(xml) / 1e6))
+    print("%-14s %8s %10s %12s" % ("parser", "granules", "time (s)",
+                                    "peak (MB)"))
+    for name, the_parser in [("tree", tree_parser),
+                             ("iter_granules", sentinel_downloader.parse_xml)]:
+        n, elapsed, peak = measure(the_parser, xml)
+        print("%-14s %8d %10.3f %12.1f" % (name, n, elapsed, peak / 1e6))
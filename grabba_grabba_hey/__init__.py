@@ -0,0 +1,5 @@
+"""
+Download EO data (Sentinel, MODIS, Landsat) from the archives. The modules
+share sessions, caches and retries with each other, so the scripts have to
+be run as modules, e.g. ``python -m grabba_grabba_hey.get_laads``.
+"""
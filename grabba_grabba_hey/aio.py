@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+An asyncio download engine, for archives where a job is lots of small files
+(e.g. the dozens of JP2/XML/GML files of an S2 tile on AWS, or LAADS
+granules). With threads, the number of files in flight is the number of
+threads; here it's only limited by ``max_in_flight``, and hundreds of
+requests can be waiting on the network at the same time. Memory is bounded
+as there are never more than ``max_in_flight`` downloads going on, each
+streaming to disk in chunks.
+
+This needs ``aiohttp`` (``pip install grabba_grabba_hey[async]``). The
+``download_files`` wrapper can be called from normal (synchronous) code.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent import futures
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import metrics
+from .ratelimit import get_throttle
+from .retry import (RETRY_STATUSES, STATS, RetryableError, RetryPolicy,
+                    retry_after)
+from .transfer import CONTENT_RANGE
+
+LOG = logging.getLogger(__name__)
+
+MAX_IN_FLIGHT = 200
+CHUNK_SIZE = 65536
+
+
+def _check_aiohttp():
+    if aiohttp is None:
+        raise ImportError("The asyncio engine needs aiohttp. Install it " +
+                          "with `pip install grabba_grabba_hey[async]`")
+
+
+async def _fetch(session, url, fname, policy, queued=None):
+    """Download ``url`` to ``fname`` (through ``fname.partial``), trying
+    again after errors worth retrying. As in ``transfer.fetch_resumable``,
+    a partial file that is already there is resumed with a ``Range``
+    request (and taken as complete if the server says there's nothing
+    left), unless the server sends the whole file again. ``queued`` is when
+    the job was queued (``time.monotonic``), for the metrics. Returns the
+    size of the file."""
+    retryable = (aiohttp.ClientError, asyncio.TimeoutError, RetryableError)
+    throttle = get_throttle(url)
+    measure = metrics.enabled()
+    part = fname + ".partial"
+    for attempt in range(policy.max_retries + 1):
+        t0 = time.monotonic()
+        queue_wait = None if queued is None else t0 - queued
+        ttfb = None
+        n_bytes = 0
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {"Range": "bytes=%d-" % offset} if offset > 0 else None
+        try:
+            await asyncio.sleep(throttle.reserve_request())
+            # Time to first byte doesn't include waiting for the rate limit
+            t0 = time.monotonic()
+            async with session.get(url, headers=headers) as r:
+                ttfb = time.monotonic() - t0
+                if offset > 0 and r.status == 416:
+                    match = CONTENT_RANGE.match(
+                        r.headers.get("Content-Range", ""))
+                    if match is not None and int(match.group(1)) == offset:
+                        LOG.debug("%s was complete" % part)
+                        os.replace(part, fname)
+                        return offset
+                    os.remove(part)
+                    raise RetryableError("%s is larger than %s, starting "
+                                         "again" % (part, url), retry_after=0)
+                if r.status in RETRY_STATUSES:
+                    wait = None
+                    if r.status in (429, 503):
+                        wait = retry_after(r)
+                    raise RetryableError("Can't get %s (error code %d)" %
+                                         (url, r.status), retry_after=wait)
+                if r.status >= 400:
+                    raise IOError("Can't get %s (error code %d)" %
+                                  (url, r.status))
+                if offset > 0 and r.status != 206:
+                    LOG.info("Server doesn't support resuming, starting "
+                             "again")
+                    offset = 0
+                file_size = None
+                if r.content_length is not None:
+                    file_size = offset + r.content_length
+                with open(part, "ab" if offset > 0 else "wb") as fp:
+                    async for block in r.content.iter_chunked(CHUNK_SIZE):
+                        wait = throttle.reserve_bytes(len(block))
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                        fp.write(block)
+                        n_bytes += len(block)
+            if file_size is not None and offset + n_bytes != file_size:
+                raise RetryableError("Only got %d of the %d bytes of %s" %
+                                     (offset + n_bytes, file_size, url))
+            os.replace(part, fname)
+            if measure:
+                metrics.record(url, n_bytes, time.monotonic() - t0,
+                               ttfb=ttfb, fname=fname, retries=attempt,
+                               queue_wait=queue_wait)
+            return offset + n_bytes
+        except Exception as err:
+            if measure:
+                metrics.record(url, n_bytes, time.monotonic() - t0,
+                               ttfb=ttfb, fname=fname, error=err,
+                               retries=attempt, queue_wait=queue_wait)
+            if not isinstance(err, retryable) or \
+                    attempt == policy.max_retries:
+                raise
+            wait = policy.wait(attempt, err)
+            STATS.record(url, lost=time.monotonic() - t0, waited=wait)
+            LOG.info("%s failed (%s), retrying in %.1f s" % (url, err, wait))
+            await asyncio.sleep(wait)
+            # Back in the queue once the backoff is over
+            queued = time.monotonic()
+
+
+async def download_files_async(jobs, max_in_flight=MAX_IN_FLIGHT,
+                               max_per_host=0, policy=None, auth=None,
+                               on_done=None):
+    """Download files concurrently. See ``download_files``."""
+    _check_aiohttp()
+    policy = policy or RetryPolicy()
+    # Jobs we were given all at once have been queued since the start, the
+    # ones from a generator since it came up with them (as in
+    # ``retry.run_with_requeue``)
+    start = time.monotonic() if hasattr(jobs, "__len__") else None
+    jobs = iter(jobs)
+    results = []
+    connector = aiohttp.TCPConnector(limit=max_in_flight,
+                                     limit_per_host=max_per_host)
+    if auth is not None:
+        auth = aiohttp.BasicAuth(*auth)
+
+    async def worker(session):
+        # Each worker takes the next job when it's done with the last one,
+        # so there are never more than ``max_in_flight`` jobs started
+        for url, fname in jobs:
+            queued = time.monotonic() if start is None else start
+            try:
+                n_bytes = await _fetch(session, url, fname, policy,
+                                       queued=queued)
+            except Exception as err:
+                LOG.error("Giving up on %s (%s)" % (url, err))
+                results.append((url, None, err))
+                continue
+            if on_done is not None:
+                on_done(url, fname, n_bytes)
+            results.append((url, fname, None))
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     auth=auth) as session:
+        await asyncio.gather(*[worker(session)
+                               for i in range(max_in_flight)])
+    return results
+
+
+def download_files(jobs, max_in_flight=MAX_IN_FLIGHT, max_per_host=0,
+                   policy=None, auth=None, on_done=None):
+    """Download lots of files with asyncio, from normal code.
+
+    Parameters
+    ------------
+    jobs: iterable
+        ``(url, filename)`` tuples. The directories must exist.
+    max_in_flight: int
+        Maximum number of downloads going on at the same time
+    max_per_host: int
+        Maximum number of connections per host (0 for no limit other than
+        ``max_in_flight``)
+    policy: RetryPolicy
+        How many times and when to retry (see ``retry.RetryPolicy``)
+    auth: tuple
+        A (username, password) tuple, if needed
+    on_done: callable
+        Called with the URL, the filename and the number of bytes of every
+        file downloaded
+    Returns
+    --------
+    A list of ``(url, filename, error)`` tuples in the order the downloads
+    finished, with ``filename`` set to ``None`` and the exception in
+    ``error`` for the ones that failed.
+    """
+    _check_aiohttp()
+    coro = download_files_async(jobs, max_in_flight=max_in_flight,
+                                max_per_host=max_per_host, policy=policy,
+                                auth=auth, on_done=on_done)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # There's already an event loop running in this thread (e.g. in a
+    # notebook), so run ours in another thread
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
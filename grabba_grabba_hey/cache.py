@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+"""
+Local caches of things we have already asked the archives about, so that
+running the same (or an overlapping) job again doesn't need to go back to
+the network. Everything lives under ``CACHE_DIR``, which can be set with
+the ``GRABBA_CACHE_DIR`` environment variable.
+"""
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import requests
+
+from .sessions import get_session
+
+LOG = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get("GRABBA_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".cache",
+                                        "grabba_grabba_hey"))
+
+
+def cache_path(name, cache_dir=None):
+    """The full path of a file in the cache directory, which is created if
+    needed."""
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, name)
+
+
+def open_db(name, schema, cache_dir=None):
+    """Open (and create if needed) an SQLite database in the cache
+    directory. The database uses write-ahead logging, so that several jobs
+    can use it at the same time.
+
+    Parameters
+    ------------
+    name: str
+        The database file name, or a full path
+    schema: str
+        SQL statements to create the tables and indices, if they don't exist
+    cache_dir: str
+        The cache directory, ``CACHE_DIR`` by default
+    Returns
+    --------
+    An ``sqlite3.Connection``
+    """
+    if os.path.dirname(name):
+        fname = name
+    else:
+        fname = cache_path(name, cache_dir=cache_dir)
+    conn = sqlite3.connect(fname, timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    with conn:
+        conn.executescript(schema)
+    return conn
+
+
+# How long (in seconds) a response is fresh, by the first pattern matching
+# its URL. Listings of the archives change slowly, and once a response is
+# stale it is revalidated (with its ETag or Last-Modified date) rather than
+# downloaded again, if the server allows it.
+RESPONSE_TTLS = [
+    (r"scihub\.copernicus\.eu|/search\?", 10 * 60),
+    (r"s3\.amazonaws\.com", 6 * 3600),
+    (r"e4ftl01\.cr\.usgs\.gov", 3600),
+    (r"ladsweb\.modaps\.eosdis\.nasa\.gov", 3600),
+]
+DEFAULT_TTL = 15 * 60
+RESPONSE_CACHE = "responses.sqlite"
+RESPONSE_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    body BLOB NOT NULL,
+    encoding TEXT,
+    etag TEXT,
+    last_modified TEXT,
+    fetched REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+MEMORY_BYTES = 32 * 1048576
+DISK_BYTES = 512 * 1048576
+N_LOCKS = 64
+
+
+class CachedResponse(object):
+    """What ``cached_get`` returns, which looks enough like a
+    ``requests.Response`` for the listing and query code. The headers are
+    only there for responses that weren't cached (e.g. errors, so that
+    ``retry.check_response`` sees ``Retry-After``)."""
+    def __init__(self, url, status_code, content, encoding=None,
+                 from_cache=False, headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding or "utf-8"
+        self.from_cache = from_cache
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, "replace")
+
+
+class ResponseCache(object):
+    """A cache of successful GET responses, keyed on the full URL (query
+    included). Responses are kept in memory (the most recently used, up to
+    ``memory_bytes``) and in an SQLite database in the cache directory (up
+    to ``disk_bytes``, dropping the least recently used ones), so that they
+    are shared by all the jobs running on the machine. Only one thread (and
+    one process, where file locks are available) fetches a given URL at a
+    time: the others wait and then use what it got.
+    """
+    def __init__(self, fname=None, memory_bytes=MEMORY_BYTES,
+                 disk_bytes=DISK_BYTES, ttls=None):
+        self.fname = fname or RESPONSE_CACHE
+        self.db = open_db(self.fname, RESPONSE_CACHE_SCHEMA)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.ttls = [(re.compile(pattern), ttl)
+                     for pattern, ttl in (ttls or RESPONSE_TTLS)]
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        self.key_locks = [threading.Lock() for i in range(N_LOCKS)]
+        self.lock_dir = os.path.join(os.path.dirname(self.db_path()),
+                                     "locks")
+
+    def db_path(self):
+        if os.path.dirname(self.fname):
+            return self.fname
+        return cache_path(self.fname)
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return DEFAULT_TTL
+
+    def _remember(self, key, entry):
+        """Put an entry in the memory layer, dropping the least recently
+        used ones if needed. Needs ``self.lock``."""
+        if key in self.memory:
+            self.memory_size -= self.memory.pop(key)["size"]
+        if entry["size"] > self.memory_bytes:
+            return
+        self.memory[key] = entry
+        self.memory_size += entry["size"]
+        while self.memory_size > self.memory_bytes:
+            old_key, old_entry = self.memory.popitem(last=False)
+            self.memory_size -= old_entry["size"]
+
+    def lookup(self, key):
+        """Get an entry (a dictionary) from memory or disk, or ``None``."""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                return entry
+            row = self.db.execute(
+                "SELECT url, body, encoding, etag, last_modified, fetched, " +
+                "size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            with self.db:
+                self.db.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?",
+                    (now, key))
+            entry = dict(zip(["url", "body", "encoding", "etag",
+                              "last_modified", "fetched", "size"], row))
+            self._remember(key, entry)
+            return entry
+
+    def store(self, key, entry):
+        """Save an entry in memory and on disk, and evict the least recently
+        used entries on disk if it's grown too large."""
+        now = time.time()
+        with self.lock:
+            self._remember(key, entry)
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES " +
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, entry["url"], entry["body"], entry["encoding"],
+                     entry["etag"], entry["last_modified"], entry["fetched"],
+                     now, entry["size"]))
+                total = self.db.execute(
+                    "SELECT TOTAL(size) FROM responses").fetchone()[0]
+                if total > self.disk_bytes:
+                    self._evict(total - self.disk_bytes)
+
+    def _evict(self, excess):
+        evicted = []
+        for key, size in self.db.execute(
+                "SELECT key, size FROM responses ORDER BY accessed"):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        self.db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        for key, in evicted:
+            if key in self.memory:
+                self.memory_size -= self.memory.pop(key)["size"]
+
+    def clear(self):
+        with self.lock, self.db:
+            self.memory.clear()
+            self.memory_size = 0
+            self.db.execute("DELETE FROM responses")
+
+    @contextlib.contextmanager
+    def fetching(self, key):
+        """Hold the locks that make sure only one thread or process is
+        fetching ``key``."""
+        with self.key_locks[int(key[:8], 16) % N_LOCKS]:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.lock_dir, exist_ok=True)
+            # Lock files are shared by keys starting the same way, so that
+            # there are never more than 256 of them
+            with open(os.path.join(self.lock_dir, key[:2] + ".lock"),
+                      "w") as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def get(self, url, params=None, ttl=None, session=None, **kwargs):
+        """GET ``url`` (with ``params``), unless there's a fresh response in
+        the cache. Any other keyword arguments go to ``session.get``.
+        Responses are cached per user (the user name of the ``auth`` given,
+        or of the session), and requests with some other kind of ``auth``
+        are not cached at all.
+
+        Parameters
+        ------------
+        url: str
+            The URL
+        params: dict
+            The query parameters
+        ttl: float
+            How long (in seconds) a cached response is fresh, by default
+            given by ``RESPONSE_TTLS``. With 0, the response is always
+            revalidated.
+        session: requests.Session
+            The session to use, by default the shared one (see
+            ``sessions.get_session``)
+        Returns
+        --------
+        A ``CachedResponse``
+        """
+        full_url = requests.Request("GET", url, params=params).prepare().url
+        if session is None:
+            session = get_session()
+        user = _auth_user(kwargs.get("auth") or getattr(session, "auth", None))
+        if user is None:
+            # We can't tell whose response it'd be, so it's not shared
+            r = session.get(full_url, **kwargs)
+            return CachedResponse(full_url, r.status_code, r.content,
+                                  encoding=r.encoding, headers=r.headers)
+        # Responses to different accounts are kept apart
+        key = hashlib.sha1(("%s\n%s" % (user, full_url)).encode(
+            "utf-8")).hexdigest()
+        if ttl is None:
+            ttl = self.ttl(full_url)
+        entry = self.lookup(key)
+        if entry is not None and time.time() - entry["fetched"] < ttl:
+            return self._response(entry)
+        with self.fetching(key):
+            # Someone else may have got it while we waited
+            with self.lock:
+                self.memory.pop(key, None)
+            entry = self.lookup(key)
+            if entry is not None and time.time() - entry["fetched"] < ttl:
+                return self._response(entry)
+            headers = dict(kwargs.pop("headers", None) or {})
+            if entry is not None:
+                if entry["etag"]:
+                    headers["If-None-Match"] = entry["etag"]
+                if entry["last_modified"]:
+                    headers["If-Modified-Since"] = entry["last_modified"]
+            r = session.get(full_url, headers=headers, **kwargs)
+            if r.status_code == 304 and entry is not None:
+                LOG.debug("%s hasn't changed" % full_url)
+                entry = dict(entry, fetched=time.time())
+            elif r.status_code == 200:
+                content = r.content
+                entry = {"url": full_url, "body": content,
+                         "encoding": r.encoding,
+                         "etag": r.headers.get("ETag"),
+                         "last_modified": r.headers.get("Last-Modified"),
+                         "fetched": time.time(), "size": len(content)}
+            else:
+                # Errors aren't cached
+                return CachedResponse(full_url, r.status_code, r.content,
+                                      encoding=r.encoding, headers=r.headers)
+            self.store(key, entry)
+            response = self._response(entry)
+            response.from_cache = r.status_code == 304
+            return response
+
+    def _response(self, entry):
+        return CachedResponse(entry["url"], 200, entry["body"],
+                              encoding=entry["encoding"], from_cache=True)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def _auth_user(auth):
+    """Who a request is made as: ``""`` for nobody, the user name of a
+    ``(user, password)`` tuple or of a ``requests`` basic/digest auth, or
+    ``None`` if we can't tell."""
+    if auth is None:
+        return ""
+    if isinstance(auth, (tuple, list)) and auth:
+        return str(auth[0])
+    user = getattr(auth, "username", None)
+    return None if user is None else str(user)
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """The ``ResponseCache`` shared by the whole process."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+
+def cached_get(url, params=None, ttl=None, session=None, cache=None,
+               **kwargs):
+    """GET a URL through a ``ResponseCache`` (by default, the one shared by
+    the whole process). See ``ResponseCache.get``."""
+    if cache is None:
+        cache = get_response_cache()
+    return cache.get(url, params=params, ttl=ttl, session=session, **kwargs)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+A simple database of acquired data, shared by all the downloaders. Every
+product that has been downloaded (and checked) is recorded with where it
+was saved, its size and checksum, so that when a job is run again (e.g. as
+a cronjob) working out what is left to download is just a local query,
+without asking the archive about files we already have.
+"""
+import datetime
+import os
+import threading
+from collections import namedtuple
+
+from .cache import open_db
+
+CATALOGUE = "catalogue.sqlite"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    product_id TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    checksum TEXT,
+    first_seen TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS products_source ON products (source);
+"""
+
+Product = namedtuple("Product", ["product_id", "source", "path", "size",
+                                 "checksum", "first_seen", "updated"])
+
+_catalogues = {}
+_catalogues_lock = threading.Lock()
+
+
+class Catalogue(object):
+    """The catalogue of acquired products. Products are identified by their
+    file name (e.g. ``MOD09GA.A2017001.h17v04.006.2017003043436.hdf``).
+    A catalogue can be shared by several threads."""
+    def __init__(self, fname=None):
+        self.fname = fname or CATALOGUE
+        self.db = open_db(self.fname, SCHEMA)
+        self.lock = threading.Lock()
+
+    def add(self, product_id, path, source, size=None, checksum=None):
+        """Record a product as acquired. If ``size`` isn't given, it is
+        taken from the file."""
+        if size is None:
+            size = os.path.getsize(path)
+        # UTC, without the offset, as the times already recorded
+        now = datetime.datetime.now(datetime.timezone.utc).replace(
+            tzinfo=None).isoformat()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?) " +
+                "ON CONFLICT(product_id) DO UPDATE SET source = " +
+                "excluded.source, path = excluded.path, size = " +
+                "excluded.size, checksum = excluded.checksum, updated = " +
+                "excluded.updated",
+                (product_id, source, os.path.abspath(path), size, checksum,
+                 now, now))
+
+    def get(self, product_id):
+        """Get the record of a product, or ``None`` if it isn't known."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT * FROM products WHERE product_id = ?",
+                (product_id,)).fetchone()
+        return None if row is None else Product(*row)
+
+    def remove(self, product_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM products WHERE product_id = ?",
+                            (product_id,))
+
+    def has(self, product_id, path=None, check_file=True):
+        """Whether a product has been acquired. With ``check_file``, the
+        file also has to be where it was saved (or at ``path``) with the
+        right size."""
+        product = self.get(product_id)
+        if product is None:
+            return False
+        if path is not None and \
+                os.path.abspath(path) != product.path:
+            return False
+        if check_file:
+            return _file_ok(product.path, product.size)
+        return True
+
+    def known(self, product_ids, check_files=True, directory=None):
+        """Which of ``product_ids`` have been acquired, in one go (see
+        ``has``). With ``directory``, only products saved there count, so
+        that a product saved somewhere else is downloaded again.
+
+        Returns
+        --------
+        A set of product ids
+        """
+        product_ids = list(product_ids)
+        if directory is not None:
+            directory = os.path.abspath(directory)
+        found = set()
+        with self.lock:
+            # SQLite has a limit on the number of parameters
+            for i in range(0, len(product_ids), 500):
+                some_ids = product_ids[i:i + 500]
+                rows = self.db.execute(
+                    "SELECT product_id, path, size FROM products WHERE " +
+                    "product_id IN (%s)" % ", ".join("?" * len(some_ids)),
+                    some_ids)
+                for product_id, path, size in rows:
+                    if directory is not None and \
+                            path != os.path.join(directory, product_id):
+                        continue
+                    if not check_files or _file_ok(path, size):
+                        found.add(product_id)
+        return found
+
+    def products(self, source=None):
+        """All the products acquired (from ``source``)."""
+        with self.lock:
+            if source is None:
+                rows = self.db.execute("SELECT * FROM products").fetchall()
+            else:
+                rows = self.db.execute(
+                    "SELECT * FROM products WHERE source = ?",
+                    (source,)).fetchall()
+        return [Product(*row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def _file_ok(path, size):
+    try:
+        return size is None or os.stat(path).st_size == size
+    except OSError:
+        return False
+
+
+def get_catalogue(catalogue=None):
+    """Get a catalogue. ``catalogue`` can be a ``Catalogue`` (which is
+    returned as is), or the file name of a catalogue, which is opened only
+    once per process. By default, ``CATALOGUE`` in the cache directory."""
+    if isinstance(catalogue, Catalogue):
+        return catalogue
+    fname = catalogue or CATALOGUE
+    with _catalogues_lock:
+        if fname not in _catalogues:
+            _catalogues[fname] = Catalogue(fname)
+        return _catalogues[fname]
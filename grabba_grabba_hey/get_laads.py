@@ -6,45 +6,93 @@ import os
 import json
 from functools import partial
 
-import requests
-from concurrent import futures
+from . import aio
+from .catalogue import get_catalogue
+from .retry import STATS, run_with_requeue
+from .sessions import get_session
+from .transfer import fetch_resumable
 
 logging.basicConfig(level=logging.INFO)
 
 LOG = logging.getLogger(__name__)
 
-def download_granule(url, output_directory="."):
-    r = requests.get( url, stream=True )
-    if not r.ok:
-        raise IOError("Can't start download of %s" % url)
-    
+LAADS_URL = "https://ladsweb.modaps.eosdis.nasa.gov/"
+ENGINES = ("threads", "async")
+
+def download_granule(url, output_directory=".", catalogue=None):
     fname = url.split("/")[-1]
+    output_fname = os.path.join(output_directory, fname)
+    catalogue = get_catalogue(catalogue)
+    if catalogue.has(fname, path=output_fname):
+        LOG.info("Already got %s" % output_fname)
+        return output_fname
+    if os.path.exists(output_fname) and \
+            not os.path.exists(output_fname + ".partial"):
+        # Not in the catalogue, so it may not be all there. If it is, the
+        # server says there's nothing left to get.
+        os.replace(output_fname, output_fname + ".partial")
+
     LOG.debug("Getting %s from %s" % (fname, url))
-    file_size = int(r.headers['content-length'])
+    file_size = fetch_resumable(get_session().get, url, output_fname,
+                                chunk_size=65536, durability="none")
     LOG.debug("\t%s file size: %d" % (fname, file_size))
-    output_fname = os.path.join(output_dir, fname)
-    with open(output_fname, 'wb') as fp:
-        for block in r.iter_content(65536):
-            fp.write(block)
+    catalogue.add(fname, output_fname, "laads", size=file_size)
     LOG.info("Done with %s" % output_fname)
     return output_fname
     
 
-def get_laads_files(laad_query_file, output_dir, n_threads=10):
-    parent_url = "https://ladsweb.modaps.eosdis.nasa.gov/"
+def get_laads_files(laad_query_file, output_dir, n_threads=10,
+                    catalogue=None, engine="threads",
+                    max_in_flight=aio.MAX_IN_FLIGHT):
+    """Download the granules of a LAADS query (a JSON file) to
+    ``output_dir``, skipping the ones already in the ``catalogue``.
+    Interrupted downloads are resumed, and files that are there but not in
+    the catalogue are only checked against the size on the server. Files
+    are downloaded by ``n_threads`` threads, or with ``engine="async"`` by
+    the asyncio engine (see ``aio.download_files``), with up to
+    ``max_in_flight`` files at the same time."""
+    if engine not in ENGINES:
+        raise ValueError("engine can only be one of %s. You provided %s" %
+                         (", ".join(ENGINES), engine))
     jj=json.load(open(laad_query_file, 'r'))
     urls = []
-    for granule in jj.iterkeys():
+    for granule in jj.keys():
         if granule != "query":
-            the_url = "%s/%s" % (parent_url, jj[granule]["url"])
+            the_url = "%s/%s" % (LAADS_URL.rstrip("/"),
+                                 jj[granule]["url"].lstrip("/"))
             urls.append(the_url)
     dloaded_files = []
-    download_granule_patch = partial(download_granule, 
-                                     output_directory=output_dir)
-    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-        for fich in executor.map(download_granule_patch, urls):
+    catalogue = get_catalogue(catalogue)
+    if engine == "async":
+        acquired = catalogue.known((url.split("/")[-1] for url in urls),
+                                   directory=output_dir)
+        jobs = [(url, os.path.join(output_dir, url.split("/")[-1]))
+                for url in urls if url.split("/")[-1] not in acquired]
+        for url, fname in jobs:
+            if os.path.exists(fname) and \
+                    not os.path.exists(fname + ".partial"):
+                # As in ``download_granule``: if it's all there, the server
+                # says there's nothing left to get
+                os.replace(fname, fname + ".partial")
+        results = aio.download_files(
+            jobs, max_in_flight=max_in_flight,
+            on_done=lambda url, fname, n_bytes: catalogue.add(
+                os.path.basename(fname), fname, "laads", size=n_bytes))
+        dloaded_files.extend(os.path.join(output_dir, fname)
+                             for fname in acquired)
+    else:
+        download_granule_patch = partial(download_granule, 
+                                         output_directory=output_dir,
+                                         catalogue=catalogue)
+        get_session(pool_size=n_threads)
+        results = run_with_requeue(download_granule_patch, urls,
+                                   n_threads=n_threads)
+    for url, fich, err in results:
+        if err is None:
             dloaded_files.append(fich)
+    STATS.report()
     LOG.info("Done downloading!")
+    return dloaded_files
 
 if __name__ == "__main__":
     query_file = sys.argv[1]
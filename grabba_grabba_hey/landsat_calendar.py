@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Offline calendar of Landsat overpasses. Landsat 5, 7 and 8 repeat their
+WRS-2 paths every 16 days, with neighbouring paths 7 days apart in the
+cycle, so when a path is seen only depends on the path, the sensor and the
+date. Everything works on NumPy arrays, so that the overpasses of thousands
+of paths over decades can be worked out in one go (e.g. to plan a large
+request without going near the archive). ``next_overpasses`` gives the same
+dates as ``landsat_downloader.next_overpass`` does one at a time.
+
+Not every overpass has a scene (e.g. no station got it), so the overpasses
+that turned out to have nothing are kept in ``EmptyScenes``, an SQLite
+database in the cache directory, and are not asked about again.
+"""
+import datetime
+import threading
+import time
+
+import numpy as np
+
+from .cache import open_db
+
+CYCLE = 16
+EMPTY_SCENES = "landsat_empty.sqlite"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS empty (
+    scene TEXT NOT NULL,
+    station TEXT NOT NULL,
+    probed REAL NOT NULL,
+    PRIMARY KEY (scene, station)
+) WITHOUT ROWID;
+"""
+# Scenes can take a while to turn up in the archive, so an overpass is only
+# taken to be empty once it is older than this
+SETTLE_DAYS = 30
+# An overpass of path 1 (which is on day 5 of the cycle), per sensor
+SENSOR_EPOCHS = {"LT5": np.datetime64("1985-05-04"),
+                 "LE7": np.datetime64("1999-01-11"),
+                 "LC8": np.datetime64("2013-05-01")}
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def _days(dates):
+    """Dates (``datetime``, ``date``, strings or ``datetime64``) as an
+    array of ``datetime64[D]``."""
+    if isinstance(dates, (datetime.datetime, datetime.date)):
+        dates = dates.strftime("%Y-%m-%d")
+    return np.asarray(dates, dtype="datetime64[D]")
+
+
+def cycle_days(paths):
+    """The day in the 16 day cycle of WRS-2 paths, as in
+    ``landsat_downloader.cycle_day``.
+
+    Parameters
+    ------------
+    paths: array
+        WRS-2 path numbers (1 to 233)
+    Returns
+    --------
+    An integer array of days
+    """
+    paths = np.asarray(paths, dtype=int)
+    day = (5 + 7 * (paths - 1)) % CYCLE
+    # Paths after the date line
+    return day + (paths >= 98)
+
+
+def sensor_epochs(sensors):
+    """The ``SENSOR_EPOCHS`` of an array of sensors (LT5, LE7 or LC8)."""
+    sensors = np.asarray(sensors)
+    names, inverse = np.unique(sensors, return_inverse=True)
+    unknown = set(names.tolist()).difference(SENSOR_EPOCHS)
+    if unknown:
+        raise ValueError("Unknown sensor(s) %s (choose from %s)" %
+                         (", ".join(sorted(unknown)),
+                          ", ".join(SENSOR_EPOCHS)))
+    epochs = np.array([SENSOR_EPOCHS[name] for name in names.tolist()],
+                      dtype="datetime64[D]")
+    return epochs[inverse].reshape(sensors.shape)
+
+
+def next_overpasses(dates, paths, sensors):
+    """The first overpass on or after each date. The arguments are
+    broadcast against each other, so e.g. one date can be given for lots of
+    paths.
+
+    Parameters
+    ------------
+    dates: array
+        The dates (see ``_days`` for what will do)
+    paths: array
+        WRS-2 path numbers
+    sensors: array
+        LT5, LE7 or LC8
+    Returns
+    --------
+    An array of ``datetime64[D]`` dates
+    """
+    dates = _days(dates)
+    days = (dates - sensor_epochs(sensors)).astype(int)
+    wait = (cycle_days(paths) - 1 - days) % CYCLE
+    return dates + wait.astype("timedelta64[D]")
+
+
+def overpass_calendar(paths, sensors, start_date, end_date):
+    """Every overpass of some paths between two dates (both included).
+
+    Parameters
+    ------------
+    paths: array
+        WRS-2 path numbers
+    sensors: array
+        LT5, LE7 or LC8, broadcast against ``paths``
+    start_date: datetime
+        The first date
+    end_date: datetime
+        The last date
+    Returns
+    --------
+    Two arrays of the same length: the positions of the overpasses in the
+    (broadcast) ``paths`` and ``sensors``, and their dates
+    (``datetime64[D]``). Overpasses are sorted by position, then date.
+    """
+    paths, sensors = np.broadcast_arrays(np.asarray(paths, dtype=int),
+                                         np.asarray(sensors))
+    paths = paths.ravel()
+    sensors = sensors.ravel()
+    start_date = _days(start_date)
+    end_date = _days(end_date)
+    first = next_overpasses(start_date, paths, sensors)
+    n_overpasses = (end_date - start_date).astype(int) // CYCLE + 1
+    dates = first[:, None] + \
+        (CYCLE * np.arange(max(n_overpasses, 0))).astype("timedelta64[D]")
+    inside = dates <= end_date
+    index = np.nonzero(inside)[0]
+    return index, dates[inside]
+
+
+def year_doy(dates):
+    """The year and day of year of ``datetime64`` dates, as in the
+    ``%Y%j`` bit of Landsat product names."""
+    dates = _days(dates)
+    years = dates.astype("datetime64[Y]")
+    doys = (dates - years).astype(int) + 1
+    return years.astype(int) + 1970, doys
+
+
+class EmptyScenes(object):
+    """Overpasses (scene names without the station and version, e.g.
+    LC81930302015003) that a station has no scene for. Can be shared by
+    several threads."""
+    def __init__(self, fname=None):
+        self.fname = fname or EMPTY_SCENES
+        self.db = open_db(self.fname, SCHEMA)
+        self.lock = threading.Lock()
+
+    def empty(self, scenes, station):
+        """Which of ``scenes`` are known to be empty for ``station``."""
+        scenes = list(scenes)
+        found = set()
+        with self.lock:
+            for i in range(0, len(scenes), 500):
+                some_scenes = scenes[i:i + 500]
+                rows = self.db.execute(
+                    "SELECT scene FROM empty WHERE station = ? AND " +
+                    "scene IN (%s)" % ", ".join("?" * len(some_scenes)),
+                    [station] + some_scenes)
+                found.update(row[0] for row in rows)
+        return found
+
+    def add(self, scene, stations, now=None):
+        """Record that ``stations`` have nothing for ``scene``, unless the
+        overpass is too recent for that to be final (see ``SETTLE_DAYS``).
+        ``now`` is the time (an aware ``datetime``) to count from, now by
+        default.
+
+        Returns
+        --------
+        Whether it was recorded
+        """
+        utc = datetime.timezone.utc
+        now = datetime.datetime.now(utc) if now is None else now
+        the_date = datetime.datetime.strptime(scene[-7:],
+                                              "%Y%j").replace(tzinfo=utc)
+        if now - the_date < datetime.timedelta(days=SETTLE_DAYS):
+            return False
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO empty VALUES " +
+                                "(?, ?, ?)", ((scene, station, time.time())
+                                              for station in stations))
+        return True
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def get_empty_scenes(index=None):
+    """Get the empty scenes. ``index`` can be an ``EmptyScenes`` (which is
+    returned as is), or the file name of one, which is opened only once per
+    process. By default, ``EMPTY_SCENES`` in the cache directory."""
+    if isinstance(index, EmptyScenes):
+        return index
+    fname = index or EMPTY_SCENES
+    with _indices_lock:
+        if fname not in _indices:
+            _indices[fname] = EmptyScenes(fname)
+        return _indices[fname]
@@ -2,12 +2,34 @@
 """
 Download Landsat data
 """
+import contextlib
+import logging
 import os
 import datetime
-import requests
 import math
+from concurrent import futures
+from functools import partial
+
+import numpy as np
+
+from .catalogue import get_catalogue
+from .landsat_calendar import get_empty_scenes, overpass_calendar, year_doy
+from .retry import STATS, call_with_retries, check_response
+from .sessions import new_session
+from .transfer import fetch_resumable
+
+LOG = logging.getLogger(__name__)
 
 BASE_URL = "http://earthexplorer.usgs.gov/download/"
+LOGIN_URL = "https://ers.cr.usgs.gov/login"
+# EarthExplorer dataset of each sensor
+DATASETS = {"LC8": "4923"}
+STATIONS = ("LGN",)
+VERSIONS = ("00", "01", "02")
+# Status codes of product names that aren't in the archive
+ABSENT_STATUSES = (404, 410)
+# Product names probed at the same time, per path/row
+N_PROBES = 6
 
 def cycle_day (path):
     """ provides the day in cycle given the path number
@@ -45,41 +67,199 @@ def next_overpass (date1, path, sat):
     return date_overpass
 
 
+def plan_overpasses(sensor, paths, rows, start_date, end_date):
+    """Work out which scenes there should be for some path/rows between two
+    dates, without going near the archive (a dry run). The overpass dates
+    come from ``landsat_calendar.overpass_calendar``.
+
+    Parameters
+    ------------
+    sensor: str or array
+        LT5, LE7 or LC8, or one of them per path/row
+    paths: array
+        WRS-2 paths
+    rows: array
+        WRS-2 rows, one per path
+    start_date: datetime
+        The first date
+    end_date: datetime
+        The last date
+    Returns
+    --------
+    A list of scene names (sensor, path, row and ``%Y%j`` date, e.g.
+    LC81930302015003), without the station and version, sorted by path/row
+    and date
+    """
+    sensors, paths, rows = np.broadcast_arrays(np.asarray(sensor),
+                                               np.asarray(paths, dtype=int),
+                                               np.asarray(rows, dtype=int))
+    index, dates = overpass_calendar(paths, sensors, start_date, end_date)
+    years, doys = year_doy(dates)
+    return ["%s%03d%03d%04d%03d" % scene for scene in
+            zip(sensors.ravel()[index].tolist(), paths.ravel()[index].tolist(),
+                rows.ravel()[index].tolist(), years.tolist(), doys.tolist())]
+
+
+def login(session, username, password):
+    """Log ``session`` in to EarthExplorer."""
+    check_response(session.post(LOGIN_URL, data={"username": username,
+                                                  "password": password}))
+    return session
+
+
+def scene_url(sensor, prod_name):
+    return "%s%s/%s/STANDARD/EE" % (BASE_URL, DATASETS[sensor], prod_name)
+
+
+def probe(session, url):
+    """Whether ``url`` is there, with a HEAD request (following redirects)
+    rather than starting a download. Busy servers are retried. Only a 404
+    (or 410) means that it isn't there: any other error (e.g. a 401 or 403
+    because the login failed or expired) is raised, so that it isn't taken
+    for an empty overpass."""
+    def head():
+        r = session.head(url, allow_redirects=True)
+        if r.status_code in ABSENT_STATUSES:
+            return False
+        check_response(r)
+        return True
+    return call_with_retries(head, url)
+
+
+def find_scene(session, sensor, scene, stations, executor):
+    """Probe all the product names (station and version) of a scene at the
+    same time with ``executor``.
+
+    Returns
+    --------
+    The first product name that is there, in the order of ``stations`` and
+    ``VERSIONS``, or ``None`` if all of them came back as not there. If any
+    probe failed, its error is raised.
+    """
+    prod_names = [scene + station + version for station in stations
+                  for version in VERSIONS]
+    found = executor.map(lambda prod_name: probe(
+        session, scene_url(sensor, prod_name)), prod_names)
+    for prod_name, there in zip(prod_names, list(found)):
+        if there:
+            return prod_name
+    return None
+
+
 def get_landsat_file ( sensor, path, row, start_date, end_date, out_dir, 
-                username, password ):
-    
-    authentication = { "username": username, "password": password }
-    with requests.Session() as s:
-        p = s.post( "https://ers.cr.usgs.gov/login", 
-                data=authentication )
-        this_date = start_date
-        while this_date <= end_date:
-            next_date = next_overpass ( this_date, int(path), sensor )
-            this_date = next_date + datetime.timedelta ( days=1 )
-            is_dload = False
-            if sensor == "LC8":
-                for station in [ 'LGN' ]:
-                    for version in [ "00", "01", "02" ]:
-                        prod_name = "%s%s%s%s%s%s" % ( sensor,path, row,
-                                        next_date.strftime("%Y%j"), 
-                                        station, version )
-                        the_url = "%s%s/%s/STANDARD/EE" % ( BASE_URL, 
-                            "4923", prod_name )
-                        print "Trying %s...." % the_url
-                        r = s.get ( the_url,stream=True )
-                        if r.ok:
-                            print "Downloading %s" % the_url
-                            fname_out = os.path.join ( out_dir, 
-                                                      prod_name + ".tar.gz"  )
-                            with open ( fname_out, 'wb') as fp:
-                                for block in r.iter_content(8192):
-                                    fp.write(block)
-                            is_dload = True
-                            print "Done!"
-                            break
-
-                    if is_dload is not True:
-                        break
+                username, password, catalogue=None, dry_run=False,
+                stations=STATIONS, session=None, empty=None,
+                n_probes=N_PROBES ):
+    """Download the scenes of a path/row between two dates. The product
+    names (one per station and version) of each overpass are probed at the
+    same time, and overpasses that turn out to have nothing are remembered
+    (see ``landsat_calendar.EmptyScenes``), so they are not probed again.
+    With ``dry_run``, nothing is downloaded, and the names of the scenes
+    that would be looked for are returned (see ``plan_overpasses``).
+
+    Parameters
+    ------------
+    stations: iter
+        The ground station codes to look for (e.g. LGN)
+    session: requests.Session
+        A session logged in to EarthExplorer (see ``login``). A new one is
+        made if not given.
+    empty: str or EmptyScenes
+        Where the empty overpasses are kept (see
+        ``landsat_calendar.get_empty_scenes``)
+    n_probes: int
+        Number of product names to probe at the same time
+    Returns
+    --------
+    A list of the files downloaded
+    """
+    if dry_run:
+        return plan_overpasses(sensor, int(path), int(row), start_date,
+                               end_date)
+    if sensor not in DATASETS:
+        LOG.warning("Can't download %s data (only %s)" %
+                    (sensor, ", ".join(DATASETS)))
+        return []
+    catalogue = get_catalogue(catalogue)
+    empty = get_empty_scenes(empty)
+    stations = list(stations)
+    scenes = plan_overpasses(sensor, int(path), int(row), start_date,
+                             end_date)
+    known = catalogue.known((scene + station + version + ".tar.gz"
+                             for scene in scenes for station in stations
+                             for version in VERSIONS), directory=out_dir)
+    known = set(prod_name[:16] for prod_name in known)
+    to_probe = {scene: list(stations) for scene in scenes
+                if scene not in known}
+    for station in stations:
+        for scene in empty.empty(to_probe, station):
+            to_probe[scene].remove(station)
+    LOG.info("%s%03d%03d: %d overpasses, %d already got, %d to look for" %
+             (sensor, int(path), int(row), len(scenes), len(known),
+              sum(1 for left in to_probe.values() if left)))
+
+    fnames = []
+    with contextlib.ExitStack() as stack:
+        if session is None:
+            session = stack.enter_context(new_session(pool_size=n_probes))
+            login(session, username, password)
+        executor = stack.enter_context(
+            futures.ThreadPoolExecutor(max_workers=n_probes))
+        for scene, scene_stations in to_probe.items():
+            if not scene_stations:
+                continue
+            prod_name = find_scene(session, sensor, scene, scene_stations,
+                                   executor)
+            if prod_name is None:
+                LOG.debug("Nothing for %s" % scene)
+                empty.add(scene, scene_stations)
+                continue
+            the_url = scene_url(sensor, prod_name)
+            LOG.info("Downloading %s" % the_url)
+            fname_out = os.path.join(out_dir, prod_name + ".tar.gz")
+            file_size = call_with_retries(lambda: fetch_resumable(
+                session.get, the_url, fname_out, chunk_size=65536,
+                durability="none"), the_url)
+            catalogue.add(prod_name + ".tar.gz", fname_out, "landsat",
+                          size=file_size)
+            fnames.append(fname_out)
+    return fnames
+
+
+def get_landsat_files(sensor, path_rows, start_date, end_date, out_dir,
+                      username, password, n_threads=4, catalogue=None,
+                      stations=STATIONS, empty=None, n_probes=N_PROBES):
+    """Download the scenes of lots of path/rows (a list of ``(path, row)``
+    tuples) between two dates, with each path/row as a job in a pool of
+    ``n_threads`` threads (see ``get_landsat_file``). All the jobs share a
+    single session, which only logs in once.
+
+    Returns
+    --------
+    A list of the files downloaded
+    """
+    catalogue = get_catalogue(catalogue)
+    fnames = []
+    with new_session(pool_size=n_threads * n_probes) as s:
+        login(s, username, password)
+        download = partial(get_landsat_file, start_date=start_date,
+                           end_date=end_date, out_dir=out_dir,
+                           username=username, password=password,
+                           catalogue=catalogue, stations=stations,
+                           session=s, empty=empty, n_probes=n_probes)
+        with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            jobs = {executor.submit(download, sensor, path, row): (path, row)
+                    for path, row in path_rows}
+            for job in futures.as_completed(jobs):
+                try:
+                    fnames.extend(job.result())
+                except Exception as err:
+                    LOG.error("Giving up on path %s row %s (%s)" %
+                              (jobs[job] + (err,)))
+    STATS.report()
+    return fnames
+
+
 if __name__ == "__main__":
     start_date = datetime.datetime(2015,1,1)
     end_date = datetime.datetime(2016,1,1)
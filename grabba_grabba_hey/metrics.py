@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Metrics for every file transferred: bytes, duration, throughput, time to
+first byte, how many times it had to be retried and how long it waited in
+the queue before a worker got to it. Each transfer is handed to the hooks
+added with ``add_hook``; ``JsonLinesLog`` writes them to a JSON-lines file
+and ``PrometheusFile`` keeps per-host totals in a Prometheus text file (as
+read by the node exporter's textfile collector), so that cron jobs can be
+monitored. With no hooks (the default) nothing is measured or recorded.
+
+Metrics can also be switched on without changing any code by setting the
+``GRABBA_METRICS_JSONL`` and/or ``GRABBA_METRICS_PROM`` environment
+variables to the files to write.
+"""
+import atexit
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+LOG = logging.getLogger(__name__)
+
+# How often (in seconds) the Prometheus file is rewritten
+PROMETHEUS_INTERVAL = 10.
+
+_hooks = []
+_hooks_lock = threading.Lock()
+_context = threading.local()
+
+Transfer = collections.namedtuple(
+    "Transfer", ["url", "host", "fname", "bytes", "duration", "throughput",
+                 "ttfb", "retries", "queue_wait", "error", "time"])
+Transfer.__doc__ = """A file transferred (or not, if ``error`` is set).
+Times are in seconds, and ``throughput`` in bytes per second."""
+
+
+def enabled():
+    """Whether there is anything listening to the metrics. Code that has to
+    do some work to measure things should check this first."""
+    return bool(_hooks)
+
+
+def add_hook(hook):
+    """Call ``hook`` with a ``Transfer`` for every file transferred. Hooks
+    are called from the thread doing the transfer, so they need to be
+    thread safe and quick. Returns the hook."""
+    with _hooks_lock:
+        _hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    """Stop calling ``hook``, closing it if it has a ``close`` method."""
+    with _hooks_lock:
+        if hook in _hooks:
+            _hooks.remove(hook)
+    if hasattr(hook, "close"):
+        hook.close()
+
+
+def set_context(**context):
+    """Set what the transfers made from this thread should report as the
+    number of ``retries`` and the time waited in the queue (``queue_wait``).
+    Used by the code that runs the downloads (see
+    ``retry.run_with_requeue``), which knows about these but not about the
+    transfer itself."""
+    _context.__dict__.update(context)
+
+
+def clear_context():
+    _context.__dict__.clear()
+
+
+def record(url, n_bytes, duration, ttfb=None, fname=None, error=None,
+           retries=None, queue_wait=None):
+    """Record a transfer, and pass it on to the hooks. Retries and queue
+    wait come from the thread's context (see ``set_context``) unless given.
+
+    Parameters
+    ------------
+    url: str
+        The URL
+    n_bytes: int
+        The number of bytes transferred
+    duration: float
+        The time (in seconds) from sending the request to getting the last
+        byte
+    ttfb: float
+        The time (in seconds) from sending the request to getting the
+        response headers
+    fname: str
+        Where the data went
+    error: Exception
+        What went wrong, if the transfer failed
+    """
+    if not _hooks:
+        return
+    if retries is None:
+        retries = getattr(_context, "retries", 0)
+    if queue_wait is None:
+        queue_wait = getattr(_context, "queue_wait", None)
+    transfer = Transfer(url=url, host=urlparse(url).netloc, fname=fname,
+                        bytes=n_bytes, duration=duration,
+                        throughput=n_bytes / duration if duration > 0 else None,
+                        ttfb=ttfb, retries=retries, queue_wait=queue_wait,
+                        error=None if error is None else str(error),
+                        time=time.time())
+    for hook in list(_hooks):
+        try:
+            hook(transfer)
+        except Exception as err:
+            LOG.warning("Metrics hook %r failed (%s)" % (hook, err))
+
+
+class JsonLinesLog(object):
+    """A hook that appends every transfer to a file, as a JSON object per
+    line."""
+    def __init__(self, fname):
+        self.fname = fname
+        self.fp = open(fname, "a", buffering=1)
+        self.lock = threading.Lock()
+
+    def __call__(self, transfer):
+        line = json.dumps(transfer._asdict())
+        with self.lock:
+            self.fp.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+class PrometheusFile(object):
+    """A hook that keeps totals per host, and writes them to a file in the
+    Prometheus text format every ``interval`` seconds (and when closed).
+    The file is replaced atomically, so it can be read at any time."""
+    # Buckets (in seconds) of the transfer duration histogram
+    buckets = (0.1, 0.5, 1., 5., 10., 60., 300., 1800.)
+    counters = (
+        ("transfers_total", "Files transferred"),
+        ("errors_total", "Transfers that failed"),
+        ("bytes_total", "Bytes transferred"),
+        ("retries_total", "Retries before the transfers"),
+        ("ttfb_seconds_total", "Time to first byte"),
+        ("queue_wait_seconds_total", "Time waited in the queue"))
+
+    def __init__(self, fname, interval=PROMETHEUS_INTERVAL,
+                 prefix="grabba"):
+        self.fname = fname
+        self.interval = interval
+        self.prefix = prefix
+        self.totals = collections.defaultdict(collections.Counter)
+        self.durations = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.written = 0.
+
+    def __call__(self, transfer):
+        with self.lock:
+            totals = self.totals[transfer.host]
+            totals["transfers_total"] += 1
+            totals["errors_total"] += transfer.error is not None
+            totals["bytes_total"] += transfer.bytes
+            totals["retries_total"] += transfer.retries
+            totals["ttfb_seconds_total"] += transfer.ttfb or 0.
+            totals["queue_wait_seconds_total"] += transfer.queue_wait or 0.
+            durations = self.durations[transfer.host]
+            durations["sum"] += transfer.duration
+            for bucket in self.buckets:
+                if transfer.duration <= bucket:
+                    durations[bucket] += 1
+            due = time.monotonic() - self.written > self.interval
+        if due:
+            self.write()
+
+    def text(self):
+        """The metrics, in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            for key, doc in self.counters:
+                name = "%s_%s" % (self.prefix, key)
+                lines.append("# HELP %s %s" % (name, doc))
+                lines.append("# TYPE %s counter" % name)
+                for host, totals in sorted(self.totals.items()):
+                    lines.append('%s{host="%s"} %s' %
+                                 (name, host, totals[key]))
+            name = "%s_transfer_duration_seconds" % self.prefix
+            lines.append("# HELP %s Time to transfer a file" % name)
+            lines.append("# TYPE %s histogram" % name)
+            for host, durations in sorted(self.durations.items()):
+                for bucket in self.buckets:
+                    lines.append('%s_bucket{host="%s",le="%g"} %d' %
+                                 (name, host, bucket, durations[bucket]))
+                count = self.totals[host]["transfers_total"]
+                lines.append('%s_bucket{host="%s",le="+Inf"} %d' %
+                             (name, host, count))
+                lines.append('%s_sum{host="%s"} %s' %
+                             (name, host, durations["sum"]))
+                lines.append('%s_count{host="%s"} %d' % (name, host, count))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        text = self.text()
+        self.written = time.monotonic()
+        dirname = os.path.dirname(os.path.abspath(self.fname))
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, self.fname)
+
+    def close(self):
+        self.write()
+
+
+def enable(jsonl=None, prometheus=None):
+    """Write metrics to a JSON-lines file and/or a Prometheus text file.
+    Returns the hooks added, which can be passed to ``remove_hook``."""
+    hooks = []
+    if jsonl is not None:
+        hooks.append(add_hook(JsonLinesLog(jsonl)))
+    if prometheus is not None:
+        hooks.append(add_hook(PrometheusFile(prometheus)))
+    return hooks
+
+
+def disable():
+    """Remove (and close) all the hooks."""
+    for hook in list(_hooks):
+        remove_hook(hook)
+
+
+if os.environ.get("GRABBA_METRICS_JSONL") or \
+        os.environ.get("GRABBA_METRICS_PROM"):
+    enable(jsonl=os.environ.get("GRABBA_METRICS_JSONL") or None,
+           prometheus=os.environ.get("GRABBA_METRICS_PROM") or None)
+    atexit.register(disable)
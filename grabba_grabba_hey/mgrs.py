@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Offline conversion of latitude/longitude to UTM and to Military Grid
+Reference System (MGRS) 100 km squares, which is how the Sentinel-2 tiles
+are named (e.g. 29TNJ). Everything works on NumPy arrays, so that lots of
+points can be converted in one go.
+
+Sentinel-2 tiles are 109.8 km wide. A tile covers its MGRS square plus 9.8
+km of the squares to the east and south, so points near the edge of a
+square (or of a UTM zone) fall in more than one tile.
+"""
+import numpy as np
+
+# WGS84
+A = 6378137.0
+F = 1 / 298.257223563
+E2 = F * (2 - F)
+EP2 = E2 / (1 - E2)
+K0 = 0.9996
+
+LAT_BANDS = np.array(list("CDEFGHJKLMNPQRSTUVWX"))
+COLUMN_LETTERS = np.array([list("ABCDEFGH"), list("JKLMNPQR"),
+                           list("STUVWXYZ")])
+ROW_LETTERS = np.array(list("ABCDEFGHJKLMNPQRSTUV"))
+
+SQUARE = 100000.
+S2_TILE_SIZE = 109800.
+S2_OVERLAP = S2_TILE_SIZE - SQUARE
+
+
+def utm_zone(lat, lon):
+    """The UTM zone of points, including the Norway and Svalbard exceptions.
+
+    Parameters
+    ------------
+    lat: array
+        Latitude in decimal degrees
+    lon: array
+        Longitude in decimal degrees
+    Returns
+    --------
+    An integer array of zones (1 to 60)
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lon = (lon + 180.) % 360. - 180.
+    zone = np.clip(np.floor((lon + 180.) / 6.).astype(int) + 1, 1, 60)
+    norway = (lat >= 56) & (lat < 64) & (lon >= 3) & (lon < 12)
+    zone = np.where(norway, 32, zone)
+    svalbard = (lat >= 72) & (lat < 84)
+    for lon0, lon1, svalbard_zone in [(0, 9, 31), (9, 21, 33),
+                                      (21, 33, 35), (33, 42, 37)]:
+        zone = np.where(svalbard & (lon >= lon0) & (lon < lon1),
+                        svalbard_zone, zone)
+    return zone
+
+
+def latlon_to_utm(lat, lon, zone=None):
+    """Project points to UTM. If ``zone`` isn't given, each point is
+    projected in its own zone (see ``utm_zone``), otherwise the points are
+    forced into ``zone`` (a scalar or an array).
+
+    Returns
+    --------
+    Easting, northing (both in m, with the false northing added in the
+    southern hemisphere) and the zone
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    if zone is None:
+        zone = utm_zone(lat, lon)
+    zone = np.asarray(zone) * np.ones_like(lat, dtype=int)
+    phi = np.radians(lat)
+    lon0 = (zone - 1) * 6. - 180. + 3.
+    dlon = (lon - lon0 + 180.) % 360. - 180.
+
+    sin_phi = np.sin(phi)
+    cos_phi = np.cos(phi)
+    n = A / np.sqrt(1 - E2 * sin_phi ** 2)
+    t = np.tan(phi) ** 2
+    c = EP2 * cos_phi ** 2
+    a = cos_phi * np.radians(dlon)
+    e4 = E2 * E2
+    e6 = e4 * E2
+    m = A * ((1 - E2 / 4 - 3 * e4 / 64 - 5 * e6 / 256) * phi -
+             (3 * E2 / 8 + 3 * e4 / 32 + 45 * e6 / 1024) * np.sin(2 * phi) +
+             (15 * e4 / 256 + 45 * e6 / 1024) * np.sin(4 * phi) -
+             (35 * e6 / 3072) * np.sin(6 * phi))
+
+    easting = K0 * n * (a + (1 - t + c) * a ** 3 / 6 +
+                        (5 - 18 * t + t ** 2 + 72 * c - 58 * EP2) *
+                        a ** 5 / 120) + 500000.
+    northing = K0 * (m + n * np.tan(phi) *
+                     (a ** 2 / 2 + (5 - t + 9 * c + 4 * c ** 2) * a ** 4 / 24 +
+                      (61 - 58 * t + t ** 2 + 600 * c - 330 * EP2) *
+                      a ** 6 / 720))
+    northing = np.where(lat < 0, northing + 10000000., northing)
+    return easting, northing, zone
+
+
+def _lat_band(lat):
+    return np.clip(np.floor((np.asarray(lat) + 80.) / 8.).astype(int), 0, 19)
+
+
+def _square_key(zone, band, easting, northing):
+    """Integer key of the 100 km squares with SW corner at ``easting,
+    northing``. Keys are turned into names with ``_key_names``."""
+    col = np.clip(np.floor(easting / SQUARE).astype(int) - 1, 0, 7)
+    row = (np.floor(northing / SQUARE).astype(int) +
+           np.where(zone % 2 == 0, 5, 0)) % 20
+    return ((zone * 20 + band) * 8 + col) * 20 + row
+
+
+def _key_names(keys):
+    """Names (e.g. 29TNJ) of square keys, as an array like ``keys``. Only
+    the unique keys are formatted, as there are usually lots of repeats."""
+    unique_keys, idx = np.unique(keys, return_inverse=True)
+    row = unique_keys % 20
+    col = unique_keys // 20 % 8
+    band = unique_keys // 160 % 20
+    zone = unique_keys // 3200
+    names = np.array(["%02d%s%s%s" % (z, LAT_BANDS[b],
+                                      COLUMN_LETTERS[(z - 1) % 3, c],
+                                      ROW_LETTERS[r])
+                      for z, b, c, r in zip(zone, band, col, row)])
+    return names[idx].reshape(np.shape(keys))
+
+
+def latlon_to_mgrs(lat, lon):
+    """Get the MGRS 100 km square (e.g. 29TNJ) where each point lies. This
+    is the name of the main Sentinel-2 tile for each point.
+
+    Parameters
+    ------------
+    lat: array
+        Latitude in decimal degrees
+    lon: array
+        Longitude in decimal degrees
+    Returns
+    --------
+    An array of strings
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+    easting, northing, zone = latlon_to_utm(lat, lon)
+    return _key_names(_square_key(zone, _lat_band(lat), easting, northing))
+
+
+def latlon_to_s2_tiles(lat, lon):
+    """Get all the Sentinel-2 tiles that contain each point. Tiles overlap
+    by 9.8 km within a UTM zone, and also extend past the edges of the zone,
+    so points close to edges can be in up to four or so tiles. Tiles over a
+    neighbouring zone are only considered if their 100 km square reaches
+    into that zone, which is how the Sentinel-2 tiling grid is laid out.
+
+    Parameters
+    ------------
+    lat: array
+        Latitude in decimal degrees
+    lon: array
+        Longitude in decimal degrees
+    Returns
+    --------
+    A list with a sorted list of tile names per point, with the main tile
+    (see ``latlon_to_mgrs``) first.
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+    band = _lat_band(lat)
+    home_zone = utm_zone(lat, lon)
+    keys = []
+    for dzone in [0, -1, 1]:
+        zone = (home_zone + dzone - 1) % 60 + 1
+        easting, northing, zone = latlon_to_utm(lat, lon, zone=zone)
+        # Edges of the zone at the latitude of each point
+        west, _, _ = latlon_to_utm(lat, (zone - 1) * 6. - 180., zone=zone)
+        east, _, _ = latlon_to_utm(lat, zone * 6. - 180., zone=zone)
+        if dzone == 0:
+            # The Norway and Svalbard zones are wider than 6 degrees
+            west = np.minimum(west, easting)
+            east = np.maximum(east, easting)
+        x0 = np.floor(easting / SQUARE) * SQUARE
+        y0 = np.floor(northing / SQUARE) * SQUARE
+        near_west = easting - x0 < S2_OVERLAP
+        near_north = northing - y0 >= SQUARE - S2_OVERLAP
+        for dx, dy, inside in [(0, 0, True), (-1, 0, near_west),
+                               (0, 1, near_north),
+                               (-1, 1, near_west & near_north)]:
+            tile_x0 = x0 + dx * SQUARE
+            tile_y0 = y0 + dy * SQUARE
+            valid = inside & (tile_x0 <= east) & (tile_x0 + SQUARE >= west)
+            keys.append(np.where(valid, _square_key(zone, band, tile_x0,
+                                                    tile_y0), -1))
+    # The first candidate is the main tile in the zone of the point, and
+    # most points are only in that one
+    keys = np.array(keys).T
+    names = _key_names(np.maximum(keys, 0))
+    tiles = [[name] for name in names[:, 0].tolist()]
+    for i in np.flatnonzero((keys[:, 1:] >= 0).any(axis=1)):
+        others = set(names[i, 1:][keys[i, 1:] >= 0].tolist())
+        others.discard(tiles[i][0])
+        tiles[i].extend(sorted(others))
+    return tiles
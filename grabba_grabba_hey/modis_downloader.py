@@ -4,19 +4,35 @@ Refactoring the MODIS downloading tool. The code is now simpler and
 has been implemented to have concurrent downloads. The cost of this is the
 addition of the ``concurrent`` and ``requests`` packages as dependencies.
 """
+import collections
 from functools import partial
+import itertools
+import multiprocessing
 import os
 import datetime
-import time
+import queue
+import threading
+import xml.etree.ElementTree as ET
 
-import requests
 from concurrent import futures
 
+from .cache import cached_get
+from .catalogue import get_catalogue
+from .modis_index import DATE_FORMAT, get_date_index, get_granule_index
+from .retry import (STATS, RetryableError, call_with_retries, check_response,
+                    run_with_requeue)
+from .sessions import AuthSession, learn_redirects, moved_url, new_session
+from .transfer import Cksum, checksum_file, fetch_resumable
+
 import logging
 logging.basicConfig(level=logging.INFO)
 
 LOG = logging.getLogger(__name__)
 BASE_URL = "http://e4ftl01.cr.usgs.gov/"
+# The Earthdata login, which the archive sends us to for the granules
+EARTHDATA_HOSTS = ("urs.earthdata.nasa.gov",)
+# Granules found by the listing that can be waiting to be downloaded
+QUEUE_SIZE = 100
 
 class WebError (RuntimeError):
     """An exception for web issues"""
@@ -24,97 +40,303 @@ class WebError (RuntimeError):
         self.args = arg
 
 
-def get_available_dates(url, start_date, end_date=None):
+def get_available_dates(url, start_date, end_date=None, index=None):
     """
     This function gets the available dates for a particular
     product, and returns the ones that fall within a particular
     pair of dates. If the end date is set to ``None``, it will
     be assumed it is today.
+
+    The dates are kept in a date index (see ``modis_index.get_date_index``),
+    so the archive is only asked about the product if ``end_date`` is after
+    the last date seen, and then only the new dates are added.
     """
     if end_date is None:
         end_date = datetime.datetime.now()
-    r = requests.get(url)
-    if not r.ok:
-        raise WebError(
-            "Problem contacting NASA server. Either server " +
-            "is down, or the product you used (%s) is kanckered" %
-            url)
-    html = r.text
-    avail_dates = []
-    for line in html.splitlines()[19:]:
-        if line.find("[DIR]") >= 0 and line.find("href") >= 0:
-            this_date = line.split("href=")[1].split('"')[1].strip("/")
-            this_datetime = datetime.datetime.strptime(this_date,
-                                                       "%Y.%m.%d")
-            if this_datetime >= start_date and this_datetime <= end_date:
-                avail_dates.append(url + "/" + this_date)
-    return avail_dates
-
-
-def download_granule_list(url, tiles):
+    index = get_date_index(index)
+    last_date = index.last_date(url)
+    if last_date is None or end_date.strftime(DATE_FORMAT) > last_date:
+        try:
+            r = call_with_retries(lambda: check_response(cached_get(url)),
+                                  url)
+        except IOError:
+            raise WebError(
+                "Problem contacting NASA server. Either server " +
+                "is down, or the product you used (%s) is kanckered" %
+                url)
+        n_new = index.update(url, r.text)
+        LOG.debug("%d new dates for %s" % (n_new, url))
+    return [url + "/" + the_date
+            for the_date in index.dates(url, start_date, end_date)]
+
+
+def download_granule_list(url, tiles, index=None):
     """For a particular product and date, obtain the data granule URLs.
 
+    The granules of each date are kept in a granule index (see
+    ``modis_index.get_granule_index``), so the date directory is only
+    listed if it hasn't been before (or granules may still have been
+    turning up when it was).
     """
     if not isinstance(tiles, type([])):
         tiles = [tiles]
-    while True:
-        try:
-            r = requests.get(url )
-            break
-        except requests.execeptions.ConnectionError:
-            time.sleep ( 240 )
-            
-    grab = []
-    for line in r.text.splitlines():
-        for tile in tiles:
-            if line.find ( tile ) >= 0 and line.find (".xml" ) < 0 \
-                    and line.find("BROWSE") < 0:
-                fname = line.split("href=")[1].split('"')[1]
-                grab.append(url + "/" + fname)
-    return grab
-
-
-def download_granules(url, session, username, password, output_dir):
-
-    r1 = session.request('get', url)
-    r = session.get(r1.url, stream=True)
+    index = get_granule_index(index)
+    if index.unlisted([url]):
+        r = call_with_retries(lambda: check_response(cached_get(url)), url)
+        index.add_listing(url, r.text)
+    return [granule.url for granule in index.granules(url, tiles)]
+
+
+def _getter(session):
+    """Something to make the requests for granules with, like ``get``."""
+    if isinstance(session, AuthSession):
+        return session.login_get
+
+    def get(url, **kwargs):
+        r = session.get(moved_url(url), **kwargs)
+        learn_redirects(r)
+        return r
+    return get
+
+
+def parse_sidecar(xml, fname):
+    """Get the size and checksum (as given by ``cksum``) of the granule
+    ``fname`` from its XML metadata file. Either can be ``None`` if it
+    isn't there."""
+    size, checksum = None, None
+    for container in ET.fromstring(xml).iter("DataFileContainer"):
+        if container.findtext("DistributedFileName") != fname:
+            continue
+        size = container.findtext("FileSize")
+        size = None if size is None else int(size)
+        if container.findtext("ChecksumType", "").upper() == "CKSUM":
+            checksum = container.findtext("Checksum")
+    return size, checksum
+
+
+def get_sidecar(get, url):
+    """The size and checksum of a granule, from the XML metadata file next
+    to it in the archive (see ``parse_sidecar``)."""
+    r = check_response(get(url + ".xml"))
+    return parse_sidecar(r.content, url.split("/")[-1])
+
+
+def download_granules(url, session, username, password, output_dir,
+                      catalogue=None):
+    """Download a granule with ``session``, which should have the Earthdata
+    credentials (see ``get_modis_data``). The redirects through the login
+    are followed in the one streamed request, and if the session is an
+    ``AuthSession``, only the first request to the archive logs in.
+
+    The granule goes to a ``.partial`` file first, and what's there from an
+    earlier attempt is kept, with only the rest of the file downloaded
+    (see ``transfer.fetch_resumable``). A file that is already in
+    ``output_dir`` but not in the catalogue is treated in the same way.
+    When part of the file was there already, the whole file is checked
+    against the size and checksum in the XML metadata of the granule, and
+    if they don't match the granule is downloaded again from scratch.
+    """
     fname = url.split("/")[-1]
-    LOG.debug("Getting %s from %s(-> %s)" % (fname, url, r1.url))
-    if not r.ok:
-        raise IOError("Can't start download... [%s]" % fname)
-    file_size = int(r.headers['content-length'])
-    LOG.debug("\t%s file size: %d" % (fname, file_size))
     output_fname = os.path.join(output_dir, fname)
-    # Save with temporary filename...
-    with open(output_fname+".partial", 'wb') as fp:
-        for block in r.iter_content(65536):
-            fp.write(block)
-    # Rename to definitive filename
-    os.rename(output_fname+".partial", output_fname)
+    part = output_fname + ".partial"
+    if os.path.exists(output_fname) and not os.path.exists(part):
+        # We don't know whether it's all there
+        os.replace(output_fname, part)
+    resumed = os.path.exists(part)
+    get = _getter(session)
+    hasher = Cksum()
+    file_size = fetch_resumable(get, url, output_fname, hasher=hasher,
+                                chunk_size=65536, durability="none")
+    checksum = hasher.hexdigest()
+    if resumed:
+        try:
+            size, expected = get_sidecar(get, url)
+        except RetryableError:
+            raise
+        except (IOError, ET.ParseError) as err:
+            LOG.info("Can't check %s (%s)" % (fname, err))
+            size, expected = None, None
+        if (size is not None and size != file_size) or \
+                (expected is not None and expected != checksum):
+            os.remove(output_fname)
+            raise RetryableError("%s doesn't match its metadata" % fname)
+    get_catalogue(catalogue).add(fname, output_fname, "modis",
+                                 size=file_size, checksum=checksum)
     LOG.info("Done with %s" % output_fname)
     return output_fname
 
-def required_files (url_list, output_dir):
-    """Checks for files that are already available in the system."""
-    
-    all_files_present = os.listdir (output_dir)
-    hdf_files_present = [fich 
-                        for fich in all_files_present if fich.endswith(".hdf")]
-    hdf_files_present = set(hdf_files_present)
-    
-    flist= [url.split("/")[-1] for url in url_list]
-    file_list = dict(list(zip(flist, url_list)))
 
-    flist = set(flist)
-    files_to_download = list(flist.difference(hdf_files_present))
-    to_download = [ file_list[k] for k in files_to_download]
+def required_files (url_list, output_dir, catalogue=None):
+    """Checks for files that are already available in the system. Files in
+    the catalogue of acquired data (saved in ``output_dir``) are taken out
+    straight away. Files that
+    are in ``output_dir`` but not in the catalogue are not trusted to be
+    complete, so they are still returned: they can be checked with
+    ``verify_granules``, and downloading them only gets what's missing."""
+    catalogue = get_catalogue(catalogue)
+    flist= [url.split("/")[-1] for url in url_list]
+    known = catalogue.known(flist, directory=output_dir)
+    to_download = [url for fname, url in zip(flist, url_list)
+                   if fname not in known]
     return to_download
-    
-    
+
+
+def verify_granules(urls, output_dir, session, n_procs=None,
+                    catalogue=None):
+    """Check granules already in ``output_dir`` (e.g. from an older archive,
+    or a job that was killed) against the size and checksum in their XML
+    metadata. The metadata files are downloaded with ``n_procs`` threads,
+    and the checksums calculated by ``n_procs`` processes (the number of
+    CPUs by default), so that large archives can be checked quickly.
+
+    Good granules are added to the catalogue. Granules that are too small
+    are renamed to ``.partial``, so that only the rest of the file is
+    downloaded (see ``download_granules``), and bad ones are removed.
+
+    Returns
+    --------
+    A generator of ``(url, ok)`` tuples, as granules are checked.
+    """
+    catalogue = get_catalogue(catalogue)
+    get = _getter(session)
+    n_procs = n_procs or os.cpu_count()
+    # Forking a process with threads running isn't safe
+    context = multiprocessing.get_context("spawn")
+    with futures.ProcessPoolExecutor(max_workers=n_procs,
+                                     mp_context=context) as procs, \
+            futures.ThreadPoolExecutor(max_workers=n_procs) as threads:
+
+        def check(url):
+            fname = url.split("/")[-1]
+            output_fname = os.path.join(output_dir, fname)
+            try:
+                size, checksum = get_sidecar(get, url)
+            except (IOError, ET.ParseError) as err:
+                LOG.info("Can't check %s (%s)" % (fname, err))
+                return False
+            actual = os.path.getsize(output_fname)
+            if size is not None and actual < size:
+                LOG.info("%s is incomplete" % fname)
+                os.replace(output_fname, output_fname + ".partial")
+                return False
+            if checksum is None:
+                # Downloading it will at least check the size
+                return False
+            if (size is not None and actual > size) or \
+                    procs.submit(checksum_file, output_fname,
+                                 Cksum).result() != checksum:
+                LOG.info("%s is bad, removing it" % fname)
+                os.remove(output_fname)
+                return False
+            catalogue.add(fname, output_fname, "modis", size=actual,
+                          checksum=checksum)
+            return True
+
+        jobs = {threads.submit(check, url): url for url in urls}
+        for future in futures.as_completed(jobs):
+            yield jobs[future], future.result()
+
+
+def list_granules(the_dates, tiles, output_dir, n_threads=5,
+                  catalogue=None, ordered=True, queue_size=QUEUE_SIZE,
+                  session=None):
+    """List the granules of ``tiles`` in the date directories
+    ``the_dates`` (see ``download_granule_list``) in the background, with
+    ``n_threads`` threads, leaving out the ones we already have (see
+    ``required_files``). Granules that are in ``output_dir`` but not in the
+    catalogue are checked with ``verify_granules`` once the listing is
+    done, and only handed out if they are bad or incomplete.
+
+    Parameters
+    ------------
+    session: requests.Session
+        The session to get the metadata of granules to check with. If
+        ``None``, granules in ``output_dir`` are handed out without
+        checking them (``download_granules`` resumes them).
+    ordered: bool
+        Whether to hand out the granules in the order of ``the_dates``, or
+        as soon as the listing of their date comes in
+    queue_size: int
+        How many granules can be waiting to be taken. Listing stops when
+        the queue is full, until granules are taken.
+    Returns
+    --------
+    A generator of the granule URLs. If listing (or checking the granules
+    already there) fails, the error is raised by the generator.
+    """
+    catalogue = get_catalogue(catalogue)
+    found = queue.Queue(maxsize=queue_size)
+
+    def lister():
+        try:
+            _list(found)
+        except Exception as err:
+            # Raised again by the generator, for whoever is downloading
+            found.put(err)
+        finally:
+            found.put(None)
+
+    def _list(found):
+        n_found = 0
+        existing = []
+        dates = iter(the_dates)
+        with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+            # Only ``n_threads`` listings are done ahead of time, so that
+            # listing doesn't get ahead of a full queue
+            pending = collections.deque(
+                (executor.submit(download_granule_list, the_date, tiles),
+                 the_date)
+                for the_date in itertools.islice(dates, n_threads))
+            while pending:
+                if ordered:
+                    future, the_date = pending.popleft()
+                    futures.wait([future])
+                else:
+                    done, _ = futures.wait(
+                        [future for future, the_date in pending],
+                        return_when=futures.FIRST_COMPLETED)
+                    future, the_date = next(job for job in pending
+                                            if job[0] in done)
+                    pending.remove((future, the_date))
+                for the_date in itertools.islice(dates, 1):
+                    pending.append((executor.submit(
+                        download_granule_list, the_date, tiles), the_date))
+                granules = future.result()
+                for granule in sorted(required_files(
+                        granules, output_dir, catalogue=catalogue)):
+                    if session is not None and os.path.exists(os.path.join(
+                            output_dir, granule.split("/")[-1])):
+                        existing.append(granule)
+                        continue
+                    found.put(granule)
+                    n_found += 1
+        if existing:
+            LOG.info("Checking %d files already there" % len(existing))
+            for granule, ok in verify_granules(existing, output_dir, session,
+                                               catalogue=catalogue):
+                if not ok:
+                    found.put(granule)
+                    n_found += 1
+        LOG.info("Found %d files to download" % n_found)
+
+    thread = threading.Thread(target=lister, daemon=True)
+    thread.start()
+    while True:
+        granule = found.get()
+        if granule is None:
+            break
+        if isinstance(granule, Exception):
+            thread.join()
+            raise granule
+        yield granule
+    thread.join()
+
+
 
 def get_modis_data(username, password, platform, product, tiles, 
                    output_dir, start_date,
-                   end_date=None, n_threads=5):
+                   end_date=None, n_threads=5, catalogue=None, ordered=True,
+                   queue_size=QUEUE_SIZE):
     """The main workhorse of MODIS downloading. This function will grab
     products for a particular platform (MOLT, MOLA or MOTA). The products
     are specified by their MODIS code (e.g. MCD45A1.051 or MOD09GA.006).
@@ -146,7 +368,18 @@ def get_modis_data(username, password, platform, product, tiles,
     n_threads: int
         The number of concurrent downloads to envisage. I haven't got a clue
         as to what a good number would be here...
+    catalogue: str or Catalogue
+        The catalogue of acquired data (see ``catalogue.get_catalogue``).
+        Files in it are not downloaded again.
+    ordered: bool
+        Whether to download the granules in date order, or as soon as they
+        are found
+    queue_size: int
+        How many granules the listing can get ahead of the downloads
 
+    Date directories are listed at the same time as granules are
+    downloaded: granules go into a queue as soon as they are found (see
+    ``list_granules``), and are taken from there by the download threads.
     """
     # Ensure the platform is OK
     assert platform.upper() in [ "MOLA", "MOLT", "MOTA"], \
@@ -161,38 +394,30 @@ def get_modis_data(username, password, platform, product, tiles,
     the_dates = get_available_dates(url, start_date, end_date=end_date)
     
     # We then explore the NASA archive for the dates that we are going to
-    # download. This is done in parallel. For each date, we will get the
-    # url for each of the tiles that are required.
-    the_granules = []
-    download_granule_patch = partial(download_granule_list, tiles=tiles)
-    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-        for granules in executor.map(download_granule_patch, the_dates):
-            the_granules.append(granules)
-    # Flatten the list of lists...
-    gr = [g for granule in the_granules for g in granule]
-    gr.sort()
-    # Check whether we have some files available already
-    gr_to_dload = required_files(gr, output_dir)
-    gr = gr_to_dload
-    
-    LOG.info( "Will download %d files" % len ( gr ))
-    # Wait for a few minutes before downloading the data
-    time.sleep ( 60 )
+    # download, in the background. For each date, we will get the url for
+    # each of the tiles that are required, and they are downloaded as soon
+    # as they are found.
+    catalogue = get_catalogue(catalogue)
     # The main download loop. This will get all the URLs with the filenames,
     # and start downloading them in parallel.
     dload_files = []
-    with requests.Session() as s:
-        s.auth = (username, password)
+    with new_session(pool_size=n_threads, auth=(username, password),
+                     auth_hosts=EARTHDATA_HOSTS) as s:
+        gr = list_granules(the_dates, tiles, output_dir, n_threads=n_threads,
+                           catalogue=catalogue, ordered=ordered,
+                           queue_size=queue_size, session=s)
         download_granule_patch = partial(download_granules,
                                      session=s,
                                      output_dir=output_dir,
                                      username=username,
-                                     password=password )
+                                     password=password,
+                                     catalogue=catalogue)
         
-        with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-            for fich in executor.map(download_granule_patch, gr):
+        for url, fich, err in run_with_requeue(download_granule_patch, gr,
+                                               n_threads=n_threads):
+            if err is None:
                 dload_files.append(fich)
-        
+    STATS.report()
     return dload_files
 
     
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Making sense of the directory listings of the MODIS archive (plain Apache
+"Index of" pages), and an index of the dates available for each product.
+A product directory of a daily product has thousands of date directories,
+so rather than going through all of them every time, the dates seen are
+kept in an SQLite database in the cache directory. Dates are only ever
+added to the archive, so later runs only need to look at the dates after
+the last one seen, and finding the dates in a range is an indexed lookup.
+
+In the same way, the granules in each date directory are kept in a
+``GranuleIndex``, by tile, so that working out which granules to get for
+lots of tiles and dates doesn't need any listings we've already seen.
+"""
+import datetime
+import re
+import threading
+import time
+from collections import namedtuple
+from html.parser import HTMLParser
+
+from .cache import open_db
+
+DATE_INDEX = "modis_dates.sqlite"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dates (
+    product_url TEXT NOT NULL,
+    date TEXT NOT NULL,
+    PRIMARY KEY (product_url, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS products (
+    product_url TEXT PRIMARY KEY,
+    last_date TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+GRANULE_INDEX = "modis_granules.sqlite"
+GRANULE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS granules (
+    product_url TEXT NOT NULL,
+    date TEXT NOT NULL,
+    tile TEXT NOT NULL,
+    fname TEXT NOT NULL,
+    size INTEGER,
+    xml TEXT,
+    PRIMARY KEY (product_url, date, tile, fname)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS listings (
+    product_url TEXT NOT NULL,
+    date TEXT NOT NULL,
+    listed REAL NOT NULL,
+    PRIMARY KEY (product_url, date)
+) WITHOUT ROWID;
+"""
+# Date directories are called e.g. 2017.01.31, which sort as dates do
+DATE_FORMAT = "%Y.%m.%d"
+DATE_DIR = re.compile(r"^\d{4}\.\d{2}\.\d{2}$")
+TILE = re.compile(r"\.(h\d{2}v\d{2})\.")
+# Sizes in listings are either in bytes or rounded (e.g. 5.2M)
+SIZE = re.compile(r"^(\d+(?:\.\d+)?)([KMGT]?)$")
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3,
+              "T": 1024 ** 4}
+# Granules keep turning up in a date directory for a few days, after which
+# a listing of it is final
+SETTLE_DAYS = 7
+
+Granule = namedtuple("Granule", ["url", "tile", "size", "xml_url"])
+
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+class _ListingParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.hrefs = []
+        self.texts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            for name, value in attrs:
+                if name == "href" and value:
+                    self.hrefs.append(value)
+                    self.texts.append([])
+
+    def handle_data(self, data):
+        # The text after a link (up to the next one) has the date and size
+        if self.texts:
+            self.texts[-1].append(data)
+
+
+def _parse_size(text):
+    for token in reversed(text.split()):
+        match = SIZE.match(token)
+        if match:
+            return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+    return None
+
+
+def parse_listing(html, sizes=False):
+    """Get the entries of a directory listing. Links that aren't entries of
+    the directory (the parent directory, sorting links, links to other
+    sites) are left out.
+
+    Parameters
+    ------------
+    html: str
+        The HTML of the listing
+    sizes: bool
+        Whether to get the sizes of the files too
+    Returns
+    --------
+    A list with the names of the directories (without the trailing
+    slash), and a list with the names of the files, in the order they
+    appear in the listing. With ``sizes``, the files are ``(name, size)``
+    tuples, with the size in bytes (only approximate if the listing rounds
+    it, and ``None`` if it isn't there).
+    """
+    parser = _ListingParser()
+    parser.feed(html)
+    parser.close()
+    dirs = []
+    files = []
+    for href, text in zip(parser.hrefs, parser.texts):
+        if href.startswith(("?", "/", "#", "..")) or "://" in href:
+            continue
+        if href.endswith("/"):
+            dirs.append(href.rstrip("/"))
+        elif sizes:
+            # The first bit of text is the name of the link
+            files.append((href, _parse_size(" ".join(text[1:]))))
+        else:
+            files.append(href)
+    return dirs, files
+
+
+class DateIndex(object):
+    """The dates (as ``YYYY.MM.DD`` strings) available for each product,
+    identified by the URL of its directory. Can be shared by several
+    threads."""
+    def __init__(self, fname=None):
+        self.fname = fname or DATE_INDEX
+        self.db = open_db(self.fname, SCHEMA)
+        self.lock = threading.Lock()
+
+    def last_date(self, product_url):
+        """The last date seen for a product, or ``None``."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT last_date FROM products WHERE product_url = ?",
+                (product_url,)).fetchone()
+        return None if row is None else row[0]
+
+    def update(self, product_url, html):
+        """Add the dates in the listing of a product directory that are
+        after the last date seen.
+
+        Returns
+        --------
+        The number of dates added
+        """
+        last_date = self.last_date(product_url)
+        if last_date is not None:
+            # The listing is sorted by name, so everything up to the last
+            # date we know about is old news
+            start = html.find('href="%s/"' % last_date)
+            if start >= 0:
+                html = html[start:]
+        dirs, _ = parse_listing(html)
+        new_dates = sorted(the_date for the_date in dirs
+                           if DATE_DIR.match(the_date) and
+                           (last_date is None or the_date > last_date))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO dates VALUES (?, ?)",
+                                ((product_url, the_date)
+                                 for the_date in new_dates))
+            if new_dates:
+                last_date = new_dates[-1]
+            if last_date is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO products VALUES (?, ?, ?)",
+                    (product_url, last_date, time.time()))
+        return len(new_dates)
+
+    def dates(self, product_url, start_date, end_date):
+        """The dates of a product between ``start_date`` and ``end_date``
+        (both included, either ``datetime`` objects or ``YYYY.MM.DD``
+        strings), in order."""
+        if not isinstance(start_date, str):
+            start_date = start_date.strftime(DATE_FORMAT)
+        if not isinstance(end_date, str):
+            end_date = end_date.strftime(DATE_FORMAT)
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT date FROM dates WHERE product_url = ? AND " +
+                "date BETWEEN ? AND ? ORDER BY date",
+                (product_url, start_date, end_date)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def get_date_index(index=None):
+    """Get a date index. ``index`` can be a ``DateIndex`` (which is returned
+    as is), or the file name of one, which is opened only once per process.
+    By default, ``DATE_INDEX`` in the cache directory."""
+    if isinstance(index, DateIndex):
+        return index
+    fname = index or DATE_INDEX
+    with _indices_lock:
+        if (DateIndex, fname) not in _indices:
+            _indices[(DateIndex, fname)] = DateIndex(fname)
+        return _indices[(DateIndex, fname)]
+
+
+class GranuleIndex(object):
+    """The granules in the date directories of each product, by tile, with
+    their size and the URL of their XML metadata file. Can be shared by
+    several threads."""
+    def __init__(self, fname=None):
+        self.fname = fname or GRANULE_INDEX
+        self.db = open_db(self.fname, GRANULE_SCHEMA)
+        self.lock = threading.Lock()
+
+    def unlisted(self, date_urls):
+        """Which of the date directories (given by their URLs) have to be
+        listed, because they haven't been yet or because granules might
+        still have been turning up when they were."""
+        date_urls = list(date_urls)
+        by_product = {}
+        for url in date_urls:
+            product_url, the_date = url.rstrip("/").rsplit("/", 1)
+            by_product.setdefault(product_url, []).append(the_date)
+        settle = datetime.timedelta(days=SETTLE_DAYS)
+        utc = datetime.timezone.utc
+        final = set()
+        with self.lock:
+            for product_url, dates in by_product.items():
+                for i in range(0, len(dates), 500):
+                    some_dates = dates[i:i + 500]
+                    rows = self.db.execute(
+                        "SELECT date, listed FROM listings WHERE " +
+                        "product_url = ? AND date IN (%s)" %
+                        ", ".join("?" * len(some_dates)),
+                        [product_url] + some_dates)
+                    for the_date, listed in rows:
+                        listed = datetime.datetime.fromtimestamp(listed, utc)
+                        if listed - datetime.datetime.strptime(
+                                the_date, DATE_FORMAT).replace(
+                                    tzinfo=utc) > settle:
+                            final.add(product_url + "/" + the_date)
+        return [url for url in date_urls
+                if url.rstrip("/") not in final]
+
+    def add_listing(self, date_url, html):
+        """Add (or replace) the granules in the listing of a date directory.
+
+        Returns
+        --------
+        The number of granules
+        """
+        product_url, the_date = date_url.rstrip("/").rsplit("/", 1)
+        _, files = parse_listing(html, sizes=True)
+        names = set(fname for fname, size in files)
+        rows = []
+        for fname, size in files:
+            match = TILE.search(fname)
+            if match is None or fname.endswith(".xml") or \
+                    fname.startswith("BROWSE"):
+                continue
+            xml = fname + ".xml" if fname + ".xml" in names else None
+            rows.append((product_url, the_date, match.group(1), fname, size,
+                         xml))
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM granules WHERE product_url = ? " +
+                            "AND date = ?", (product_url, the_date))
+            self.db.executemany(
+                "INSERT INTO granules VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO listings VALUES " +
+                            "(?, ?, ?)", (product_url, the_date, time.time()))
+        return len(rows)
+
+    def granules(self, date_url, tiles):
+        """The granules of some ``tiles`` in a date directory.
+
+        Returns
+        --------
+        A list of ``Granule`` tuples, sorted by file name
+        """
+        product_url, the_date = date_url.rstrip("/").rsplit("/", 1)
+        tiles = list(tiles)
+        granules = []
+        with self.lock:
+            for i in range(0, len(tiles), 500):
+                some_tiles = tiles[i:i + 500]
+                rows = self.db.execute(
+                    "SELECT tile, fname, size, xml FROM granules WHERE " +
+                    "product_url = ? AND date = ? AND tile IN (%s)" %
+                    ", ".join("?" * len(some_tiles)),
+                    [product_url, the_date] + some_tiles)
+                for tile, fname, size, xml in rows:
+                    granules.append(Granule(
+                        url="%s/%s/%s" % (product_url, the_date, fname),
+                        tile=tile, size=size,
+                        xml_url=xml and "%s/%s/%s" % (product_url, the_date,
+                                                      xml)))
+        return sorted(granules, key=lambda granule: granule.url)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def get_granule_index(index=None):
+    """Get a granule index. ``index`` can be a ``GranuleIndex`` (which is
+    returned as is), or the file name of one, which is opened only once per
+    process. By default, ``GRANULE_INDEX`` in the cache directory."""
+    if isinstance(index, GranuleIndex):
+        return index
+    fname = index or GRANULE_INDEX
+    with _indices_lock:
+        if (GranuleIndex, fname) not in _indices:
+            _indices[(GranuleIndex, fname)] = GranuleIndex(fname)
+        return _indices[(GranuleIndex, fname)]
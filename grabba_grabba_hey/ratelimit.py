@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Bandwidth and request rate limits, shared by all the threads (and all the
+downloaders) in a process. Limits are token buckets for bytes per second
+and requests per second, for a given host or for everything (e.g. to leave
+some of a shared uplink for everyone else). By default there are no
+limits, and limits can be changed at any time, also while downloading:
+
+    set_limit("e4ftl01.cr.usgs.gov", requests_per_second=10)
+    set_limit(bytes_per_second=50e6)   # For all the hosts together
+
+Requests are throttled by the sessions (see ``sessions.py``), and bytes by
+the download loops, through a ``Throttle`` (see ``get_throttle``).
+"""
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket(object):
+    """A token bucket, refilled at ``rate`` tokens per second, and holding
+    at most ``burst`` tokens (one second's worth by default). Taking more
+    tokens than there are leaves the bucket in debt, and whoever took them
+    waits until it's paid back, so that the rate is kept however large the
+    chunks are. With ``rate`` set to ``None`` there's no limit."""
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.set_rate(rate, burst=burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate. The tokens (or debt) there are now are kept, so
+        changing the rate doesn't hand out a new burst."""
+        with self.lock:
+            if rate is not None and rate <= 0:
+                raise ValueError("The rate has to be positive, or None")
+            now = time.monotonic()
+            burst = burst or rate
+            if self.rate is None:
+                # A new limit starts with a full bucket
+                self.tokens = burst
+            else:
+                self.tokens = min(burst or self.burst, self.tokens +
+                                  (now - self.last) * self.rate)
+            self.burst = burst
+            self.last = now
+            self.rate = rate
+
+    def reserve(self, n=1):
+        """Take ``n`` tokens, and return how long to wait (in seconds)
+        before using them."""
+        if self.rate is None:
+            return 0.
+        with self.lock:
+            if self.rate is None:
+                return 0.
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.
+            return -self.tokens / self.rate
+
+    def take(self, n=1):
+        """Take ``n`` tokens, waiting if needed."""
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostLimits(object):
+    """The buckets for bytes and requests of a host."""
+    def __init__(self):
+        self.bytes = TokenBucket()
+        self.requests = TokenBucket()
+
+
+GLOBAL = HostLimits()
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def _host_limits(host):
+    limits = _hosts.get(host)
+    if limits is None:
+        with _hosts_lock:
+            limits = _hosts.setdefault(host, HostLimits())
+    return limits
+
+
+def set_limit(host=None, bytes_per_second=None, requests_per_second=None,
+              burst_seconds=1.):
+    """Set the limits for a host, or for all the hosts together if ``host``
+    is ``None``. A limit set to ``None`` is taken away. Takes effect straight
+    away, also for downloads that are going on.
+
+    Parameters
+    ------------
+    host: str
+        The host name, without the port (e.g.
+        ``ladsweb.modaps.eosdis.nasa.gov``)
+    bytes_per_second: float
+        Download bandwidth
+    requests_per_second: float
+        Rate of requests
+    burst_seconds: float
+        How many seconds' worth of tokens can be used in one go
+    """
+    limits = GLOBAL if host is None else _host_limits(host.lower())
+    for bucket, rate in [(limits.bytes, bytes_per_second),
+                         (limits.requests, requests_per_second)]:
+        bucket.set_rate(rate, burst=rate and max(1, rate * burst_seconds))
+
+
+def clear_limits():
+    """Take away all the limits."""
+    for limits in [GLOBAL] + list(_hosts.values()):
+        limits.bytes.set_rate(None)
+        limits.requests.set_rate(None)
+
+
+class Throttle(object):
+    """Throttles the transfers to and from a host (together with the global
+    limits). Get one with ``get_throttle``, once per download, and call it
+    with the size of every chunk."""
+    def __init__(self, host):
+        self.host = _host_limits(host)
+
+    def reserve_bytes(self, n):
+        return max(self.host.bytes.reserve(n), GLOBAL.bytes.reserve(n))
+
+    def reserve_request(self):
+        return max(self.host.requests.reserve(), GLOBAL.requests.reserve())
+
+    def __call__(self, n):
+        wait = self.reserve_bytes(n)
+        if wait > 0:
+            time.sleep(wait)
+
+    def request(self):
+        wait = self.reserve_request()
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_throttle(url):
+    """The ``Throttle`` of the host of ``url``. Limits are per host name,
+    whatever the port, as for ``sentinel_downloader.host_slot``."""
+    return Throttle(urlparse(url).hostname)
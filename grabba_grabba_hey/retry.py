@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+"""
+What to do when a request fails. Rather than sleeping for a fixed time (or
+forever), failures that are worth retrying (dropped connections, timeouts,
+and servers saying they are busy) are retried after an exponential backoff
+with some jitter, honouring the ``Retry-After`` header if the server sends
+one. A host that keeps failing has its circuit "opened" for a while, so we
+stop hammering it. When downloading lots of files, failed files are put
+back in the queue to be tried again later, so that the worker threads get
+on with the rest in the meantime. How many retries there have been, and
+how much time they cost, is kept in ``STATS``.
+"""
+import collections
+import datetime
+import email.utils
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from concurrent import futures
+from urllib.parse import urlparse
+
+import requests
+
+from . import metrics
+
+LOG = logging.getLogger(__name__)
+
+# Status codes that mean "try again later"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+BASE_WAIT = 1.
+MAX_WAIT = 300.
+# Consecutive failures before a host's circuit opens, and for how long
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 60.
+
+
+class RetryableError(IOError):
+    """An error after which the request can be tried again, maybe after
+    ``retry_after`` seconds."""
+    def __init__(self, msg, retry_after=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(RetryableError):
+    """Too many failures from a host for now."""
+
+
+RETRYABLE_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout,
+                    RetryableError)
+
+
+def retry_after(response):
+    """The number of seconds given in the ``Retry-After`` header of a
+    response (either as a number or as a date), or ``None``."""
+    value = getattr(response, "headers", {}).get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(when.tzinfo)
+    return max(0., (when - now).total_seconds())
+
+
+def check_response(response, what=None):
+    """Raise a ``RetryableError`` if the server is busy or had a temporary
+    problem, or an ``IOError`` for any other error. Otherwise, the response
+    is returned."""
+    if response.ok:
+        return response
+    msg = "Can't get %s (error code %d)" % (what or response.url,
+                                             response.status_code)
+    if response.status_code in RETRY_STATUSES:
+        wait = None
+        if response.status_code in (429, 503):
+            wait = retry_after(response)
+        raise RetryableError(msg, retry_after=wait)
+    raise IOError(msg)
+
+
+class RetryPolicy(object):
+    """How many times to try again, and how long to wait before each
+    attempt: exponential backoff capped to ``max_wait``, with "full jitter"
+    (a random wait up to the backoff time, so that lots of threads failing
+    at the same time don't all come back at the same time), unless the
+    server said how long to wait."""
+    def __init__(self, max_retries=MAX_RETRIES, base_wait=BASE_WAIT,
+                 max_wait=MAX_WAIT, jitter=True):
+        self.max_retries = max_retries
+        self.base_wait = base_wait
+        self.max_wait = max_wait
+        self.jitter = jitter
+
+    def retryable(self, err):
+        return isinstance(err, RETRYABLE_ERRORS)
+
+    def wait(self, attempt, err=None):
+        """How long to wait after failed attempt number ``attempt``
+        (starting at 0), which failed with ``err``."""
+        server_wait = getattr(err, "retry_after", None)
+        if server_wait is not None:
+            return min(server_wait, self.max_wait)
+        wait = min(self.max_wait, self.base_wait * 2 ** attempt)
+        if self.jitter:
+            wait = random.uniform(0, wait)
+        return wait
+
+
+def _host(url):
+    return urlparse(url).netloc or url
+
+
+class CircuitBreaker(object):
+    """Keeps count of consecutive failures per host. After ``threshold`` of
+    them, requests to that host fail straight away (with a
+    ``CircuitOpenError``) for ``reset_after`` seconds. After that, requests
+    are let through again, but a single failure opens the circuit again."""
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset_after=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = collections.Counter()
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def check(self, url):
+        host = _host(url)
+        with self.lock:
+            if host not in self.opened:
+                return
+            remaining = self.opened[host] + self.reset_after - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError("Too many failures from %s" % host,
+                                   retry_after=remaining)
+
+    def success(self, url):
+        host = _host(url)
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, url):
+        host = _host(url)
+        with self.lock:
+            self.failures[host] += 1
+            if self.failures[host] >= self.threshold:
+                if host not in self.opened:
+                    LOG.warning("Too many failures from %s, leaving it " %
+                                host + "alone for %d s" % self.reset_after)
+                self.opened[host] = time.monotonic()
+
+
+class RetryStats(object):
+    """Number of retries per host, time lost in failed attempts and time
+    spent waiting to retry."""
+    def __init__(self):
+        self.retries = collections.Counter()
+        self.lost = collections.Counter()
+        self.waited = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, url, lost=0., waited=0.):
+        host = _host(url)
+        with self.lock:
+            self.retries[host] += 1
+            self.lost[host] += lost
+            self.waited[host] += waited
+
+    def summary(self):
+        """A dictionary with the retries, and the time lost and waited (in
+        seconds), per host."""
+        with self.lock:
+            return {host: {"retries": self.retries[host],
+                           "lost": self.lost[host],
+                           "waited": self.waited[host]}
+                    for host in self.retries}
+
+    def report(self):
+        for host, stats in sorted(self.summary().items()):
+            LOG.info("%s: %d retries, %.1f s lost in failed attempts, " %
+                     (host, stats["retries"], stats["lost"]) +
+                     "%.1f s waiting" % stats["waited"])
+
+    def reset(self):
+        with self.lock:
+            self.retries.clear()
+            self.lost.clear()
+            self.waited.clear()
+
+
+STATS = RetryStats()
+BREAKER = CircuitBreaker()
+
+
+def call_with_retries(func, url, policy=None, breaker=None, stats=None):
+    """Call ``func()`` (which gets ``url``) until it works, waiting between
+    attempts as set by ``policy``. This is for things that have to be done
+    before anything else can go on (e.g. a listing); for lots of files, use
+    ``run_with_requeue``."""
+    policy = policy or RetryPolicy()
+    breaker = breaker or BREAKER
+    stats = stats or STATS
+    for attempt in range(policy.max_retries + 1):
+        t0 = time.monotonic()
+        try:
+            breaker.check(url)
+            result = func()
+        except RETRYABLE_ERRORS as err:
+            if not isinstance(err, CircuitOpenError):
+                breaker.failure(url)
+            if attempt == policy.max_retries:
+                raise
+            wait = policy.wait(attempt, err)
+            stats.record(url, lost=time.monotonic() - t0, waited=wait)
+            LOG.info("%s failed (%s), retrying in %.1f s" % (url, err, wait))
+            time.sleep(wait)
+        else:
+            breaker.success(url)
+            return result
+
+
+def _attempt(func, item, url, breaker, attempt=0, queued=None):
+    measure = metrics.enabled()
+    if measure:
+        metrics.set_context(retries=attempt,
+                            queue_wait=time.monotonic() - queued)
+    try:
+        breaker.check(url)
+        try:
+            result = func(item)
+        except RETRYABLE_ERRORS as err:
+            if not isinstance(err, CircuitOpenError):
+                breaker.failure(url)
+            raise
+    finally:
+        if measure:
+            metrics.clear_context()
+    breaker.success(url)
+    return result
+
+
+_NO_ITEM = object()
+
+
+def run_with_requeue(func, items, n_threads=4, key=None, policy=None,
+                     breaker=None, stats=None):
+    """Call ``func(item)`` for all the ``items`` using ``n_threads``
+    threads. Items that fail with an error worth retrying go back in the
+    queue, to be tried again once their backoff time is over, while the
+    threads get on with the other items. The number of retries and the
+    time each item waited in the queue are passed on to the metrics (see
+    ``metrics.set_context``).
+
+    Parameters
+    ------------
+    func: callable
+        The function to call on each item
+    items: iterable
+        The items (e.g. URLs). They are taken as the workers are ready for
+        them, so this can be a generator of items that are still being
+        worked out (e.g. a listing) without having to wait for all of them.
+    n_threads: int
+        Number of worker threads
+    key: callable
+        Gives the URL of an item (for the circuit breaker and stats). The
+        item itself by default.
+    policy: RetryPolicy
+        How many times and when to retry. ``RetryPolicy()`` by default.
+    Returns
+    --------
+    A generator of ``(item, result, error)`` tuples as items are done, with
+    ``error`` being ``None`` if all went well, or the last exception raised
+    for that item.
+    """
+    policy = policy or RetryPolicy()
+    breaker = breaker or BREAKER
+    stats = stats or STATS
+    key = key or str
+    # Items we were given all at once have been queued since the start,
+    # the ones from a generator since it came up with them
+    start = time.monotonic() if hasattr(items, "__len__") else None
+    items = iter(items)
+    ready = collections.deque()
+    later = []
+    order = itertools.count()
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        while items is not None or ready or later or running:
+            now = time.monotonic()
+            while later and later[0][0] <= now:
+                _, _, item, attempt = heapq.heappop(later)
+                ready.append((item, attempt, now))
+            # Don't queue up more than the workers can take soon, so that
+            # retried items are not stuck behind everything else
+            while len(running) < 2 * n_threads:
+                if ready:
+                    item, attempt, queued = ready.popleft()
+                elif items is not None:
+                    item = next(items, _NO_ITEM)
+                    if item is _NO_ITEM:
+                        items = None
+                        break
+                    attempt = 0
+                    queued = time.monotonic() if start is None else start
+                else:
+                    break
+                future = executor.submit(_attempt, func, item, key(item),
+                                         breaker, attempt, queued)
+                running[future] = (item, attempt, time.monotonic())
+            timeout = None
+            if later:
+                timeout = max(0., later[0][0] - time.monotonic())
+            if not running:
+                if timeout is not None:
+                    time.sleep(timeout)
+                continue
+            done, _ = futures.wait(running, timeout=timeout,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                item, attempt, t0 = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as err:
+                    if policy.retryable(err) and attempt < policy.max_retries:
+                        wait = policy.wait(attempt, err)
+                        stats.record(key(item), lost=time.monotonic() - t0)
+                        LOG.info("%s failed (%s), trying again in %.1f s" %
+                                 (key(item), err, wait))
+                        heapq.heappush(later, (time.monotonic() + wait,
+                                               next(order), item,
+                                               attempt + 1))
+                    else:
+                        LOG.error("Giving up on %s (%s)" % (key(item), err))
+                        yield item, None, err
+                else:
+                    yield item, result, None
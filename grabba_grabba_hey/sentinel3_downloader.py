@@ -7,13 +7,19 @@ from functools import partial
 import hashlib
 import os
 import datetime
-import sys
-import xml.etree.cElementTree as ET
 import re
+import time
 
 import requests
 from concurrent import futures
 
+from .cache import cached_get
+from .catalogue import get_catalogue
+from .sentinel_downloader import _get_md5, parse_xml
+from .retry import MAX_RETRIES, RETRYABLE_ERRORS, STATS, RetryPolicy
+from .sessions import get_session
+from .transfer import fetch_resumable, new_hasher
+
 import logging
 logging.basicConfig(level=logging.INFO)
 
@@ -47,99 +53,75 @@ def do_query(query, user="guest", passwd="guest"):
     Returns:
         The relevant XML file, or raises error
     """
-    r = requests.get(query, auth=(user, passwd), verify=False)
+    r = cached_get(query, auth=(user, passwd), verify=False)
     if r.status_code == 200:
         return r.text
     else:
         raise IOError("Something went wrong! Error code %d" % r.status_code)
 
 
-def download_product(source, target, user="guest", passwd="guest"):
+def _fetch_product(source, target, user, passwd):
+    """Download (or finish downloading) ``source`` to ``target``, and return
+    the MD5 of the whole file."""
+    hasher = new_hasher("md5")
+    get = partial(get_session().get, auth=(user, passwd), verify=False)
+    n_bytes = fetch_resumable(get, source, target, hasher=hasher)
+    LOG.info("%d bytes..." % n_bytes)
+    return hasher.hexdigest().upper()
+
+
+def download_product(source, target, user="guest", passwd="guest",
+                     catalogue=None, max_retries=MAX_RETRIES):
     """
     Download a product from the SentinelScihub site, and save it to a named
-    local disk location given by ``target``.
+    local disk location given by ``target``. Products already in the
+    ``catalogue`` (see ``catalogue.get_catalogue``) are skipped without
+    asking the hub. The product is written to ``target + ".partial"``
+    first, and an interrupted download is resumed from there.
 
     source: str
         A product fully qualified URL
     target: str
         A filename where to download the URL specified
+    max_retries: int
+        Number of times to try again if the download fails or the file
+        doesn't match its checksum
     """
-    md5_source = source.replace("$value", "/Checksum/Value/$value")
-    r = requests.get(md5_source, auth=(user, passwd), verify=False)
-    md5 = r.text
+    catalogue = get_catalogue(catalogue)
+    product_id = os.path.basename(target)
+    if catalogue.has(product_id, path=target):
+        return
+    md5 = _get_md5(source, user=user, passwd=passwd)
     if os.path.exists(target):
         md5_file = calculate_md5(target)
         if md5 == md5_file:
+            catalogue.add(product_id, target, "s3hub", checksum=md5_file)
             return
-    chunks = 1048576 # 1MiB...
-    while True:
+    # Interrupted downloads and checksum mismatches both use up attempts
+    policy = RetryPolicy(max_retries=max_retries)
+    err = None
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            wait = policy.wait(attempt - 1, err)
+            STATS.record(source, waited=wait)
+            LOG.info("Retrying %s in %d s" % (source, wait))
+            time.sleep(wait)
+        err = None
         LOG.debug("Getting %s" % source)
-        r = requests.get(source, auth=(user, passwd), stream=True,
-                         verify=False)
-        if not r.ok:
-            raise IOError("Can't start download... [%s]" % source)
-        file_size = int(r.headers['content-length'])
         LOG.info("Downloading to -> %s" % target)
-        LOG.info("%d bytes..." % file_size)
-        with open(target, 'wb') as fp:
-            cntr = 0
-            dload = 0
-            for chunk in r.iter_content(chunk_size=chunks):
-                if chunk:
-                    cntr += 1
-                    if cntr > 100:
-                        dload += cntr * chunks
-                        LOG.info("\tWriting %d/%d [%5.2f %%]" % (dload, file_size,
-                                                              100. * float(dload) / 
-                                                              float(file_size)))
-                        sys.stdout.flush()
-                        cntr = 0
-
-                    fp.write(chunk)
-                    fp.flush()
-                    os.fsync(fp)
-
-        md5_file = calculate_md5(target)
+        try:
+            md5_file = _fetch_product(source, target, user, passwd)
+        except RETRYABLE_ERRORS as the_err:
+            LOG.info("Download of %s interrupted (%s)" % (source, the_err))
+            err = the_err
+            continue
         if md5_file == md5:
-            break
-        return
-
-
-def parse_xml(xml):
-    """
-    Parse an OData XML file to havest some relevant information re products
-    available and so on. It will return a list of dictionaries, with one
-    dictionary per product returned from the query. Each dicionary will have a
-    number of keys (see ``fields_of_interest``), as well as ``link`` and
-    ``qui
-    """
-    fields_of_interest = ["filename", "identifier", "instrumentshortname",
-                          "orbitnumber", "orbitdirection", "producttype",
-                          "beginposition", "endposition"]
-    tree = ET.ElementTree(ET.fromstring(xml))
-    # Search for all the acquired images...
-    granules = []
-    for elem in tree.iter(tag="{http://www.w3.org/2005/Atom}entry"):
-        granule = {}
-        for img in elem.getchildren():
-            if img.tag.find("id") >= 0:
-                granule['id'] = img.text
-            if img.tag.find("link") and img.attrib.has_key("href"):
-
-                if img.attrib['href'].find("Quicklook") >= 0:
-                    granule['quicklook'] = img.attrib['href']
-                elif img.attrib['href'].find("$value") >= 0:
-                    granule['link'] = img.attrib['href'].replace("$value", "")
-
-            if img.attrib.has_key("name"):
-                if img.attrib['name'] in fields_of_interest:
-                    granule[img.attrib['name']] = img.text
-
-        granules.append(granule)
-
-    return granules
-    # print img.tag, img.attrib, img.text
-    # for x in img.getchildren():
+            catalogue.add(product_id, target, "s3hub", checksum=md5_file)
+            return
+        LOG.info("MD5 signatures didn't match")
+        os.remove(target)
+    raise IOError("Giving up on %s after %d attempts" %
+                  (source, max_retries + 1))
 
 
 def download_sentinel(location, input_start_date, input_sensor, output_dir,
@@ -201,7 +183,6 @@ def download_sentinel(location, input_start_date, input_sensor, output_dir,
     query = "%s%s" % (hub_url, query)
     # query = "%s%s" % ( hub_url, urllib2.quote(query ) )
     LOG.debug(query)
-    import pdb;pdb.set_trace()
     result = do_query(query, user=username, passwd=password)
     
     granules = parse_xml(result)
@@ -240,13 +221,13 @@ if __name__ == "__main__":    # location = (43.3650, -8.4100)
     #lng = -2.1082 
     #lat = 28.55 # Libya 4
     #lng = 23.39
-    print "Testing S2 on COPERNICUS scientific hub"
+    print("Testing S2 on COPERNICUS scientific hub")
     location=(lat,lng)
     input_start_date="2017.1.1"
     input_sensor="S3"
     output_dir="/tmp/"
     username="s3guest"
     password="s3guest"
-    print "Set username and password variables for Sentinel hub!!!"
+    print("Set username and password variables for Sentinel hub!!!")
     download_sentinel(location, input_start_date, input_sensor, output_dir,
                       input_end_date=None, username=username, password=password)
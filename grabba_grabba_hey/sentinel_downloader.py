@@ -5,19 +5,33 @@ the COPERNICUS Sentinel Hub.
 """
 import hashlib
 import datetime
+from collections import namedtuple
 from functools import partial
+import io
 import logging
 import os
 import shutil
 import re
-import sys
+import threading
 import time
-import xml.etree.cElementTree as ET
+import xml.etree.ElementTree as ET
 
 from concurrent import futures
+from urllib.parse import urlparse
 
 import requests
 
+from . import aio, metrics
+from .cache import cached_get, open_db
+from .catalogue import get_catalogue
+from .mgrs import latlon_to_mgrs, latlon_to_s2_tiles
+from .retry import (MAX_RETRIES, RETRY_STATUSES, RETRYABLE_ERRORS, STATS,
+                    RetryPolicy, call_with_retries, check_response,
+                    run_with_requeue)
+from .sessions import get_session
+from .transfer import (fetch_resumable, hash_file, new_hasher, open_target,
+                       write_stream)
+
 logging.basicConfig(level=logging.INFO)
 
 # not so much to use basicConfig as a quick usage of %(pathname)s
@@ -31,15 +45,56 @@ logging.getLogger("urllib3").setLevel(logging.CRITICAL)
 
 # hub_url = "https://scihub.copernicus.eu/dhus/search?q="
 hub_url = "https://scihub.copernicus.eu/apihub/search?q="
-MGRS_CONVERT = "http://legallandconverter.com/cgi-bin/shopmgrs3.cgi"
-aws_url = 'http://sentinel-s2-l1c.s3.amazonaws.com/?delimiter=/&prefix=tiles/'
 aws_url_dload = 'http://sentinel-s2-l1c.s3.amazonaws.com/'
+# Subdirectories of an acquisition in the S2 bucket that we also want
+AWS_SUBDIRS = ("qi/", "aux/")
+# Listings of the bucket that new acquisitions can still turn up in (the
+# ones with no date, or a year, month or day that ended less than
+# ``LIVE_DAYS`` ago) are only cached for ``LIVE_TTL`` seconds
+LIVE_DAYS = 7
+LIVE_TTL = 10 * 60
+AWS_PREFIX_DATE = re.compile(r"^tiles/\d+/\w/\w\w/(\d{4})(?:/(\d{1,2}))?"
+                             r"(?:/(\d{1,2}))?")
+# Cloud cover of each S2 tile and date on AWS
+CLOUD_CACHE = "s2_cloud_cover.sqlite"
+CLOUD_CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cloud_cover (
+    tile TEXT NOT NULL,
+    date TEXT NOT NULL,
+    cover REAL,
+    PRIMARY KEY (tile, date)
+);
+"""
+ATOM_ENTRY = "{http://www.w3.org/2005/Atom}entry"
+ATOM_ID = "{http://www.w3.org/2005/Atom}id"
+ATOM_LINK = "{http://www.w3.org/2005/Atom}link"
+# Maximum number of rows per page allowed by the hub
+MAX_ROWS = 100
+MD5 = re.compile(r"^[0-9A-F]{32}$")
+TOTAL_RESULTS = re.compile(r"<opensearch:totalResults>\s*(\d+)\s*<")
+# Concurrent downloads allowed per account on each host. The hub only lets
+# each user have a couple of parallel streams going.
+HOST_LIMITS = {"scihub.copernicus.eu": 2}
+DEFAULT_HOST_LIMIT = 4
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+# Downloads are checked in blocks of this size, so that only the bad blocks
+# are downloaded again. Failed downloads are retried a few times, waiting
+# longer each time.
+CHUNK_SIZE = 1048576  # 1MiB...
+BLOCK_SIZE = 8 * 1048576
+ENGINES = ("threads", "async")
+RETRY_WAIT = 10
+MAX_RETRY_WAIT = 300
 requests.packages.urllib3.disable_warnings()
 
 
 def get_mgrs(longitude, latitude):
-    """A method that uses a website to infer the Military Grid Reference System
-    tile that is used by the Amazon data buckets from the latitude/longitude
+    """A method that infers the Military Grid Reference System tile that is
+    used by the Amazon data buckets from the latitude/longitude. This is
+    calculated locally (see ``mgrs.latlon_to_mgrs``), and if you have lots
+    of points, it's much faster to call that (or ``mgrs.latlon_to_s2_tiles``
+    to get all the tiles that overlap each point) with arrays.
 
     Parameters
     -------------
@@ -51,17 +106,9 @@ def get_mgrs(longitude, latitude):
     --------
     The MGRS tile (e.g. 29TNJ)
     """
-    r = requests.post(MGRS_CONVERT,
-                      data=dict(latitude=latitude,
-                                longitude=longitude, xcmd="Calc", cmd="gps"))
-    for liner in r.text.split("\n"):
-        if liner.find("<title>") >= 0:
-            mgrs_tile = liner.replace("<title>", "").replace("</title>", "")
-            mgrs_tile = mgrs_tile.replace(" ", "")
-    try:
-        return mgrs_tile[:5]  # This should be enough
-    except NameError:
+    if longitude is None or latitude is None:
         return None
+    return str(latlon_to_mgrs(latitude, longitude)[0])
 
 
 def calculate_md5(fname):
@@ -84,113 +131,467 @@ def do_query(query, user="guest", passwd="guest"):
     Returns:
         The relevant XML file, or raises error
     """
-    r = requests.get(query, auth=(user, passwd), verify=False)
+    r = cached_get(query, auth=(user, passwd), verify=False)
     if r.status_code == 200:
         return r.text
     else:
         raise IOError("Something went wrong! Error code %d" % r.status_code)
 
 
-def download_product(source, target, user="guest", passwd="guest"):
+class _HostSlot(object):
+    """Lets at most ``limit`` downloads go on at the same time. Unlike a
+    semaphore, the limit can be changed while downloads are going on: those
+    keep going, and new ones wait until there are fewer than the new limit
+    in flight."""
+    def __init__(self, limit):
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.limit = limit
+
+    def set_limit(self, limit):
+        if limit < 1:
+            raise ValueError("The limit has to be at least 1 (got %s)" %
+                             limit)
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def host_slot(url, user=None, limit=None):
+    """Get the slot that limits the number of concurrent downloads from the
+    host of ``url`` for account ``user``. The limit is taken from
+    ``HOST_LIMITS`` (or ``DEFAULT_HOST_LIMIT``) unless ``limit`` is given.
+
+    Parameters
+    ------------
+    url: str
+        The URL to download
+    user: str
+        The account used to download
+    limit: int
+        The maximum number of concurrent downloads
+    Returns
+    --------
+    A context manager, the same one for every call with the same host and
+    account, so that all the downloads count towards the limit. The limit
+    of the last call is the one kept to from then on.
+    """
+    host = urlparse(url).hostname
+    if limit is None:
+        limit = HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT)
+    with _host_slots_lock:
+        slot = _host_slots.get((host, user))
+        if slot is None:
+            slot = _host_slots[(host, user)] = _HostSlot(limit)
+    slot.set_limit(limit)
+    return slot
+
+
+def download_product(source, target, user="guest", passwd="guest",
+                     max_per_host=None, max_retries=MAX_RETRIES,
+                     durability=None, preallocate=False, catalogue=None):
     """
     Download a product from the SentinelScihub site, and save it to a named
-    local disk location given by ``target``.
+    local disk location given by ``target``. No more than ``max_per_host``
+    downloads from the same host and account will run at the same time (see
+    ``host_slot``).
+
+    The product is written to ``target + ".part"`` first. An interrupted
+    download is resumed from where it stopped, and if the MD5 doesn't match
+    only the bad blocks are downloaded again where possible. After
+    ``max_retries`` failed retries, an ``IOError`` is raised.
+
+    By default the file is only synced to disk once it has been written.
+    ``durability`` can be set to ``"chunk"`` to sync after every chunk, or
+    ``"none"`` to never sync (see ``transfer.write_stream``). With
+    ``preallocate``, the whole file is reserved on disk before downloading.
+
+    Downloaded products are recorded in the ``catalogue`` (see
+    ``catalogue.get_catalogue``), and skipped if they are already there.
 
     source: str
         A product fully qualified URL
     target: str
         A filename where to download the URL specified
     """
-
+    catalogue = get_catalogue(catalogue)
+    product_id = os.path.basename(target)
+    if catalogue.has(product_id, path=target):
+        logging.info("\t{} already acquired. Skipping".format(target))
+        return
     if os.path.exists(target):
         # File already exists on file system. Can only be that
         # it's been downloaded already and checked vs MD5 hash
         # Just return empty
         logging.info("\t{} already exists. Skipping".format(target))
+        catalogue.add(product_id, target, "scihub")
         return
-    chunks = 1048576  # 1MiB...
+    measure = metrics.enabled()
+    t0 = time.monotonic()
+    with host_slot(source, user=user, limit=max_per_host):
+        if measure:
+            metrics.set_context(queue_wait=time.monotonic() - t0)
+        try:
+            md5 = _download_product(source, target, user=user,
+                                    passwd=passwd, max_retries=max_retries,
+                                    durability=durability,
+                                    preallocate=preallocate)
+        finally:
+            if measure:
+                metrics.clear_context()
+    catalogue.add(product_id, target, "scihub", checksum=md5)
+
+
+def _read_block_digests(part):
+    """Read the MD5 digests of the blocks of ``part`` that were recorded
+    while they were being downloaded."""
+    if not os.path.exists(part + ".blocks"):
+        return []
+    with open(part + ".blocks", "r") as fp:
+        digests = [line.strip() for line in fp]
+    # A half written last line is just dropped
+    return [digest for digest in digests if len(digest) == 32]
+
+
+def _discard_part(part):
+    """Remove a partial download and its block digests."""
+    for fname in [part, part + ".blocks"]:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+
+class _BlockDigests(object):
+    """A hasher-like object that appends the MD5 of each complete block of
+    ``BLOCK_SIZE`` bytes that goes past to the open file ``fp``."""
+    def __init__(self, fp):
+        self.fp = fp
+        self.block = hashlib.md5()
+        self.in_block = 0
+
+    def update(self, chunk):
+        while chunk:
+            piece = chunk[:BLOCK_SIZE - self.in_block]
+            chunk = chunk[len(piece):]
+            self.block.update(piece)
+            self.in_block += len(piece)
+            if self.in_block == BLOCK_SIZE:
+                self.fp.write(self.block.hexdigest() + "\n")
+                self.fp.flush()
+                self.block = hashlib.md5()
+                self.in_block = 0
+
+
+def _fetch_part(source, part, user="guest", passwd="guest", digest="md5",
+                durability=None, preallocate=False):
+    """Download ``source`` into the partial file ``part``. If ``part``
+    already exists, the download resumes after the last block whose digest
+    was recorded, using a ``Range`` request. The MD5 of each complete block
+    of ``BLOCK_SIZE`` bytes is appended to ``part + ".blocks"`` as it is
+    written. See ``transfer.open_target`` and ``transfer.write_stream`` for
+    ``durability`` and ``preallocate``.
+
+    Returns
+    --------
+    The checksum of the whole of ``part`` (upper case hex), calculated with
+    ``digest`` (see ``transfer.new_hasher``) while downloading.
+    """
+    digests = _read_block_digests(part)
+    offset = 0
+    if os.path.exists(part):
+        offset = min(len(digests) * BLOCK_SIZE, os.path.getsize(part))
+        offset -= offset % BLOCK_SIZE
+    digests = digests[:offset // BLOCK_SIZE]
+    headers = {}
+    if offset > 0:
+        headers["Range"] = "bytes=%d-" % offset
+    logging.debug("Getting %s from byte %d" % (source, offset))
+    r = get_session().get(source, auth=(user, passwd), stream=True,
+                          verify=False, headers=headers)
+    if r.status_code == 416:
+        # Nothing left to get
+        return hash_file(part, new_hasher(digest)).hexdigest().upper()
+    check_response(r, source)
+    if offset > 0 and r.status_code != 206:
+        logging.info("Server doesn't support resuming, starting again")
+        offset = 0
+        digests = []
+    file_size = offset + int(r.headers['content-length'])
+    hasher = new_hasher(digest)
+    if offset > 0:
+        logging.info("Resuming download to -> %s" % part)
+        # Only the bit that we already had needs reading back
+        hash_file(part, hasher, size=offset)
+    else:
+        logging.info("Downloading to -> %s" % part)
+    logging.info("%d bytes..." % file_size)
+    with open_target(part, offset=offset, file_size=file_size,
+                     preallocate=preallocate) as fp, \
+            open(part + ".blocks", "w") as fp_blocks:
+        fp_blocks.writelines(block + "\n" for block in digests)
+        fp_blocks.flush()
+        write_stream(r, fp, hashers=[hasher, _BlockDigests(fp_blocks)],
+                     chunk_size=CHUNK_SIZE, offset=offset,
+                     file_size=file_size, durability=durability)
+    return hasher.hexdigest().upper()
+
+
+def _repair_part(source, part, user="guest", passwd="guest"):
+    """Check a complete partial download block by block against the digests
+    recorded while downloading it, and download again the blocks that don't
+    match, as well as the tail after the last complete block. The hub only
+    publishes a checksum for the whole product, and the block digests are
+    of the data as it was received, so this can only fix blocks that got
+    damaged on disk after they were written. It can't fix data that was
+    corrupted on the way: then no block looks bad, and the whole product is
+    downloaded again.
+
+    Busy servers and dropped connections raise the errors in
+    ``retry.RETRYABLE_ERRORS``, so the repair is tried again like the rest
+    of the download.
+
+    Returns
+    --------
+    ``True`` if only some bits of the file have been downloaded again,
+    ``False`` if the whole file needs to be downloaded again.
+    """
+    digests = _read_block_digests(part)
+    file_size = os.path.getsize(part)
+    if not digests or len(digests) * BLOCK_SIZE > file_size:
+        return False
+    bad_blocks = []
+    with open(part, "rb") as fp:
+        for i, digest in enumerate(digests):
+            if hashlib.md5(fp.read(BLOCK_SIZE)).hexdigest() != digest:
+                bad_blocks.append((i * BLOCK_SIZE, (i + 1) * BLOCK_SIZE - 1))
+    if len(digests) * BLOCK_SIZE < file_size:
+        bad_blocks.append((len(digests) * BLOCK_SIZE, file_size - 1))
+    logging.info("Downloading %d bad blocks again" % len(bad_blocks))
+    with open(part, "r+b") as fp:
+        for start, end in bad_blocks:
+            r = get_session().get(
+                source, auth=(user, passwd), verify=False,
+                headers={"Range": "bytes=%d-%d" % (start, end)})
+            if r.status_code in RETRY_STATUSES:
+                check_response(r, source)
+            if r.status_code != 206 or len(r.content) != end - start + 1:
+                return False
+            fp.seek(start)
+            fp.write(r.content)
+    return True
+
+
+def _get_md5(source, user="guest", passwd="guest"):
+    """The MD5 checksum that the hub publishes for a product (upper case
+    hex). Busy servers are retried, and anything that isn't an MD5 (e.g. an
+    error page) raises an ``IOError`` rather than being taken for one."""
     md5_source = source.replace("$value", "/Checksum/Value/$value")
-    r = requests.get(md5_source, auth=(user, passwd), verify=False)
-    md5 = r.text
-    # Infinite loop until we get the hash to match the official one
-    while True:
-        logging.debug("Getting %s" % target)
-        r = requests.get(source, auth=(user, passwd), stream=True,
-                         verify=False)
-        if not r.ok:
-            raise IOError("Can't start download... [%s]" % source)
-        file_size = int(r.headers['content-length'])
-        logging.info("Downloading to -> %s" % target)
-        logging.info("%d bytes..." % file_size)
-        with open(target+".part", 'wb') as fp:
-            cntr = 0
-            dload = 0
-            for chunk in r.iter_content(chunk_size=chunks):
-                if chunk:
-                    cntr += 1
-                    if cntr > 100:
-                        dload += cntr * chunks
-                        logging.info("\tWriting %d/%d [%5.2f %%]" %
-                                     (dload, file_size,
-                                      100. * float(dload) / float(file_size)))
-                        sys.stdout.flush()
-                        cntr = 0
-
-                    fp.write(chunk)
-                    fp.flush()
-                    os.fsync(fp)
-        shutil.move(target+".part", target)
-        md5_file = calculate_md5(target)
+    r = call_with_retries(lambda: check_response(get_session().get(
+        md5_source, auth=(user, passwd), verify=False), md5_source),
+        md5_source)
+    md5 = r.text.strip().upper()
+    if not MD5.match(md5):
+        raise IOError("%s doesn't look like an MD5 checksum (%r)" %
+                      (md5_source, md5[:40]))
+    return md5
+
+
+def _download_product(source, target, user="guest", passwd="guest",
+                      max_retries=MAX_RETRIES, durability=None,
+                      preallocate=False):
+    md5 = _get_md5(source, user=user, passwd=passwd)
+    part = target + ".part"
+    policy = RetryPolicy(max_retries=max_retries, base_wait=RETRY_WAIT,
+                         max_wait=MAX_RETRY_WAIT)
+    err = None
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            wait = policy.wait(attempt - 1, err)
+            STATS.record(source, lost=time.monotonic() - t0, waited=wait)
+            logging.info("Retrying download in %d s" % wait)
+            time.sleep(wait)
+        t0 = time.monotonic()
+        err = None
+        if metrics.enabled():
+            metrics.set_context(retries=attempt)
+        try:
+            md5_file = _fetch_part(source, part, user=user, passwd=passwd,
+                                   durability=durability,
+                                   preallocate=preallocate)
+            if md5_file != md5:
+                logging.info("MD5 signatures didn't match")
+                # Only helps if the file got damaged on disk (see
+                # ``_repair_part``). A repair that gets interrupted uses up
+                # an attempt, and carries on from the part file next time.
+                if _repair_part(source, part, user=user, passwd=passwd):
+                    md5_file = calculate_md5(part)
+        except RETRYABLE_ERRORS as the_err:
+            logging.info("Download of %s interrupted (%s)" %
+                         (source, the_err))
+            err = the_err
+            continue
         if md5_file == md5:
-            logging.info("MD5 signatures match")
-            logging.info("Successful download")
             break
+        _discard_part(part)
+    else:
+        raise IOError("Giving up on %s after %d attempts" %
+                      (source, max_retries + 1))
+    shutil.move(part, target)
+    _discard_part(part)
+    logging.info("MD5 signatures match")
+    logging.info("Successful download")
+    return md5
+
+
+def _parse_datetime(text):
+    """Parse the dates in the OData feeds (e.g. 2017-01-11T11:23:42.026Z)"""
+    text = text.rstrip("Z")
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        # Older Pythons only like 3 or 6 digits for the fraction of seconds
+        if "." in text:
+            text, fraction = text.split(".")
+            text = "%s.%s" % (text, fraction[:6].ljust(6, "0"))
+            return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S.%f")
+        return datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S")
+
+
+class Granule(namedtuple("Granule", ["id", "link", "quicklook", "filename",
+                                     "identifier", "instrumentshortname",
+                                     "orbitnumber", "orbitdirection",
+                                     "producttype", "beginposition",
+                                     "endposition"])):
+    """A product returned by a query. Orbit numbers are integers and
+    positions are ``datetime`` objects. Fields can also be looked up as
+    ``granule['filename']``."""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+
+# Product properties that we keep, and how to convert them
+GRANULE_FIELDS = {"filename": str, "identifier": str,
+                  "instrumentshortname": str, "orbitnumber": int,
+                  "orbitdirection": str, "producttype": str,
+                  "beginposition": _parse_datetime,
+                  "endposition": _parse_datetime}
+
+
+def iter_granules(source):
+    """
+    Parse an OData XML file incrementally, yielding a ``Granule`` for each
+    product as soon as its entry has been read. Elements are thrown away
+    once they have been parsed, so memory use doesn't grow with the size of
+    the file.
+
+    source: str, bytes or file
+        The XML document, or a file-like object to read it from
+    """
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    root = None
+    fields = None
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            elif elem.tag == ATOM_ENTRY:
+                fields = dict.fromkeys(Granule._fields)
+            continue
+        if fields is None:
+            continue
+        if elem.tag == ATOM_ENTRY:
+            yield Granule(**fields)
+            fields = None
+            # Get rid of everything parsed so far
+            root.clear()
+        elif elem.tag == ATOM_ID:
+            fields['id'] = elem.text
+        elif elem.tag == ATOM_LINK:
+            href = elem.get("href", "")
+            if href.find("Quicklook") >= 0:
+                fields['quicklook'] = href
+            elif href.find("$value") >= 0:
+                fields['link'] = href.replace("$value", "")
         else:
-            logging.info("MD5 signatures didn't match")
-            logging.info("Retrying download")
-    return
+            name = elem.get("name")
+            if name in GRANULE_FIELDS:
+                fields[name] = GRANULE_FIELDS[name](elem.text)
 
 
 def parse_xml(xml):
     """
     Parse an OData XML file to havest some relevant information re products
-    available and so on. It will return a list of dictionaries, with one
-    dictionary per product returned from the query. Each dicionary will have a
-    number of keys (see ``fields_of_interest``), as well as ``link`` and
-    ``qui
+    available and so on. It will return a list of ``Granule``s, one per
+    product returned from the query. See ``iter_granules``.
     """
-    fields_of_interest = ["filename", "identifier", "instrumentshortname",
-                          "orbitnumber", "orbitdirection", "producttype",
-                          "beginposition", "endposition"]
-    tree = ET.ElementTree(ET.fromstring(xml))
-    # Search for all the acquired images...
-    granules = []
-    for elem in tree.iter(tag="{http://www.w3.org/2005/Atom}entry"):
-        granule = {}
-        for img in elem.getchildren():
-            if img.tag.find("id") >= 0:
-                granule['id'] = img.text
-            if img.tag.find("link") and "href" in img.attrib:
-
-                if img.attrib['href'].find("Quicklook") >= 0:
-                    granule['quicklook'] = img.attrib['href']
-                elif img.attrib['href'].find("$value") >= 0:
-                    granule['link'] = img.attrib['href'].replace("$value", "")
+    return list(iter_granules(xml))
 
-            if "name" in img.attrib:
-                if img.attrib['name'] in fields_of_interest:
-                    granule[img.attrib['name']] = img.text
 
-        granules.append(granule)
+def _parse_date(input_date):
+    """Parse a date given as ``YYYY.MM.DD``, ``YYYY-MM-DD`` or ``YYYY/DOY``
+    into the ISO format expected by the hub."""
+    try:
+        the_date = datetime.datetime.strptime(input_date, "%Y.%m.%d")
+    except ValueError:
+        try:
+            the_date = datetime.datetime.strptime(input_date, "%Y-%m-%d")
+        except ValueError:
+            the_date = datetime.datetime.strptime(input_date, "%Y/%j")
+    return the_date.isoformat() + "Z"
 
-    return granules
-    # print img.tag, img.attrib, img.text
-    # for x in img.getchildren():
 
+def build_query(location, input_start_date, input_sensor,
+                input_end_date=None, cloud_pcntg=None, product_type=None):
+    """Build an OpenSearch query URL for the Sentinel hub. The returned URL
+    has no paging parameters, see ``search_products``.
 
-def download_sentinel(location, input_start_date, input_sensor, output_dir,
-                      input_end_date=None, username="guest", password="guest",
-                      cloud_pcntg=None, product_type=None):
+    Parameters
+    ------------
+    location: str or iter
+        Either a tile/granule name, a (lat, lon) tuple or a
+        (lat0, lon0, lat1, lon1) bounding box.
+    input_start_date: str
+        Start date as ``YYYY.MM.DD``, ``YYYY-MM-DD`` or ``YYYY/DOY``
+    input_sensor: str
+        ``S1`` or ``S2``
+    input_end_date: str
+        End date (same formats as the start date). If ``None``, today.
+    cloud_pcntg: float
+        Maximum cloud percentage (only meaningful for S2)
+    product_type: str
+        ``L1C`` or ``L2A`` (only meaningful for S2)
+    Returns
+    --------
+    The query URL
+    """
     input_sensor = input_sensor.upper()
     sensor_list = ["S1", "S2"]
     if not input_sensor in sensor_list:
@@ -203,31 +604,12 @@ def download_sentinel(location, input_start_date, input_sensor, output_dir,
             sensor = "Sentinel-2"
         sensor_str = 'platformname:%s' % sensor
         # sensor_str = 'filename:%s' % input_sensor.upper()
-    try:
-        start_date = datetime.datetime.strptime(input_start_date,
-                                                "%Y.%m.%d").isoformat()
-    except ValueError:
-        try:
-            start_date = datetime.datetime.strptime(input_start_date,
-                                                    "%Y-%m-%d").isoformat()
-        except ValueError:
-            start_date = datetime.datetime.strptime(input_start_date,
-                                                    "%Y/%j").isoformat()
-    start_date = start_date + "Z"
+    start_date = _parse_date(input_start_date)
 
     if input_end_date is None:
         end_date = "NOW"
     else:
-        try:
-            end_date = datetime.datetime.strptime(input_end_date,
-                                                  "%Y.%m.%d").isoformat() + "Z"
-        except ValueError:
-            try:
-                end_date = datetime.datetime.strptime(input_end_date,
-                                                      "%Y-%m-%d").isoformat() + "Z"
-            except ValueError:
-                end_date = datetime.datetime.strptime(input_end_date,
-                                                      "%Y/%j").isoformat() + "Z"
+        end_date = _parse_date(input_end_date)
 
     if isinstance(location, str):
         location_str = f"*_{location}_*"
@@ -247,58 +629,373 @@ def download_sentinel(location, input_start_date, input_sensor, output_dir,
     if cloud_pcntg is not None:
             query = f"{query:s} AND cloudcoverpercentage:[0 TO {int(cloud_pcntg):d}]"
     if product_type is not None:
-        if product_type is "L2A":
+        if product_type == "L2A":
             query = f"{query:s} AND producttype:S2MSI2Ap"
-        elif product_type is "L1C":
+        elif product_type == "L1C":
             query = f"{query:s} AND producttype:S2MSI1C"
 
-    query = f"{hub_url}{query}"
-    query = f"{query:s}&start=0&rows=100"
-
     # query = "%s%s" % ( hub_url, urllib2.quote(query ) )
-    logging.debug(query)
-    result = do_query(query, user=username, passwd=password)
+    return f"{hub_url}{query}"
+
+
+def _total_results(xml):
+    """Get the total number of matches reported in an OpenSearch page,
+    without parsing the whole document. Returns ``None`` if not reported."""
+    match = TOTAL_RESULTS.search(xml)
+    if match is None:
+        return None
+    return int(match.group(1))
 
-    granules = parse_xml(result)
+
+def search_products(query, user="guest", passwd="guest", rows=100):
+    """A generator that walks over all the pages of results of a query,
+    yielding granules (see ``parse_xml``) as they are parsed. While a page is
+    being parsed (and its granules consumed by the caller), the next page is
+    already being fetched in the background.
+
+    Parameters
+    ------------
+    query: str
+        A query URL without paging parameters (see ``build_query``)
+    user: str
+        The hub username
+    passwd: str
+        The hub password
+    rows: int
+        Number of products per page. The hub caps this at 100.
+    """
+    if not 0 < rows <= MAX_ROWS:
+        raise ValueError("rows must be between 1 and %d" % MAX_ROWS)
+
+    def fetch_page(start):
+        page_query = f"{query:s}&start={start:d}&rows={rows:d}"
+        logging.debug(page_query)
+        return do_query(page_query, user=user, passwd=passwd)
+
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        start = 0
+        page = executor.submit(fetch_page, start)
+        while page is not None:
+            xml = page.result()
+            total = _total_results(xml)
+            start += rows
+            # Only fetch the next page if there's more stuff to get. If the
+            # hub doesn't tell us, keep on going until we get a short page
+            if total is None or start < total:
+                page = executor.submit(fetch_page, start)
+            else:
+                page = None
+            n_granules = 0
+            for granule in iter_granules(xml):
+                n_granules += 1
+                yield granule
+            if total is None and n_granules < rows:
+                if page is not None:
+                    page.cancel()
+                page = None
+
+
+def download_sentinel(location, input_start_date, input_sensor, output_dir,
+                      input_end_date=None, username="guest", password="guest",
+                      cloud_pcntg=None, product_type=None, rows=100,
+                      n_threads=4, max_per_host=None):
+    """Search the Sentinel hub and download all the matching products to
+    ``output_dir``. All the pages of results are traversed, with products
+    being downloaded as soon as they are found. See ``build_query`` for the
+    search parameters, and ``search_products`` for ``rows``.
+
+    Products are downloaded by a pool of ``n_threads`` workers, but never
+    more than ``max_per_host`` at a time from the same host for this account
+    (see ``host_slot``).
+
+    Returns
+    --------
+    A list of granules and a list of the downloaded files, in the order in
+    which the downloads finished.
+    """
+    query = build_query(location, input_start_date, input_sensor,
+                        input_end_date=input_end_date,
+                        cloud_pcntg=cloud_pcntg, product_type=product_type)
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
+    granules = []
     ret_files = []
-    for granule in granules:
-        download_product(granule['link'] + "$value",
-                         os.path.join(output_dir, granule['filename'].replace(
-                             "SAFE", "zip")), user=username, passwd=password)
-        ret_files.append(os.path.join(output_dir,
-                                      granule['filename'].replace(
-                                          "SAFE", "zip")))
+    get_session(pool_size=n_threads)
+    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = {}
+        for granule in search_products(query, user=username, passwd=password,
+                                       rows=rows):
+            target = os.path.join(output_dir,
+                                  granule.filename.replace("SAFE", "zip"))
+            fut = executor.submit(download_product, granule.link + "$value",
+                                  target, user=username, passwd=password,
+                                  max_per_host=max_per_host)
+            pending[fut] = (granule, target)
+        for fut in futures.as_completed(pending):
+            fut.result()
+            granule, target = pending[fut]
+            granules.append(granule)
+            ret_files.append(target)
 
     return granules, ret_files
 
 
-def parse_aws_xml(xml_text, clouds=None):
+def parse_aws_listing(xml_text):
+    """Parse a page of an S3 bucket listing (``ListBucketResult``).
+
+    Returns
+    --------
+    A list of keys, a list of common prefixes, and the continuation token
+    for the next page (``None`` if this was the last page).
+    """
+    root = ET.fromstring(xml_text)
+    keys = []
+    prefixes = []
+    next_token = None
+    truncated = False
+    for elem in root:
+        tag = elem.tag.split("}")[-1]
+        if tag in ["Contents", "CommonPrefixes"]:
+            for child in elem:
+                child_tag = child.tag.split("}")[-1]
+                if child_tag == "Key":
+                    keys.append(child.text)
+                elif child_tag == "Prefix":
+                    prefixes.append(child.text)
+        elif tag == "NextContinuationToken":
+            next_token = elem.text
+        elif tag == "IsTruncated":
+            truncated = elem.text == "true"
+    if not truncated:
+        next_token = None
+    return keys, prefixes, next_token
+
+
+def _listing_ttl(prefix, now=None):
+    """How long a listing of ``prefix`` can be cached for: ``LIVE_TTL`` if
+    new acquisitions can still turn up in it, otherwise ``None`` (the
+    default for the bucket, see ``cache.RESPONSE_TTLS``)."""
+    match = AWS_PREFIX_DATE.match(prefix)
+    if match is None:
+        return LIVE_TTL
+    year, month, day = [int(part) if part else None
+                        for part in match.groups()]
+    # The day after the end of the year, month or day of the prefix
+    if day is not None:
+        end = datetime.date(year, month, day) + datetime.timedelta(days=1)
+    elif month is not None:
+        end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    else:
+        end = datetime.date(year + 1, 1, 1)
+    now = datetime.date.today() if now is None else now
+    if (now - end).days < LIVE_DAYS:
+        return LIVE_TTL
+    return None
+
+
+def list_aws_prefix(prefix, delimiter=None):
+    """List all the keys in the S2 bucket that start with ``prefix``,
+    following continuation tokens.
+
+    Returns
+    --------
+    A list of keys and a list of common prefixes (only if ``delimiter`` is
+    given)
+    """
+    params = {"list-type": 2, "prefix": prefix}
+    if delimiter is not None:
+        params["delimiter"] = delimiter
+    ttl = _listing_ttl(prefix)
+    keys = []
+    prefixes = []
+    while True:
+        r = call_with_retries(
+            lambda: check_response(cached_get(aws_url_dload, params=params,
+                                              ttl=ttl),
+                                   prefix), aws_url_dload)
+        page_keys, page_prefixes, next_token = parse_aws_listing(r.text)
+        keys.extend(page_keys)
+        prefixes.extend(page_prefixes)
+        if next_token is None:
+            return keys, prefixes
+        params["continuation-token"] = next_token
+
+
+def _months(start_date, end_date):
+    """The (year, month) pairs between two dates."""
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        yield year, month
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+
+def scan_aws_tile(mgrs_reference, start_date, end_date=None, n_threads=15):
+    """Find all the acquisitions over a tile in the S2 bucket between two
+    dates. Rather than asking for every single day, the tile is listed one
+    month at a time (all the months at the same time), which only takes one
+    or two requests per month.
 
-    tree = ET.ElementTree(ET.fromstring(xml_text))
-    root = tree.getroot()
-    files_to_get = []
-    for elem in tree.iter():
-        for k in elem.getchildren():
-            if k.tag.find("Key") >= 0:
-                if k.text.find("tiles") >= 0:
-                    files_to_get.append(k.text)
+    Parameters
+    ------------
+    mgrs_reference: str
+        The MGRS tile (e.g. 29TNJ)
+    start_date: datetime
+        The starting date
+    end_date: datetime
+        The end date. If not given, today.
+    n_threads: int
+        Number of months to list at the same time
+    Returns
+    --------
+    A dictionary of acquisition dates, with the keys of the files in the
+    bucket for each date
+    """
+    return scan_aws_tiles([mgrs_reference], start_date, end_date=end_date,
+                          n_threads=n_threads)[mgrs_reference]
+
+
+def scan_aws_tiles(mgrs_references, start_date, end_date=None, n_threads=15):
+    """Like ``scan_aws_tile``, for several tiles at the same time. All the
+    months of all the tiles are listed by the same pool of ``n_threads``.
+
+    Returns
+    --------
+    A dictionary with the acquisitions of each tile (see ``scan_aws_tile``)
+    """
+    if end_date is None:
+        end_date = datetime.datetime.today()
+    jobs = []
+    for mgrs_reference in mgrs_references:
+        utm_code = mgrs_reference[:2].lstrip("0")
+        lat_band = mgrs_reference[2]
+        square = mgrs_reference[3:]
+        front = "tiles/%s/%s/%s/" % (utm_code, lat_band, square)
+        jobs.extend((mgrs_reference, front, front + "%d/%d/" % (year, month))
+                    for year, month in _months(start_date, end_date))
+    acquisitions = {mgrs_reference: {} for mgrs_reference in mgrs_references}
+    get_session(pool_size=n_threads)
+    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        listings = executor.map(list_aws_prefix, [job[2] for job in jobs])
+        for (mgrs_reference, front, _), (keys, _) in zip(jobs, listings):
+            for key in keys:
+                parts = key[len(front):].split("/", 4)
+                # year/month/day/sequence/file. Only the first sequence,
+                # and only the files in it and in qi/ and aux/
+                if len(parts) < 5 or parts[3] != "0":
+                    continue
+                if "/" in parts[4] and not \
+                        parts[4].startswith(AWS_SUBDIRS):
+                    continue
+                this_date = datetime.datetime(int(parts[0]), int(parts[1]),
+                                              int(parts[2]))
+                if start_date <= this_date <= end_date:
+                    acquisitions[mgrs_reference].setdefault(
+                        this_date, []).append(key)
+    return acquisitions
+
+
+def aws_cloud_cover(key):
+    """Get the cloud cover percentage of an acquisition in the S2 bucket,
+    from its ``metadata.xml`` file (given by ``key``). Returns ``None`` if
+    the file doesn't report it."""
+    url = aws_url_dload + key
+    r = call_with_retries(lambda: check_response(get_session().get(url)),
+                          url)
+    root = ET.fromstring(r.content)
+    cloud_cover = root.find(".//CLOUDY_PIXEL_PERCENTAGE")
+    if cloud_cover is None:
+        return None
+    return float(cloud_cover.text)
+
+
+def get_cloud_cover(mgrs_reference, acquisitions, n_threads=15,
+                    cache_file=CLOUD_CACHE):
+    """Get the cloud cover of S2 acquisitions over a tile. The cloud cover
+    of each tile and date is stored in an on-disk cache the first time it is
+    needed, and the ones not in the cache are downloaded concurrently.
+
+    Parameters
+    ------------
+    mgrs_reference: str
+        The MGRS tile (e.g. 29TNJ)
+    acquisitions: dict
+        The acquisitions, as returned by ``scan_aws_tile``
+    n_threads: int
+        Number of metadata files to download at the same time
+    cache_file: str
+        The cache database (see ``cache.open_db``)
+    Returns
+    --------
+    A dictionary with the cloud cover percentage of each date (``None`` if
+    not known). If any metadata file can't be got, the first error is
+    raised once the cloud cover of the others has been stored.
+    """
+    db = open_db(cache_file, CLOUD_CACHE_SCHEMA)
+    try:
+        cloud_cover = {}
+        for the_date, cover in db.execute(
+                "SELECT date, cover FROM cloud_cover WHERE tile = ?",
+                (mgrs_reference,)):
+            the_date = datetime.datetime.strptime(the_date, "%Y-%m-%d")
+            if the_date in acquisitions:
+                cloud_cover[the_date] = cover
+        to_get = {}
+        for the_date, keys in acquisitions.items():
+            if the_date in cloud_cover:
+                continue
+            metadata = [key for key in keys if key.endswith("/metadata.xml")
+                        and key.count("/") == 8]
+            if metadata:
+                to_get[the_date] = metadata[0]
+            else:
+                cloud_cover[the_date] = None
+        if to_get:
+            LOG.info("Getting cloud cover for %d acquisitions" % len(to_get))
+            get_session(pool_size=n_threads)
+            errors = []
+            with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+                covers = {executor.submit(aws_cloud_cover, key): the_date
+                          for the_date, key in to_get.items()}
+                for fut in futures.as_completed(covers):
+                    try:
+                        cloud_cover[covers[fut]] = fut.result()
+                    except Exception as err:
+                        LOG.warning("Couldn't get the cloud cover of %s: %s" %
+                                    (to_get[covers[fut]], err))
+                        errors.append(err)
+            # Keep the ones we got even if some failed, so that only those
+            # are asked for again
+            with db:
+                db.executemany(
+                    "INSERT OR REPLACE INTO cloud_cover VALUES (?, ?, ?)",
+                    [(mgrs_reference, the_date.strftime("%Y-%m-%d"),
+                      cloud_cover[the_date]) for the_date in to_get
+                     if the_date in cloud_cover])
+            if errors:
+                raise errors[0]
+    finally:
+        db.close()
+    return cloud_cover
 
-    if len(files_to_get) > 0 and clouds is not None:
 
-        for fich in files_to_get:
-            if fich.find("metadata.xml") >= 0:
-                metadata_file = aws_url_dload + fich
-                r = requests.get(metadata_file)
-                tree = ET.ElementTree(ET.fromstring(r.text))
-                root = tree.getroot()
-                for cl in root.iter("CLOUDY_PIXEL_PERCENTAGE"):
-                    if float(cl.text) > clouds:
-                        return []
-                    else:
-                        return files_to_get
-    return files_to_get
+def cached_cloud_free(mgrs_reference, start_date, end_date, clouds,
+                      cache_file=CLOUD_CACHE):
+    """Query the cloud cover cache for the dates of the acquisitions over a
+    tile with a cloud cover of at most ``clouds`` percent. Only acquisitions
+    that have been looked at before (see ``get_cloud_cover``) are known."""
+    db = open_db(cache_file, CLOUD_CACHE_SCHEMA)
+    try:
+        rows = db.execute(
+            "SELECT date FROM cloud_cover WHERE tile = ? AND " +
+            "date BETWEEN ? AND ? AND (cover IS NULL OR cover <= ?) " +
+            "ORDER BY date", (mgrs_reference, start_date.strftime("%Y-%m-%d"),
+                              end_date.strftime("%Y-%m-%d"), clouds))
+        return [datetime.datetime.strptime(row[0], "%Y-%m-%d")
+                for row in rows]
+    finally:
+        db.close()
 
 
 def aws_grabber(url, output_dir):
@@ -308,74 +1005,99 @@ def aws_grabber(url, output_dir):
         # Note that in parallel, this can sometimes create a race condition
         # Groan
         os.makedirs(os.path.dirname(output_fname))
-    with open(output_fname, 'wb') as fp:
-        while True:
-            try:
-                r = requests.get(url, stream=True)
-                break
-            except requests.execeptions.ConnectionError:
-                time.sleep (240)
-        for block in r.iter_content(8192):
-            fp.write(block)
+    # Through a ``.partial`` file, so that a file that got cut is not taken
+    # to be there next time, and the download is resumed instead
+    fetch_resumable(get_session().get, url, output_fname, chunk_size=8192,
+                    durability="none")
     logging.debug("Done with %s" % output_fname)
     return output_fname
 
 
+def _interleave(lists):
+    """Take one item of each list in turn."""
+    iterators = [iter(a_list) for a_list in lists]
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+
 def download_sentinel_amazon(start_date, output_dir,
                              tile=None,
                              longitude=None, latitude=None,
                              end_date=None, n_threads=15, just_previews=False,
-                             verbose=False, clouds=None):
-    """A method to download data from the Amazon cloud """
-    # First, we get hold of the MGRS reference...
+                             verbose=False, clouds=None, engine="threads",
+                             max_in_flight=aio.MAX_IN_FLIGHT):
+    """A method to download data from the Amazon cloud. ``tile`` can be a
+    tile or a list of tiles, and ``longitude`` and ``latitude`` can be
+    arrays of points, which get all the tiles they are in (see
+    ``mgrs.latlon_to_s2_tiles``), as tiles overlap. All the tiles are scanned at the same time, and their
+    files go into a single download queue (taking files from each tile in
+    turn), so that a batch of tiles keeps the bandwidth busy all along. The
+    files are downloaded by ``n_threads`` threads, or with
+    ``engine="async"`` by the asyncio engine (see ``aio.download_files``),
+    with up to ``max_in_flight`` files at the same time.
+
+    Returns
+    --------
+    A list of the downloaded files
+    """
+    if engine not in ENGINES:
+        raise ValueError("engine can only be one of %s. You provided %s" %
+                         (", ".join(ENGINES), engine))
+    # First, we get hold of the MGRS references...
     if tile is None:
-        mgrs_reference = get_mgrs(longitude, latitude)
+        # Points near the edge of a tile are in the overlapping ones too
+        tiles = [a_tile for point_tiles in latlon_to_s2_tiles(latitude,
+                                                              longitude)
+                 for a_tile in point_tiles]
+    elif isinstance(tile, str):
+        tiles = [tile]
     else:
-        mgrs_reference = tile
+        tiles = list(tile)
+    tiles = sorted(set(tiles), key=tiles.index)
     if verbose:
-        logging.info(f"We need MGRS reference {mgrs_reference:s}")
-    utm_code = mgrs_reference[:2]
-    lat_band = mgrs_reference[2]
-    square = mgrs_reference[3:]
-    logging.info("Location coordinates: %s" % mgrs_reference)
-
-    front_url = aws_url + "%s/%s/%s" % (utm_code, lat_band, square)
-    this_date = start_date
-    one_day = datetime.timedelta(days=1)
-    files_to_download = []
-    if end_date is None:
-        end_date = datetime.datetime.today()
+        logging.info(f"We need MGRS references {', '.join(tiles):s}")
+    logging.info("Location coordinates: %s" % ", ".join(tiles))
+
     logging.info("Scanning archive...")
+    all_acquisitions = scan_aws_tiles(tiles, start_date, end_date=end_date,
+                                      n_threads=n_threads)
+    if clouds is not None:
+        # Share the threads out between the tiles
+        n_tiles = min(len(tiles), n_threads)
+        get_tile_cover = partial(get_cloud_cover,
+                                 n_threads=max(1, n_threads // n_tiles))
+        with futures.ThreadPoolExecutor(max_workers=n_tiles) as executor:
+            all_cloud_cover = dict(zip(tiles, executor.map(
+                get_tile_cover, tiles,
+                [all_acquisitions[mgrs_reference]
+                 for mgrs_reference in tiles])))
+    tile_files = []
     acqs_to_dload = 0
-    while this_date <= end_date:
-
-        the_url = "{0}{1}".format(front_url, "/{0:d}/{1:d}/{2:d}/0/".format(
-            this_date.year, this_date.month, this_date.day))
-        r = requests.get(the_url)
-        more_files = parse_aws_xml(r.text, clouds=clouds)
-
-        if len(more_files) > 0:
+    for mgrs_reference in tiles:
+        files_to_download = []
+        for this_date, keys in sorted(
+                all_acquisitions[mgrs_reference].items()):
+            if clouds is not None:
+                cloud_cover = all_cloud_cover[mgrs_reference]
+                if cloud_cover[this_date] is not None and \
+                        cloud_cover[this_date] > clouds:
+                    continue
             acqs_to_dload += 1
-            rqi = requests.get(the_url + "qi/")
-            raux = requests.get(the_url + "aux/")
-            qi = parse_aws_xml(rqi.text)
-            aux = parse_aws_xml(raux.text)
-            more_files.extend(qi)
-            more_files.extend(aux)
-            files_to_download.extend(more_files)
-            LOG.info("Will download data for %s..." %
-                     this_date.strftime("%Y/%m/%d"))
-
-        this_date += one_day
+            files_to_download.extend(keys)
+            LOG.info("Will download data for %s on %s..." %
+                     (mgrs_reference, this_date.strftime("%Y/%m/%d")))
+        if just_previews:
+            files_to_download = [fich for fich in files_to_download
+                                 if fich.find("preview") >= 0]
+        tile_files.append(files_to_download)
     logging.info("Will download %d acquisitions" % acqs_to_dload)
-    the_urls = []
-    if just_previews:
-        the_files = []
-        for fich in files_to_download:
-            if fich.find("preview") >= 0:
-                the_files.append(fich)
-        files_to_download = the_files
+    files_to_download = list(_interleave(tile_files))
 
+    the_urls = []
     for fich in files_to_download:
         the_urls.append(aws_url_dload + fich)
         ootput_dir = os.path.dirname(os.path.join(output_dir,
@@ -387,10 +1109,20 @@ def download_sentinel_amazon(start_date, output_dir,
     ok_files = []
     LOG.info("Downloading a grand total of %d files" %
              len(files_to_download))
-    download_granule_patch = partial(aws_grabber, output_dir=output_dir)
-    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-        for fich in executor.map(download_granule_patch, the_urls):
+    if engine == "async":
+        results = aio.download_files(
+            [(url, os.path.join(output_dir, url.split("tiles/")[-1]))
+             for url in the_urls], max_in_flight=max_in_flight)
+    else:
+        download_granule_patch = partial(aws_grabber, output_dir=output_dir)
+        get_session(pool_size=n_threads)
+        results = run_with_requeue(download_granule_patch, the_urls,
+                                   n_threads=n_threads)
+    for url, fich, err in results:
+        if err is None:
             ok_files.append(fich)
+    STATS.report()
+    return ok_files
 
 
 if __name__ == "__main__":    # location = (43.3650, -8.4100)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+HTTP sessions shared by all the downloaders. Going through a session means
+that connections to a host are kept alive and reused, rather than having a
+new TCP (and TLS) handshake for every request, which is what dominates the
+time it takes to get lots of small files (e.g. the bits of an S2 tile from
+AWS). The connection pools are sized to the number of threads using them,
+so that threads don't have to open throwaway connections when the pool runs
+out. Requests made through these sessions keep to the request rate limits
+in ``ratelimit.py``.
+
+Sites that log in through a single sign-on site (e.g. the MODIS archive,
+through the Earthdata login) need a session of their own (an
+``AuthSession``), which only logs in once, keeps the credentials for the
+sign-on site across redirects and reuses the cookies it gets. Hosts that
+have moved for good (e.g. from http to https) are remembered, so that the
+redirect is only followed once (see ``moved_url``).
+"""
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .ratelimit import get_throttle
+
+# Connections kept per host, unless more threads are going to be used
+POOL_SIZE = 16
+# Number of hosts for which connections are kept
+POOL_HOSTS = 16
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+# (scheme, host) to (scheme, host) of the hosts that have moved
+_moved = {}
+_moved_lock = threading.Lock()
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """An adapter that keeps to the request rate limits of each host (see
+    ``ratelimit.set_limit``)."""
+    def send(self, request, **kwargs):
+        get_throttle(request.url).request()
+        return super().send(request, **kwargs)
+
+
+class AuthSession(requests.Session):
+    """A session that logs in through a sign-on site. The credentials
+    (``auth``) are sent again when redirected to one of the ``auth_hosts``
+    (``requests`` drops them when redirected to another host), and only one
+    thread at a time logs in to a host (see ``login_get``), so that the
+    others can use the cookies it gets rather than all logging in."""
+    def __init__(self, auth_hosts=()):
+        super().__init__()
+        self.auth_hosts = set(auth_hosts)
+        self.logged_in = set()
+        self.login_lock = threading.Lock()
+
+    def rebuild_auth(self, prepared_request, response):
+        super().rebuild_auth(prepared_request, response)
+        if self.auth is not None and \
+                urlsplit(prepared_request.url).hostname in self.auth_hosts:
+            prepared_request.prepare_auth(self.auth)
+
+    def login_get(self, url, **kwargs):
+        """Like ``get``, but if we haven't got anything from the host of
+        ``url`` yet, the request is made by one thread at a time. The
+        others wait, and then use the cookies it got. Hosts that have moved
+        are gone to straight away (see ``moved_url``)."""
+        if urlsplit(moved_url(url)).netloc not in self.logged_in:
+            with self.login_lock:
+                requested = moved_url(url)
+                if urlsplit(requested).netloc not in self.logged_in:
+                    r = self.get(requested, **kwargs)
+                    learn_redirects(r)
+                    if r.ok:
+                        # The host we asked, wherever the response came
+                        # from in the end (and where it has moved to, if
+                        # we've just found out)
+                        self.logged_in.add(urlsplit(requested).netloc)
+                        self.logged_in.add(urlsplit(moved_url(url)).netloc)
+                    return r
+        r = self.get(moved_url(url), **kwargs)
+        learn_redirects(r)
+        return r
+
+
+def moved_url(url):
+    """``url`` on the host it has moved to, if a request to its host was
+    permanently redirected to the same path on another one (see
+    ``learn_redirects``)."""
+    parts = urlsplit(url)
+    moved = _moved.get((parts.scheme, parts.netloc))
+    if moved is None:
+        return url
+    return urlunsplit(moved + parts[2:])
+
+
+def learn_redirects(response):
+    """Remember the hosts that have moved for good, from the redirects
+    that were followed to get ``response``."""
+    for hop in response.history:
+        if hop.status_code not in (301, 308):
+            continue
+        old = urlsplit(hop.url)
+        new = urlsplit(hop.headers.get("Location", ""))
+        if new.netloc and (old.scheme, old.netloc) != \
+                (new.scheme, new.netloc) and old[2:] == new[2:]:
+            with _moved_lock:
+                _moved[(old.scheme, old.netloc)] = (new.scheme, new.netloc)
+
+
+def _mount(session, pool_size):
+    adapter = ThrottledAdapter(pool_connections=POOL_HOSTS,
+                               pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+
+def new_session(pool_size=None, auth=None, auth_hosts=None):
+    """Create a session of our own, e.g. for logging in to a site without
+    the cookies leaking to other downloads. The session should be closed
+    when done with it.
+
+    Parameters
+    ------------
+    pool_size: int
+        The number of connections to keep per host, which should be at
+        least the number of threads that will use the session. ``POOL_SIZE``
+        by default.
+    auth: tuple
+        A (username, password) tuple to use in every request
+    auth_hosts: iter
+        The hosts of the sign-on site, if any. The session is then an
+        ``AuthSession``, which sends ``auth`` to them after redirects.
+    Returns
+    --------
+    A ``requests.Session``
+    """
+    if auth_hosts is None:
+        session = requests.Session()
+    else:
+        session = AuthSession(auth_hosts)
+    _mount(session, max(pool_size or 0, POOL_SIZE))
+    if auth is not None:
+        session.auth = auth
+    return session
+
+
+def get_session(pool_size=None):
+    """Get the session shared by the whole process. If ``pool_size`` is
+    larger than the size of the current connection pools, they are replaced
+    with larger ones, so entry points that start ``n_threads`` threads
+    should call this with ``pool_size=n_threads`` before starting them."""
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None:
+            _session = new_session(pool_size)
+            _session_pool_size = max(pool_size or 0, POOL_SIZE)
+        elif pool_size is not None and pool_size > _session_pool_size:
+            _mount(_session, pool_size)
+            _session_pool_size = pool_size
+        return _session
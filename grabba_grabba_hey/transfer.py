@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+"""
+Helpers to stream HTTP responses to disk, shared by the different
+downloaders. Checksums are calculated on the chunks as they are written, so
+files don't need to be read back from disk to be verified. Every transfer
+is reported to the hooks in ``metrics.py``, if there are any. Downloads go
+to a ``.partial`` file first, and are resumed from where they stopped if
+they get interrupted (see ``fetch_resumable``).
+"""
+import hashlib
+import logging
+import os
+import re
+import time
+import zlib
+
+from . import metrics
+from .ratelimit import get_throttle
+from .retry import RetryableError, check_response
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1048576  # 1MiB...
+# Data is written to disk in large blocks, which parallel filesystems like
+# Lustre much prefer to lots of small writes.
+WRITE_BUFFER = 8 * 1048576
+# How hard we try to make sure the data is on disk: "chunk" syncs after
+# every chunk, "close" once the whole file has been written, and "none"
+# leaves it to the OS.
+DURABILITY_MODES = ("chunk", "close", "none")
+DURABILITY = "close"
+CONTENT_RANGE = re.compile(r"bytes (?:\d+-\d+|\*)/(\d+)")
+
+# Bytes with their bits the other way round, so that the (most significant
+# bit first) CRC of ``cksum`` can be calculated with zlib's (least
+# significant bit first) one, which is a lot quicker than doing it in Python
+_REVERSED_BITS = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+_MASK = 0xFFFFFFFF
+
+
+def new_hasher(digest="md5"):
+    """Create a new hasher object. Any object with ``update`` and
+    ``hexdigest`` methods (like the ones in ``hashlib``) will do.
+
+    Parameters
+    ------------
+    digest: str or callable
+        Either the name of a ``hashlib`` algorithm (e.g. ``"md5"`` or
+        ``"sha256"``), a callable that returns a new hasher object, or
+        ``None`` if no checksum is required.
+    Returns
+    --------
+    A hasher object, or ``None``
+    """
+    if digest is None:
+        return None
+    if callable(digest):
+        return digest()
+    return hashlib.new(digest)
+
+
+class Cksum(object):
+    """A hasher for the checksum given by the POSIX ``cksum`` command, which
+    is the one in the XML metadata of MODIS granules. ``hexdigest`` gives
+    it in decimal, the way ``cksum`` (and the metadata) have it."""
+    def __init__(self):
+        self.crc = 0
+        self.length = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(bytes(data).translate(_REVERSED_BITS),
+                              self.crc ^ _MASK) ^ _MASK
+        self.length += len(data)
+
+    def value(self):
+        # The length of the data goes in too, least significant byte first
+        length = self.length
+        tail = bytearray()
+        while length:
+            tail.append(length & 0xFF)
+            length >>= 8
+        crc = zlib.crc32(bytes(tail).translate(_REVERSED_BITS),
+                         self.crc ^ _MASK) ^ _MASK
+        return int("{:032b}".format(crc)[::-1], 2) ^ _MASK
+
+    def hexdigest(self):
+        return str(self.value())
+
+
+def hash_file(fname, hasher, size=None, block_size=CHUNK_SIZE):
+    """Update ``hasher`` with the contents of a file on disk. Only the first
+    ``size`` bytes are used if ``size`` is given. Mostly useful to catch up
+    with the bits of a file that were downloaded earlier.
+
+    Returns
+    --------
+    The hasher object
+    """
+    with open(fname, "rb") as fp:
+        remaining = size
+        while remaining is None or remaining > 0:
+            if remaining is None:
+                block = fp.read(block_size)
+            else:
+                block = fp.read(min(block_size, remaining))
+                remaining -= len(block)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher
+
+
+def checksum_file(fname, digest="md5", block_size=1048576):
+    """The checksum (as given by ``hexdigest``) of a file on disk, with a
+    hasher made by ``new_hasher(digest)``. This can be run in another
+    process (e.g. with ``concurrent.futures.ProcessPoolExecutor``), as long
+    as ``digest`` can be pickled."""
+    return hash_file(fname, new_hasher(digest),
+                     block_size=block_size).hexdigest()
+
+
+def open_target(fname, offset=0, file_size=None, preallocate=False,
+                buffer_size=None):
+    """Open a file to write a download to, with a large write buffer. The
+    file is truncated to ``offset`` bytes (so that a download can be
+    resumed), and the file position left at ``offset``.
+
+    Parameters
+    ------------
+    fname: str
+        The file name
+    offset: int
+        Number of bytes of the file to keep
+    file_size: int
+        The final size of the file, if known
+    preallocate: bool
+        Whether to reserve ``file_size`` bytes on disk up front. This avoids
+        fragmentation, but the file will have its final size even if the
+        download doesn't finish.
+    buffer_size: int
+        The size of the write buffer. ``WRITE_BUFFER`` by default.
+    Returns
+    --------
+    The open file object
+    """
+    if buffer_size is None:
+        buffer_size = WRITE_BUFFER
+    mode = "r+b" if offset > 0 and os.path.exists(fname) else "wb"
+    fp = open(fname, mode, buffering=buffer_size)
+    fp.truncate(offset)
+    fp.seek(offset)
+    if preallocate and file_size is not None and file_size > offset and \
+            hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fp.fileno(), offset, file_size - offset)
+        except OSError as err:
+            LOG.debug("Can't preallocate %s (%s)" % (fname, err))
+    return fp
+
+
+def write_stream(r, fp, hashers=(), chunk_size=CHUNK_SIZE, offset=0,
+                 file_size=None, durability=None):
+    """Write the body of a streamed ``requests`` response to the open file
+    ``fp``, updating each of the ``hashers`` with every chunk as it goes
+    past. Progress is logged every 100 chunks. The bandwidth limits of the
+    host (see ``ratelimit.set_limit``) are kept to, and the transfer is
+    recorded in the metrics (see ``metrics.record``).
+
+    Parameters
+    ------------
+    r: requests.Response
+        A response requested with ``stream=True``
+    fp: file
+        A file opened for writing in binary mode
+    hashers: iter
+        Hasher objects (see ``new_hasher``) to update with the data
+    chunk_size: int
+        The size of the chunks to read from the network
+    offset: int
+        Number of bytes of the file already on disk (when resuming), only
+        used to report progress
+    file_size: int
+        The final size of the file, only used to report progress
+    durability: str
+        One of ``DURABILITY_MODES``, ``DURABILITY`` by default
+    Returns
+    --------
+    The number of bytes written
+    """
+    if durability is None:
+        durability = DURABILITY
+    if durability not in DURABILITY_MODES:
+        raise ValueError("durability has to be one of %s, not %s" %
+                         (", ".join(DURABILITY_MODES), durability))
+    hashers = [hasher for hasher in hashers if hasher is not None]
+    throttle = get_throttle(r.url)
+    measure = metrics.enabled()
+    if measure:
+        t0 = time.monotonic()
+    cntr = 0
+    dload = 0
+    try:
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if chunk:
+                cntr += 1
+                dload += len(chunk)
+                if cntr > 100 and file_size:
+                    LOG.info("\tWriting %d/%d [%5.2f %%]" %
+                             (offset + dload, file_size,
+                              100. * float(offset + dload) / float(file_size)))
+                    cntr = 0
+
+                throttle(len(chunk))
+                fp.write(chunk)
+                if durability == "chunk":
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                for hasher in hashers:
+                    hasher.update(chunk)
+        if durability == "close":
+            fp.flush()
+            os.fsync(fp.fileno())
+    except Exception as err:
+        if measure:
+            _record(r, fp, dload, t0, err)
+        raise
+    if measure:
+        _record(r, fp, dload, t0)
+    return dload
+
+
+def _record(r, fp, n_bytes, t0, error=None):
+    # ``elapsed`` is the time from sending the request to parsing the
+    # headers, the body is read after that
+    ttfb = r.elapsed.total_seconds()
+    metrics.record(r.url, n_bytes, ttfb + time.monotonic() - t0, ttfb=ttfb,
+                   fname=getattr(fp, "name", None), error=error)
+
+
+def fetch_resumable(get, url, fname, hasher=None, chunk_size=CHUNK_SIZE,
+                    durability=None):
+    """Download ``url`` to ``fname``, through ``fname + ".partial"``. If
+    that is already there (from a download that got interrupted), only the
+    rest of the file is asked for with a ``Range`` request, and if the
+    server says there's nothing left, the partial file was complete. If the
+    server doesn't do ranges, the download starts again.
+
+    Parameters
+    ------------
+    get: callable
+        Makes the requests, like ``requests.Session.get``
+    url: str
+        The URL
+    fname: str
+        The file name
+    hasher: object
+        A hasher (see ``new_hasher``) to update with the whole of the file,
+        including the bit that was there already
+    chunk_size: int
+        The size of the chunks to read from the network
+    durability: str
+        See ``write_stream``
+    Returns
+    --------
+    The size of the file. If fewer bytes than the server said come in, a
+    ``RetryableError`` is raised, and the download can be resumed later.
+    """
+    part = fname + ".partial"
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    headers = {"Range": "bytes=%d-" % offset} if offset > 0 else {}
+    r = get(url, stream=True, headers=headers)
+    if offset > 0 and r.status_code == 416:
+        match = CONTENT_RANGE.match(r.headers.get("Content-Range", ""))
+        if match is not None and int(match.group(1)) == offset:
+            LOG.debug("%s was complete" % part)
+            if hasher is not None:
+                hash_file(part, hasher)
+            os.replace(part, fname)
+            return offset
+        LOG.info("%s is larger than %s, starting again" % (part, url))
+        os.remove(part)
+        return fetch_resumable(get, url, fname, hasher=hasher,
+                               chunk_size=chunk_size, durability=durability)
+    check_response(r, url)
+    if offset > 0 and r.status_code != 206:
+        LOG.info("Server doesn't support resuming, starting again")
+        offset = 0
+    file_size = None
+    if "content-length" in r.headers:
+        file_size = offset + int(r.headers["content-length"])
+    if offset > 0:
+        LOG.info("Resuming %s from byte %d" % (fname, offset))
+        if hasher is not None:
+            hash_file(part, hasher, size=offset)
+    with open_target(part, offset=offset, file_size=file_size) as fp:
+        n_bytes = write_stream(r, fp, hashers=[hasher],
+                               chunk_size=chunk_size, offset=offset,
+                               file_size=file_size, durability=durability)
+    if file_size is not None and offset + n_bytes != file_size:
+        raise RetryableError("Only got %d of the %d bytes of %s" %
+                             (offset + n_bytes, file_size, url))
+    os.replace(part, fname)
+    return offset + n_bytes
@@ -2,6 +2,7 @@ from setuptools import setup, find_packages
 
 requires = [
     'futures>=3.0.3',
+    'numpy',
     'requests'
 ]
 
@@ -14,5 +15,6 @@ setup(
     package_dir={'': 'grabba_grabba_hey'},
     packages=find_packages("grabba_grabba_hey"),
     install_requires=requires,
+    extras_require={'async': ['aiohttp']},
     zip_safe=False,
 )
\ No newline at end of file
@@ -0,0 +1,9 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# Keep the caches and the catalogue of the tests away from the real ones
+os.environ["GRABBA_CACHE_DIR"] = tempfile.mkdtemp(prefix="grabba_tests_")
+atexit.register(shutil.rmtree, os.environ["GRABBA_CACHE_DIR"],
+                ignore_errors=True)
@@ -0,0 +1,412 @@
+"""
+A local stand-in for the archives we download from, so that the downloaders
+can be tested (and timed) without a network connection. It emulates the
+bits of the archives that we use:
+
+* The Sentinel hub: OpenSearch search (``/apihub/search``), and OData
+  product ``$value`` (with ``Range`` support) and checksum. Products are
+  added to ``products``.
+* The S2 bucket on AWS: ``ListObjectsV2`` listings of ``files`` (at ``/``,
+  with ``list-type=2``) and the files themselves.
+* The MODIS archive (e4ftl01): Apache directory pages of ``files``, with
+  data behind an Earthdata login (a redirect to ``/oauth/authorize``, which
+  wants the ``earthdata`` credentials, and back with a session cookie).
+* LAADS: plain ``files``.
+* EarthExplorer (Landsat): a login form (a POST to ``/login``), and scenes
+  in ``files``, which can be probed with HEAD requests.
+
+Latency, bandwidth and errors can be set for testing how the downloaders
+cope, and the requests made are counted in ``requests``.
+"""
+import base64
+import hashlib
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+PRODUCT = re.compile(r"/odata/v1/Products\('([^']+)'\)/+(Checksum/Value/)?"
+                     r"\$value$")
+RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+SEARCH_PATH = "/apihub/search"
+AUTHORIZE_PATH = "/oauth/authorize"
+LOGIN_PATH = "/login"
+SESSION_COOKIE = "urs_session=standin"
+S3_NS = "http://s3.amazonaws.com/doc/2006-03-01/"
+BLOCK = 65536
+
+# e4ftl01 directory pages have a header of 19 lines before the entries
+LISTING_HEADER = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html>
+ <head>
+  <title>Index of {0}</title>
+ </head>
+ <body>
+<h1>Index of {0}</h1>
+<pre><img src="/icons/blank.gif" alt="Icon "> <a href="?C=N;O=D">Name</a>
+<hr><img src="/icons/back.gif" alt="[PARENTDIR]"> <a href="/">Parent</a>
+""" + "\n" * 10
+LISTING_DIR = ('<img src="/icons/folder.gif" alt="[DIR]"> '
+               '<a href="{0}/">{0}/</a>  2017-01-03 04:34    -   \n')
+LISTING_FILE = ('<img src="/icons/unknown.gif" alt="[   ]"> '
+                '<a href="{0}">{0}</a>  2017-01-03 04:34  {1}   \n')
+LISTING_FOOTER = "<hr></pre>\n</body></html>\n"
+
+ENTRY = """<entry>
+<title>{name}</title>
+<link href="{url}/odata/v1/Products('{name}')/$value"/>
+<link rel="alternative" href="{url}/odata/v1/Products('{name}')/"/>
+<link rel="icon" href="{url}/odata/v1/Products('{name}')/Products('Quicklook')/$value"/>
+<id>{name}</id>
+<date name="beginposition">2017-01-11T11:23:42.026Z</date>
+<date name="endposition">2017-01-11T11:24:07.025Z</date>
+<int name="orbitnumber">8123</int>
+<str name="filename">{name}.SAFE</str>
+<str name="identifier">{name}</str>
+<str name="producttype">S2MSI1C</str>
+</entry>
+"""
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Whether this is a HEAD request, which gets the headers only
+    head = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, status=200, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.write_body(body)
+
+    def write_body(self, body):
+        if self.head:
+            return
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        for start in range(0, len(body), BLOCK):
+            block = body[start:start + BLOCK]
+            self.wfile.write(block)
+            time.sleep(len(block) / bandwidth)
+
+    def redirect(self, location, headers=None):
+        headers = dict(headers or {}, Location=location)
+        self.send_body(b"", status=302, headers=headers)
+
+    def do_HEAD(self):
+        # The handler is kept for the next request on the connection
+        self.head = True
+        try:
+            self.do_GET()
+        finally:
+            self.head = False
+
+    def do_POST(self):
+        """Only the login form, which sets a session cookie."""
+        self.server.count(self.path)
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path != LOGIN_PATH:
+            self.send_body(b"Not found", status=404)
+            return
+        with self.server._lock:
+            self.server.logins += 1
+        self.send_body(b"", headers={"Set-Cookie": "EROS_SSO=standin"})
+
+    def do_GET(self):
+        self.server.count(self.path)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.moved_to is not None:
+            self.send_body(b"", status=301, headers={
+                "Location": self.server.moved_to + self.path})
+            return
+        status = self.server.error_for(self.path)
+        if status is not None:
+            headers = {}
+            if self.server.retry_after is not None:
+                headers["Retry-After"] = str(self.server.retry_after)
+            self.send_body(b"Busy", status=status, headers=headers)
+            return
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        query = parse_qs(parts.query)
+        if path == SEARCH_PATH:
+            self.send_search(query)
+        elif path == AUTHORIZE_PATH:
+            self.send_authorize(query)
+        elif path == "/" and query.get("list-type") == ["2"]:
+            self.send_s3_listing(query)
+        elif PRODUCT.match(path):
+            self.send_odata(PRODUCT.match(path))
+        elif self.needs_login(path, query):
+            return
+        elif path in self.server.files:
+            self.send_product(path, self.server.files[path])
+        elif self.server.listing(path) is not None:
+            self.send_apache_listing(path)
+        else:
+            self.send_body(b"Not found", status=404)
+
+    def send_odata(self, match):
+        if match.group(1) not in self.server.products:
+            self.send_body(b"Not found", status=404)
+            return
+        data = self.server.products[match.group(1)]
+        if match.group(2):
+            md5 = hashlib.md5(data).hexdigest().upper()
+            self.send_body(md5.encode())
+            return
+        self.send_product(match.group(1), data)
+
+    def send_product(self, name, data):
+        start, end = 0, len(data) - 1
+        status = 200
+        headers = {"Accept-Ranges": "bytes"}
+        the_range = self.headers.get("Range")
+        if the_range is not None and self.server.ranges:
+            start, last = RANGE.match(the_range).groups()
+            start = int(start)
+            if last:
+                end = min(int(last), end)
+            if start >= len(data):
+                self.send_body(b"", status=416, headers={
+                    "Content-Range": "bytes */%d" % len(data)})
+                return
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end,
+                                                           len(data))
+        body = data[start:end + 1]
+        if self.head:
+            self.send_body(body, status=status, headers=headers)
+            return
+        corrupt = self.server.corrupt.pop(name, None)
+        if corrupt is not None and corrupt < len(body):
+            body = body[:corrupt] + bytes([body[corrupt] ^ 0xFF]) + \
+                body[corrupt + 1:]
+        cut = self.server.cut.pop(name, None)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.server.sent(len(body) if cut is None else min(cut, len(body)))
+        if cut is not None:
+            # Drop the connection half way through the body
+            self.wfile.write(body[:cut])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.write_body(body)
+
+    def send_search(self, query):
+        """An OpenSearch page with all the products (the query itself is
+        ignored)."""
+        start = int(query.get("start", ["0"])[0])
+        rows = int(query.get("rows", ["10"])[0])
+        names = sorted(self.server.products)
+        xml = ('<?xml version="1.0" encoding="utf-8"?>' +
+               '<feed xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/"'
+               ' xmlns="http://www.w3.org/2005/Atom">' +
+               "<opensearch:totalResults>%d</opensearch:totalResults>" %
+               len(names) +
+               "".join(ENTRY.format(name=escape(name), url=self.server.url)
+                       for name in names[start:start + rows]) + "</feed>")
+        self.send_body(xml.encode(), headers={
+            "Content-Type": "application/atom+xml"})
+
+    def send_s3_listing(self, query):
+        prefix = query.get("prefix", [""])[0]
+        delimiter = query.get("delimiter", [None])[0]
+        after = query.get("continuation-token", [""])[0]
+        # Keys and common prefixes are listed together, in order
+        entries = set()
+        for path in self.server.files:
+            key = path[1:]
+            if not key.startswith(prefix):
+                continue
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                key = prefix + rest.split(delimiter)[0] + delimiter
+            entries.add(key)
+        entries = [entry for entry in sorted(entries) if entry > after]
+        page = entries[:self.server.max_keys]
+        truncated = len(entries) > len(page)
+        contents = [entry for entry in page if "/" + entry in
+                    self.server.files]
+        prefixes = [entry for entry in page if "/" + entry not in
+                    self.server.files]
+        n_listed = len(page)
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+               '<ListBucketResult xmlns="%s">' % S3_NS,
+               "<Name>sentinel-s2-l1c</Name>",
+               "<Prefix>%s</Prefix>" % escape(prefix),
+               "<KeyCount>%d</KeyCount>" % n_listed,
+               "<MaxKeys>%d</MaxKeys>" % self.server.max_keys,
+               "<IsTruncated>%s</IsTruncated>" % str(truncated).lower()]
+        if truncated:
+            # The token is simply the last entry in the page
+            xml.append("<NextContinuationToken>%s</NextContinuationToken>" %
+                       escape(page[-1]))
+        for key in contents:
+            xml.append("<Contents><Key>%s</Key><Size>%d</Size></Contents>" %
+                       (escape(key), len(self.server.files["/" + key])))
+        for common in prefixes:
+            xml.append("<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>"
+                       % escape(common))
+        xml.append("</ListBucketResult>")
+        self.send_body("".join(xml).encode(), headers={
+            "Content-Type": "application/xml"})
+
+    def send_apache_listing(self, path):
+        dirs, files = self.server.listing(path)
+        html = LISTING_HEADER.format(escape(path))
+        html += "".join(LISTING_DIR.format(escape(name)) for name in dirs)
+        html += "".join(LISTING_FILE.format(escape(name), size)
+                        for name, size in files)
+        html += LISTING_FOOTER
+        self.send_body(html.encode(), headers={"Content-Type": "text/html"})
+
+    def needs_login(self, path, query):
+        """Send files under the ``protected`` paths to the Earthdata login,
+        and set the session cookie when coming back from it. Returns
+        ``True`` if a response has been sent."""
+        if self.server.earthdata is None or \
+                not path.startswith(self.server.protected) or \
+                path not in self.server.files:
+            return False
+        if "code" in query:
+            self.redirect(path, headers={
+                "Set-Cookie": SESSION_COOKIE + "; Path=/"})
+            return True
+        if SESSION_COOKIE in self.headers.get("Cookie", ""):
+            return False
+        self.redirect("%s%s?redirect_uri=%s" % (self.server.url,
+                                                 AUTHORIZE_PATH,
+                                                 quote(path, safe="")))
+        return True
+
+    def send_authorize(self, query):
+        expected = "Basic " + base64.b64encode(
+            ("%s:%s" % self.server.earthdata).encode()).decode()
+        if self.headers.get("Authorization") != expected:
+            self.send_body(b"Unauthorized", status=401, headers={
+                "WWW-Authenticate": 'Basic realm="Earthdata Login"'})
+            return
+        self.server.logins += 1
+        self.redirect("%s%s?code=standin" % (self.server.url,
+                                              query["redirect_uri"][0]))
+
+
+class StandinServer(ThreadingHTTPServer):
+    """A threaded HTTP server on a random local port. Products are added to
+    ``products`` (a dictionary of name to bytes). Faults are injected with
+    ``cut`` (drop the connection after a number of bytes) and ``corrupt``
+    (flip the byte at an offset of the body), both used only once per
+    product (or file path). ``ranges`` can be set to ``False`` to ignore
+    ``Range`` headers. Plain files are added to ``files`` (a dictionary of
+    path to bytes), and are also listed as directories and S3 keys. Setting
+    ``earthdata`` to a (username, password) tuple puts the files under
+    ``protected`` behind a login. If ``moved_to`` is set to the URL of
+    another server, every request is permanently redirected there.
+
+    ``latency`` (in seconds) is added to every request, and ``bandwidth``
+    (in bytes per second) limits every response. ``errors`` maps paths
+    (with the query) to a list of status codes to send (one per request)
+    before working, and ``error_rate`` is the probability of any request
+    getting a 503. Errors come with a ``Retry-After`` header if
+    ``retry_after`` is set. ``bytes_sent`` counts the bytes of products and
+    files sent."""
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandinHandler)
+        self.products = {}
+        self.cut = {}
+        self.corrupt = {}
+        self.ranges = True
+        self.files = {}
+        self.max_keys = 1000
+        self.earthdata = None
+        self.protected = ("/MOLT/", "/MOLA/", "/MOTA/")
+        self.logins = 0
+        self.moved_to = None
+        self.latency = 0.
+        self.bandwidth = None
+        self.errors = {}
+        self.error_rate = 0.
+        self.retry_after = None
+        self.requests = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._random = random.Random(42)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    @property
+    def host(self):
+        return "127.0.0.1:%d" % self.server_address[1]
+
+    @property
+    def total_requests(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def sent(self, n_bytes):
+        with self._lock:
+            self.bytes_sent += n_bytes
+
+    def product_url(self, name):
+        return "%s/odata/v1/Products('%s')/$value" % (self.url, name)
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def error_for(self, path):
+        with self._lock:
+            if self.errors.get(path):
+                return self.errors[path].pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 503
+        return None
+
+    def listing(self, path):
+        """The directories and (name, size) of the files in a directory of
+        ``files``, or ``None`` if there's no such directory."""
+        prefix = path.rstrip("/") + "/"
+        dirs = set()
+        files = []
+        for fname, data in self.files.items():
+            if fname.startswith(prefix):
+                rest = fname[len(prefix):]
+                if "/" in rest:
+                    dirs.add(rest.split("/")[0])
+                else:
+                    files.append((rest, len(data)))
+        if not dirs and not files:
+            return None
+        return sorted(dirs), sorted(files)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, skipIf
+
+from grabba_grabba_hey import aio, metrics
+from grabba_grabba_hey.retry import RetryPolicy
+
+from .standin import StandinServer
+
+
+@skipIf(aio.aiohttp is None, "aiohttp not installed")
+class TestAsyncEngine(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_download_files(self):
+        with StandinServer() as server:
+            server.latency = 0.05
+            for i in range(60):
+                server.files["/tiles/B%02d.jp2" % i] = os.urandom(1000 + i)
+            jobs = [(server.url + path,
+                     os.path.join(self.tmp, path.split("/")[-1]))
+                    for path in server.files]
+            jobs.append((server.url + "/tiles/missing.jp2",
+                         os.path.join(self.tmp, "missing.jp2")))
+            done = []
+            results = aio.download_files(
+                jobs, max_in_flight=30,
+                on_done=lambda url, fname, n: done.append(n))
+            self.assertEqual(len(results), 61)
+            failed = [url for url, fname, err in results if err is not None]
+            self.assertEqual(failed, [server.url + "/tiles/missing.jp2"])
+            for path, data in server.files.items():
+                with open(os.path.join(self.tmp, path.split("/")[-1]),
+                          "rb") as fp:
+                    self.assertEqual(fp.read(), data)
+            self.assertEqual(sorted(done), list(range(1000, 1060)))
+            self.assertFalse(os.path.exists(
+                os.path.join(self.tmp, "missing.jp2")))
+
+    def test_queue_wait(self):
+        transfers = []
+        metrics.add_hook(transfers.append)
+        self.addCleanup(metrics.disable)
+        with StandinServer() as server:
+            server.latency = 0.05
+            for i in range(4):
+                server.files["/tiles/B%02d.jp2" % i] = b"."
+            server.errors["/tiles/B03.jp2"] = [503]
+            server.retry_after = 0
+
+            def jobs():
+                for path in sorted(server.files):
+                    yield (server.url + path,
+                           os.path.join(self.tmp, path.split("/")[-1]))
+
+            aio.download_files(jobs(), max_in_flight=1,
+                               policy=RetryPolicy(base_wait=0))
+        self.assertEqual(len(transfers), 5)
+        # The jobs only came up as the worker was ready for them, and the
+        # retry went straight back to the worker
+        for transfer in transfers:
+            self.assertLess(transfer.queue_wait, 0.04)
@@ -0,0 +1,61 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from grabba_grabba_hey.catalogue import Catalogue
+from grabba_grabba_hey.modis_downloader import required_files
+
+
+class TestCatalogue(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.catalogue = Catalogue(os.path.join(self.tmp.name, "cat.sqlite"))
+        self.addCleanup(self.catalogue.close)
+
+    def touch(self, name, size=10):
+        fname = os.path.join(self.tmp.name, name)
+        with open(fname, "wb") as fp:
+            fp.write(b"x" * size)
+        return fname
+
+    def test_add_and_check(self):
+        fname = self.touch("a.hdf")
+        self.catalogue.add("a.hdf", fname, "modis", checksum="abc")
+        self.assertTrue(self.catalogue.has("a.hdf"))
+        self.assertFalse(self.catalogue.has("a.hdf", path="/elsewhere/a.hdf"))
+        self.assertEqual(self.catalogue.get("a.hdf").size, 10)
+        self.assertEqual([p.product_id
+                          for p in self.catalogue.products("modis")],
+                         ["a.hdf"])
+        # A file that has changed doesn't count as acquired
+        self.touch("a.hdf", size=5)
+        self.assertFalse(self.catalogue.has("a.hdf"))
+        self.assertTrue(self.catalogue.has("a.hdf", check_file=False))
+
+    def test_required_files(self):
+        self.catalogue.add("a.hdf", self.touch("a.hdf"), "modis")
+        self.touch("b.hdf")
+        urls = ["http://e4ftl01/%s.hdf" % name for name in "abc"]
+        self.assertEqual(required_files(urls, self.tmp.name,
+                                        catalogue=self.catalogue),
+                         ["http://e4ftl01/b.hdf", "http://e4ftl01/c.hdf"])
+        # Files found on disk aren't trusted until they've been checked
+        self.assertEqual(self.catalogue.known(["a.hdf", "b.hdf", "c.hdf"]),
+                         {"a.hdf"})
+
+    def test_known_elsewhere(self):
+        other = tempfile.TemporaryDirectory()
+        self.addCleanup(other.cleanup)
+        fname = os.path.join(other.name, "a.hdf")
+        with open(fname, "wb") as fp:
+            fp.write(b"x")
+        self.catalogue.add("a.hdf", fname, "modis")
+        self.assertEqual(self.catalogue.known(["a.hdf"]), {"a.hdf"})
+        self.assertEqual(self.catalogue.known(["a.hdf"],
+                                              directory=self.tmp.name), set())
+        # So it's downloaded again to where it's wanted
+        self.assertEqual(required_files(["http://e4ftl01/a.hdf"],
+                                        self.tmp.name,
+                                        catalogue=self.catalogue),
+                         ["http://e4ftl01/a.hdf"])
@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent import futures
+from unittest import TestCase, mock
+
+import requests
+
+from grabba_grabba_hey import sentinel_downloader
+from grabba_grabba_hey.sessions import new_session
+
+from .standin import StandinServer
+
+
+class TestDownloadProduct(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmp_dir, "S2A_PRODUCT.zip")
+        self.data = os.urandom(10 * 1024 + 123)
+        patches = [mock.patch.object(sentinel_downloader, "CHUNK_SIZE", 512),
+                   mock.patch.object(sentinel_downloader, "BLOCK_SIZE", 1024),
+                   mock.patch.object(sentinel_downloader, "RETRY_WAIT", 0)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def download(self, server, **kwargs):
+        sentinel_downloader.download_product(
+            server.product_url("S2A_PRODUCT"), self.target, **kwargs)
+        with open(self.target, "rb") as fp:
+            self.assertEqual(fp.read(), self.data)
+        self.assertFalse(os.path.exists(self.target + ".part"))
+        self.assertFalse(os.path.exists(self.target + ".part.blocks"))
+
+    def test_download(self):
+        with StandinServer() as server:
+            server.products["S2A_PRODUCT"] = self.data
+            self.download(server)
+
+    def test_resume_after_interruption(self):
+        with StandinServer() as server:
+            server.products["S2A_PRODUCT"] = self.data
+            server.cut["S2A_PRODUCT"] = 5000
+            session = new_session()
+            self.addCleanup(session.close)
+            with mock.patch.object(session, "get", wraps=session.get) as get, \
+                    mock.patch.object(sentinel_downloader, "get_session",
+                                      return_value=session):
+                self.download(server)
+            ranges = [call[1]["headers"].get("Range")
+                      for call in get.call_args_list if "headers" in call[1]]
+            # Resumed from the last complete block before the cut
+            self.assertEqual(ranges, [None, "bytes=4096-"])
+
+    def test_repair_bad_blocks(self):
+        with StandinServer() as server:
+            server.products["S2A_PRODUCT"] = self.data
+            sentinel_downloader._fetch_part(server.product_url("S2A_PRODUCT"),
+                                            self.target + ".part")
+            # Corrupt a block on disk
+            with open(self.target + ".part", "r+b") as fp:
+                fp.seek(3000)
+                fp.write(b"\x00" * 10)
+            self.download(server)
+            product = "/odata/v1/Products('S2A_PRODUCT')/$value"
+            # The first download, the tail of the file when resuming, and
+            # then the bad block and the tail again
+            self.assertEqual(server.requests[product], 4)
+
+    def test_repair_interrupted(self):
+        with StandinServer() as server:
+            server.products["S2A_PRODUCT"] = self.data
+            sentinel_downloader._fetch_part(server.product_url("S2A_PRODUCT"),
+                                            self.target + ".part")
+            with open(self.target + ".part", "r+b") as fp:
+                fp.seek(3000)
+                fp.write(b"\x00" * 10)
+            session = new_session()
+            self.addCleanup(session.close)
+            ranges = []
+
+            def get(url, **kwargs):
+                if "Range" in kwargs.get("headers", {}):
+                    ranges.append(kwargs["headers"]["Range"])
+                    # The connection drops while repairing the bad block
+                    if len(ranges) == 2:
+                        raise requests.exceptions.ConnectionError("Dropped")
+                return session.get(url, **kwargs)
+
+            with mock.patch.object(sentinel_downloader, "get_session",
+                                   return_value=mock.Mock(get=get)):
+                self.download(server)
+            # The repair is tried again on the next attempt
+            self.assertEqual(ranges, ["bytes=10240-", "bytes=2048-3071"] * 2 +
+                             ["bytes=10240-10362"])
+
+    def test_no_range_support(self):
+        with StandinServer() as server:
+            server.products["S2A_PRODUCT"] = self.data
+            server.cut["S2A_PRODUCT"] = 5000
+            server.ranges = False
+            self.download(server)
+
+    def test_gives_up(self):
+        with StandinServer() as server:
+            server.products["S2A_PRODUCT"] = self.data
+            server.corrupt["S2A_PRODUCT"] = 10
+            with self.assertRaises(IOError):
+                sentinel_downloader.download_product(
+                    server.product_url("S2A_PRODUCT"), self.target,
+                    max_retries=0)
+            self.assertFalse(os.path.exists(self.target))
+
+    def test_checksum_errors(self):
+        checksum = "/odata/v1/Products('S2A_PRODUCT')//Checksum/Value/$value"
+        product = "/odata/v1/Products('S2A_PRODUCT')/$value"
+        with StandinServer() as server:
+            server.products["S2A_PRODUCT"] = self.data
+            server.retry_after = 0
+            # Busy servers are retried
+            server.errors[checksum] = [503]
+            self.download(server)
+            os.remove(self.target)
+            # Other errors don't get taken for the checksum, and the product
+            # isn't downloaded
+            server.errors[checksum] = [401]
+            n_requests = server.requests[product]
+            with self.assertRaises(IOError):
+                sentinel_downloader.download_product(
+                    server.product_url("S2A_PRODUCT"), self.target)
+            self.assertEqual(server.requests[product], n_requests)
+
+    def test_host_slots(self):
+        url = "https://slots.example.com/odata/v1/Products('S2A')/$value"
+        running = []
+        most = []
+        lock = threading.Lock()
+
+        def download(limit):
+            with sentinel_downloader.host_slot(url, user="me", limit=limit):
+                with lock:
+                    running.append(1)
+                    most.append(len(running))
+                time.sleep(0.01)
+                with lock:
+                    running.pop()
+
+        with futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(download, [2] * 40))
+        self.assertEqual(max(most), 2)
+        # Another limit takes over from the old one for all the downloads
+        del most[:]
+        with futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(download, [3] * 40))
+        self.assertEqual(max(most), 3)
+        self.assertIs(sentinel_downloader.host_slot(url, user="me"),
+                      sentinel_downloader.host_slot(url, user="me", limit=2))
@@ -0,0 +1,107 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from grabba_grabba_hey import sentinel_downloader
+
+from .standin import StandinServer
+
+FILES = ["B01.jp2", "B02.jp2", "metadata.xml", "qi/MSK_CLOUDS_B00.gml"]
+
+
+class TestDownloadSentinelAmazon(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def run_batch(self, server, **kwargs):
+        with mock.patch.object(sentinel_downloader, "aws_url_dload",
+                               server.url + "/"):
+            return sentinel_downloader.download_sentinel_amazon(
+                datetime.datetime(2017, 1, 1), self.tmp,
+                end_date=datetime.datetime(2017, 2, 28), **kwargs)
+
+    def test_batch_of_tiles(self):
+        with StandinServer() as server:
+            server.max_keys = 3
+            for tile in ["29/T/NJ", "29/T/NH", "30/S/WJ"]:
+                for day in ["2017/1/3", "2017/2/12"]:
+                    for fname in FILES:
+                        path = "/tiles/%s/%s/0/%s" % (tile, day, fname)
+                        server.files[path] = path.encode()
+            # A file that gets cut is downloaded again
+            server.cut["/tiles/29/T/NH/2017/2/12/0/B02.jp2"] = 10
+            # Points are looked up as all the tiles they are in (29TNH and
+            # 29TNJ, as the first one is near the edge, and 30SWJ)
+            files = self.run_batch(server, tile=None, longitude=[-8.41, -2.1],
+                                   latitude=[43.3, 39.1])
+            self.assertEqual(len(files), 24)
+            # A tile given twice is only done once
+            files = self.run_batch(server, tile=["29TNJ", "29TNH", "29TNJ"],
+                                   n_threads=1)
+            self.assertEqual(len(files), 16)
+        # Files from each tile are taken in turn
+        self.assertEqual([os.path.relpath(f, self.tmp).split("/")[2]
+                          for f in files[:4]],
+                         ["NJ", "NH", "NJ", "NH"])
+        fname = os.path.join(self.tmp, "29/T/NH/2017/2/12/0/qi/" +
+                             "MSK_CLOUDS_B00.gml")
+        with open(fname, "rb") as fp:
+            self.assertEqual(fp.read(), b"/tiles/29/T/NH/2017/2/12/0/qi/" +
+                             b"MSK_CLOUDS_B00.gml")
+        fname = os.path.join(self.tmp, "29/T/NH/2017/2/12/0/B02.jp2")
+        with open(fname, "rb") as fp:
+            self.assertEqual(fp.read(), b"/tiles/29/T/NH/2017/2/12/0/B02.jp2")
+        for path, dirs, fnames in os.walk(self.tmp):
+            self.assertEqual([fname for fname in fnames
+                              if fname.endswith(".partial")], [])
+
+    def test_listing_pages(self):
+        with StandinServer() as server:
+            server.max_keys = 2
+            for key in ["a/1/x", "a/1/y", "a/2/x", "a/3", "b/1"]:
+                server.files["/" + key] = b"."
+            with mock.patch.object(sentinel_downloader, "aws_url_dload",
+                                   server.url + "/"):
+                self.assertEqual(sentinel_downloader.list_aws_prefix("a/"),
+                                 (["a/1/x", "a/1/y", "a/2/x", "a/3"], []))
+                self.assertEqual(
+                    sentinel_downloader.list_aws_prefix("a/", delimiter="/"),
+                    (["a/3"], ["a/1/", "a/2/"]))
+            self.assertEqual(server.total_requests, 4)
+
+    def test_live_listings(self):
+        now = datetime.date(2017, 2, 3)
+        ttl = sentinel_downloader._listing_ttl
+        # New acquisitions can still turn up in these
+        for prefix in ["tiles/29/T/NJ/", "tiles/29/T/NJ/2017/",
+                       "tiles/29/T/NJ/2017/1/", "tiles/29/T/NJ/2017/2/1/0/"]:
+            self.assertEqual(ttl(prefix, now), sentinel_downloader.LIVE_TTL)
+        for prefix in ["tiles/29/T/NJ/2016/", "tiles/29/T/NJ/2016/12/",
+                       "tiles/29/T/NJ/2017/1/5/"]:
+            self.assertIsNone(ttl(prefix, now))
+
+    def test_cloud_cover_errors(self):
+        cache_file = os.path.join(self.tmp, "clouds.sqlite")
+        metadata = "tiles/29/T/NJ/2017/1/%d/0/metadata.xml"
+        acquisitions = {datetime.datetime(2017, 1, day): [metadata % day]
+                        for day in (3, 13, 23)}
+        with StandinServer() as server:
+            for day in (3, 13, 23):
+                server.files["/" + metadata % day] = (
+                    b"<a><CLOUDY_PIXEL_PERCENTAGE>%d" % day +
+                    b"</CLOUDY_PIXEL_PERCENTAGE></a>")
+            server.errors["/" + metadata % 13] = [403]
+            with mock.patch.object(sentinel_downloader, "aws_url_dload",
+                                   server.url + "/"):
+                with self.assertRaises(IOError):
+                    sentinel_downloader.get_cloud_cover(
+                        "29TNJ", acquisitions, cache_file=cache_file)
+                # The others were kept, so only the failed one is asked for
+                n_requests = server.total_requests
+                cloud_cover = sentinel_downloader.get_cloud_cover(
+                    "29TNJ", acquisitions, cache_file=cache_file)
+            self.assertEqual(server.total_requests, n_requests + 1)
+        self.assertEqual(sorted(cloud_cover.values()), [3., 13., 23.])
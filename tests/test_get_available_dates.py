@@ -1,6 +1,306 @@
-from unittest import TestCase
+import datetime
+import os
+import shutil
+import tempfile
+from concurrent import futures
+from unittest import TestCase, mock
+
+from grabba_grabba_hey import modis_downloader, sessions
+from grabba_grabba_hey.cache import get_response_cache
+from grabba_grabba_hey.catalogue import Catalogue
+from grabba_grabba_hey.modis_index import (DateIndex, GranuleIndex,
+                                           parse_listing)
+from grabba_grabba_hey.retry import RETRYABLE_ERRORS
+from grabba_grabba_hey.transfer import Cksum
+
+from .standin import StandinServer
+
+GRANULE = "MOD09GA.A%s.%s.006.2017003043436.hdf"
+SIDECAR = """<?xml version="1.0" encoding="UTF-8"?>
+<GranuleMetaDataFile><GranuleURMetaData><DataFiles><DataFileContainer>
+<DistributedFileName>%s</DistributedFileName><FileSize>%d</FileSize>
+<ChecksumType>CKSUM</ChecksumType><Checksum>%s</Checksum>
+</DataFileContainer></DataFiles></GranuleURMetaData></GranuleMetaDataFile>"""
+
+
+def sidecar(fname, data):
+    cksum = Cksum()
+    cksum.update(data)
+    return (SIDECAR % (fname, len(data), cksum.hexdigest())).encode()
+
+
+def add_granules(server, dates, tiles, size=None):
+    for the_date in dates:
+        for tile in tiles:
+            fname = GRANULE % (the_date.strftime("%Y%j"), tile)
+            path = "/MOLT/MOD09GA.006/%s/%s" % (
+                the_date.strftime("%Y.%m.%d"), fname)
+            data = fname.encode() if size is None else os.urandom(size)
+            server.files[path] = data
+            server.files[path + ".xml"] = sidecar(fname, data)
+            server.files["/MOLT/MOD09GA.006/%s/BROWSE.%s.1.jpg" % (
+                the_date.strftime("%Y.%m.%d"), fname)] = b"jpg"
 
 
 class TestGet_available_dates(TestCase):
+    def setUp(self):
+        self.dates = [datetime.datetime(2017, 1, 1) +
+                      datetime.timedelta(days=i) for i in range(10)]
+
     def test_get_available_dates(self):
-        self.fail()
+        with StandinServer() as server:
+            add_granules(server, self.dates, ["h17v04"])
+            url = server.url + "/MOLT/MOD09GA.006"
+            dates = modis_downloader.get_available_dates(
+                url, datetime.datetime(2017, 1, 3),
+                datetime.datetime(2017, 1, 5))
+        self.assertEqual(dates, [url + "/2017.01.03", url + "/2017.01.04",
+                                 url + "/2017.01.05"])
+
+    def test_parse_listing(self):
+        html = """<html><body><h1>Index of /MOLT</h1><pre>
+<a href="?C=N;O=D">Name</a> <a href="?C=M;O=A">Last modified</a>
+<hr><a href="/">Parent Directory</a>
+<a href="2017.01.01/">2017.01.01/</a>  2017-01-03 04:34    -
+<a href=2017.01.02/>2017.01.02/</a>  2017-01-03 04:34    -
+<a href="MOD09GA.A2017001.h17v04.006.2017003043436.hdf">MOD...</a>
+<a href="http://example.com/">elsewhere</a></pre></body></html>"""
+        self.assertEqual(parse_listing(html), (
+            ["2017.01.01", "2017.01.02"],
+            ["MOD09GA.A2017001.h17v04.006.2017003043436.hdf"]))
+
+    def test_date_index(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        index = DateIndex(os.path.join(tmp, "dates.sqlite"))
+        self.addCleanup(index.close)
+        with StandinServer() as server:
+            add_granules(server, self.dates[:5], ["h17v04"])
+            url = server.url + "/MOLT/MOD09GA.006"
+            dates = modis_downloader.get_available_dates(
+                url, self.dates[0], self.dates[9], index=index)
+            self.assertEqual(len(dates), 5)
+            self.assertEqual(index.last_date(url), "2017.01.05")
+            # Dates up to the last one seen come from the index
+            n_requests = server.total_requests
+            dates = modis_downloader.get_available_dates(
+                url, self.dates[1], self.dates[3], index=index)
+            self.assertEqual(dates, [url + "/2017.01.02", url + "/2017.01.03",
+                                     url + "/2017.01.04"])
+            self.assertEqual(server.total_requests, n_requests)
+            # Later dates are added as they turn up
+            add_granules(server, self.dates[5:], ["h17v04"])
+            get_response_cache().clear()
+            dates = modis_downloader.get_available_dates(
+                url, self.dates[4], self.dates[9], index=index)
+            self.assertEqual(dates, [url + "/" + the_date.strftime("%Y.%m.%d")
+                                     for the_date in self.dates[4:]])
+            self.assertEqual(index.last_date(url), "2017.01.10")
+
+    def test_granule_index(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        index = GranuleIndex(os.path.join(tmp, "granules.sqlite"))
+        self.addCleanup(index.close)
+        today = datetime.datetime.now()
+        with StandinServer() as server:
+            add_granules(server, self.dates[:1] + [today],
+                         ["h17v04", "h17v05", "h18v04"])
+            urls = [server.url + "/MOLT/MOD09GA.006/" +
+                    the_date.strftime("%Y.%m.%d")
+                    for the_date in (self.dates[0], today)]
+            for url in urls:
+                modis_downloader.download_granule_list(url, "h17v04",
+                                                       index=index)
+            granules = index.granules(urls[0], ["h18v04", "h17v04"])
+            fname = GRANULE % ("2017001", "h17v04")
+            self.assertEqual([granule.tile for granule in granules],
+                             ["h17v04", "h18v04"])
+            self.assertEqual(granules[0].url, urls[0] + "/" + fname)
+            self.assertEqual(granules[0].size, len(fname))
+            self.assertEqual(granules[0].xml_url, granules[0].url + ".xml")
+            # Only today's directory can still change
+            self.assertEqual(index.unlisted(urls), urls[1:])
+            n_requests = server.total_requests
+            self.assertEqual(
+                modis_downloader.download_granule_list(
+                    urls[0], ["h17v05"], index=index),
+                [urls[0] + "/" + GRANULE % ("2017001", "h17v05")])
+            self.assertEqual(server.total_requests, n_requests)
+
+    def test_one_request_per_granule(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.addCleanup(sessions._moved.clear)
+        catalogue = Catalogue(os.path.join(tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        with StandinServer() as server, StandinServer() as old_server, \
+                sessions.new_session(auth=("user", "secret"),
+                            auth_hosts=["127.0.0.1"]) as session:
+            server.earthdata = ("user", "secret")
+            old_server.moved_to = server.url
+            add_granules(server, self.dates, ["h17v04"])
+            urls = [old_server.url + path for path in sorted(server.files)
+                    if path.endswith(".hdf")]
+            with futures.ThreadPoolExecutor(max_workers=4) as executor:
+                fnames = list(executor.map(
+                    lambda url: modis_downloader.download_granules(
+                        url, session, "user", "secret", tmp,
+                        catalogue=catalogue), urls))
+            self.assertEqual(len(fnames), 10)
+            self.assertEqual(server.logins, 1)
+            # The login takes three requests, and the move is only followed
+            # the first time
+            self.assertEqual(server.total_requests, 10 + 3)
+            self.assertEqual(old_server.total_requests, 1)
+
+    def test_get_modis_data(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        catalogue = Catalogue(os.path.join(tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        with StandinServer() as server, \
+                mock.patch.object(modis_downloader, "BASE_URL",
+                                  server.url + "/"):
+            server.earthdata = ("user", "secret")
+            add_granules(server, self.dates, ["h17v04", "h18v04"])
+            for ordered, dates in ((True, self.dates[2:5]),
+                                   (False, self.dates[5:8])):
+                files = modis_downloader.get_modis_data(
+                    "user", "secret", "MOLT", "MOD09GA.006", ["h17v04"],
+                    tmp, dates[0], end_date=dates[-1],
+                    n_threads=3, catalogue=catalogue, ordered=ordered,
+                    queue_size=1)
+                self.assertEqual(sorted(os.path.basename(fname)
+                                        for fname in files),
+                                 [GRANULE % (the_date.strftime("%Y%j"),
+                                             "h17v04")
+                                  for the_date in dates])
+            # Everything is there already
+            self.assertEqual(modis_downloader.get_modis_data(
+                "user", "secret", "MOLT", "MOD09GA.006", ["h17v04"],
+                tmp, self.dates[2], end_date=self.dates[7],
+                n_threads=3, catalogue=catalogue, ordered=False), [])
+
+    def test_listing_fails(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        catalogue = Catalogue(os.path.join(tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        with StandinServer() as server, \
+                mock.patch.object(modis_downloader, "BASE_URL",
+                                  server.url + "/"):
+            add_granules(server, self.dates, ["h17v04"])
+            server.errors["/MOLT/MOD09GA.006/2017.01.04"] = [403]
+            with self.assertRaises(IOError):
+                modis_downloader.get_modis_data(
+                    "user", "secret", "MOLT", "MOD09GA.006", ["h17v04"],
+                    tmp, self.dates[0], end_date=self.dates[7],
+                    n_threads=2, catalogue=catalogue, queue_size=1)
+
+    def test_missing_product(self):
+        with StandinServer() as server:
+            with self.assertRaises(modis_downloader.WebError):
+                modis_downloader.get_available_dates(
+                    server.url + "/MOLT/MOD09GA.005",
+                    datetime.datetime(2017, 1, 3))
+
+    def test_granules_behind_login(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        catalogue = Catalogue(os.path.join(tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        with StandinServer() as server, \
+                sessions.new_session(auth=("user", "secret")) as session:
+            server.earthdata = ("user", "secret")
+            add_granules(server, self.dates[:1], ["h17v04", "h18v04"])
+            url = server.url + "/MOLT/MOD09GA.006/2017.01.01"
+            granules = modis_downloader.download_granule_list(url, "h17v04")
+            fname = GRANULE % ("2017001", "h17v04")
+            self.assertEqual(granules, [url + "/" + fname])
+            output = modis_downloader.download_granules(
+                granules[0], session, "user", "secret", tmp,
+                catalogue=catalogue)
+            self.assertEqual(server.logins, 1)
+        with open(output, "rb") as fp:
+            self.assertEqual(fp.read(), fname.encode())
+        self.assertTrue(catalogue.has(fname))
+
+    def test_cksum(self):
+        # As given by ``printf 'hello\n' | cksum``
+        cksum = Cksum()
+        cksum.update(b"hel")
+        cksum.update(b"lo\n")
+        self.assertEqual(cksum.hexdigest(), "3015617425")
+        self.assertEqual(modis_downloader.parse_sidecar(
+            sidecar("a.hdf", b"hello\n"), "a.hdf"), (6, "3015617425"))
+
+    def test_resume_granule(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        catalogue = Catalogue(os.path.join(tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        with StandinServer() as server, \
+                sessions.new_session(auth=("user", "secret")) as session:
+            server.earthdata = ("user", "secret")
+            add_granules(server, self.dates[:1], ["h17v04"], size=100000)
+            path = [path for path in server.files if path.endswith(".hdf")][0]
+            # Past the first chunk, which is all that is kept
+            server.cut[path] = 70000
+            url = server.url + path
+            fname = os.path.join(tmp, url.split("/")[-1])
+            with self.assertRaises(RETRYABLE_ERRORS):
+                modis_downloader.download_granules(
+                    url, session, "user", "secret", tmp, catalogue=catalogue)
+            self.assertEqual(os.path.getsize(fname + ".partial"), 65536)
+            # Only the rest of the file is downloaded the second time, and
+            # the whole of it is checked against the metadata
+            server.corrupt[path] = 10000
+            with self.assertRaises(modis_downloader.RetryableError):
+                modis_downloader.download_granules(
+                    url, session, "user", "secret", tmp, catalogue=catalogue)
+            self.assertFalse(os.path.exists(fname))
+            modis_downloader.download_granules(
+                url, session, "user", "secret", tmp, catalogue=catalogue)
+            with open(fname, "rb") as fp:
+                self.assertEqual(fp.read(), server.files[path])
+        self.assertTrue(catalogue.has(os.path.basename(fname)))
+
+    def test_verify_granules(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        catalogue = Catalogue(os.path.join(tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        with StandinServer() as server, \
+                mock.patch.object(modis_downloader, "BASE_URL",
+                                  server.url + "/"):
+            server.earthdata = ("user", "secret")
+            add_granules(server, self.dates[:3], ["h17v04"], size=10000)
+            paths = sorted(path for path in server.files
+                           if path.endswith(".hdf"))
+            good, short, bad = [os.path.join(tmp, path.split("/")[-1])
+                                for path in paths]
+            with open(good, "wb") as fp:
+                fp.write(server.files[paths[0]])
+            with open(short, "wb") as fp:
+                fp.write(server.files[paths[1]][:5000])
+            with open(bad, "wb") as fp:
+                fp.write(b"x" + server.files[paths[2]][1:])
+            urls = [server.url + path for path in paths]
+            with sessions.new_session(auth=("user", "secret")) as session:
+                checked = dict(modis_downloader.verify_granules(
+                    urls, tmp, session, n_procs=2, catalogue=catalogue))
+            self.assertEqual(checked, dict(zip(urls, [True, False, False])))
+            self.assertTrue(catalogue.has(os.path.basename(good)))
+            self.assertTrue(os.path.exists(short + ".partial"))
+            self.assertFalse(os.path.exists(bad))
+            # Only what is missing is downloaded
+            catalogue.remove(os.path.basename(good))
+            files = modis_downloader.get_modis_data(
+                "user", "secret", "MOLT", "MOD09GA.006", ["h17v04"],
+                tmp, self.dates[0], end_date=self.dates[2],
+                catalogue=catalogue)
+            self.assertEqual(sorted(files), [short, bad])
+            for path, fname in zip(paths, (good, short, bad)):
+                with open(fname, "rb") as fp:
+                    self.assertEqual(fp.read(), server.files[path])
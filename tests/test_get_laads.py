@@ -0,0 +1,58 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock, skipIf
+
+from grabba_grabba_hey import aio, get_laads
+from grabba_grabba_hey.catalogue import Catalogue
+
+from .standin import StandinServer
+
+GRANULE = "/archive/allData/61/MOD021KM/2017/001/MOD021KM.%d.hdf"
+
+
+class TestGetLaads(TestCase):
+    def resume(self, engine):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        catalogue = Catalogue(os.path.join(tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        query = {"query": "standin"}
+        with StandinServer() as server:
+            server.retry_after = 0
+            for i in range(3):
+                server.files[GRANULE % i] = os.urandom(200000)
+                query[str(i)] = {"url": GRANULE % i}
+            # One complete file and one incomplete one from an older run,
+            # and one download that gets cut
+            fnames = [os.path.join(tmp, os.path.basename(GRANULE % i))
+                      for i in range(3)]
+            with open(fnames[0], "wb") as fp:
+                fp.write(server.files[GRANULE % 0])
+            with open(fnames[1], "wb") as fp:
+                fp.write(server.files[GRANULE % 1][:100000])
+            server.cut[GRANULE % 2] = 150000
+            query_file = os.path.join(tmp, "query.json")
+            with open(query_file, "w") as fp:
+                json.dump(query, fp)
+            with mock.patch.object(get_laads, "LAADS_URL", server.url + "/"):
+                files = get_laads.get_laads_files(query_file, tmp,
+                                                  n_threads=2,
+                                                  catalogue=catalogue,
+                                                  engine=engine)
+            self.assertEqual(sorted(files), fnames)
+            for i, fname in enumerate(fnames):
+                with open(fname, "rb") as fp:
+                    self.assertEqual(fp.read(), server.files[GRANULE % i])
+                self.assertFalse(os.path.exists(fname + ".partial"))
+            # Only what was missing was downloaded: nothing of the first
+            # file, and the rest of the others
+            self.assertLessEqual(server.bytes_sent, 450000)
+
+    def test_resume(self):
+        self.resume("threads")
+
+    @skipIf(aio.aiohttp is None, "aiohttp not installed")
+    def test_resume_async(self):
+        self.resume("async")
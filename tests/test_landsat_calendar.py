@@ -0,0 +1,71 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from grabba_grabba_hey import landsat_calendar, landsat_downloader
+
+
+class TestLandsatCalendar(TestCase):
+    def test_next_overpasses(self):
+        rng = np.random.default_rng(42)
+        paths = rng.integers(1, 234, 500)
+        sensors = rng.choice(["LT5", "LE7", "LC8"], 500)
+        dates = [datetime.datetime(2013, 6, 1) +
+                 datetime.timedelta(days=int(day))
+                 for day in rng.integers(0, 3000, 500)]
+        overpasses = landsat_calendar.next_overpasses(
+            np.array(dates, dtype="datetime64[D]"), paths, sensors)
+        self.assertEqual(overpasses.tolist(), [
+            landsat_downloader.next_overpass(the_date, int(path),
+                                             sensor).date()
+            for the_date, path, sensor in zip(dates, paths, sensors)])
+
+    def test_calendar(self):
+        start_date = datetime.datetime(2015, 1, 1)
+        end_date = datetime.datetime(2015, 12, 31)
+        paths = [1, 97, 98, 193, 233]
+        index, dates = landsat_calendar.overpass_calendar(
+            paths, "LE7", start_date, end_date)
+        for i, path in enumerate(paths):
+            expected = []
+            the_date = landsat_downloader.next_overpass(start_date, path,
+                                                        "LE7")
+            while the_date <= end_date:
+                expected.append(the_date.date())
+                the_date = landsat_downloader.next_overpass(
+                    the_date + datetime.timedelta(days=1), path, "LE7")
+            self.assertEqual(dates[index == i].tolist(), expected)
+
+    def test_unknown_sensor(self):
+        with self.assertRaises(ValueError):
+            landsat_calendar.next_overpasses("2015-01-01", 193, "LX9")
+
+    def test_dry_run(self):
+        scenes = landsat_downloader.get_landsat_file(
+            "LC8", "193", "030", datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 2, 15), "/tmp", None, None,
+            dry_run=True)
+        self.assertEqual(scenes, ["LC81930302015004", "LC81930302015020",
+                                  "LC81930302015036"])
+        scenes = landsat_downloader.plan_overpasses(
+            "LC8", [193, 202], [30, 32], datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 1, 16))
+        self.assertEqual(scenes, ["LC81930302015004", "LC82020322015003"])
+
+    def test_empty_scenes_settle(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        empty = landsat_calendar.EmptyScenes(os.path.join(tmp, "e.sqlite"))
+        self.addCleanup(empty.close)
+        now = datetime.datetime(2015, 2, 10, tzinfo=datetime.timezone.utc)
+        self.assertFalse(empty.add("LC81930302015020", ["LGN"], now=now))
+        self.assertTrue(empty.add("LC81930302015004", ["LGN"], now=now))
+        # And the overpass of a while back, counting from now
+        self.assertTrue(empty.add("LC81930302015020", ["LGN"]))
+        self.assertEqual(empty.empty(["LC81930302015004",
+                                      "LC81930302015020"], "LGN"),
+                         {"LC81930302015004", "LC81930302015020"})
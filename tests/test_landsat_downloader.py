@@ -0,0 +1,75 @@
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from grabba_grabba_hey import landsat_downloader
+from grabba_grabba_hey.catalogue import Catalogue
+from grabba_grabba_hey.landsat_calendar import EmptyScenes
+
+from .standin import StandinServer
+
+SCENE = "/download/4923/%s/STANDARD/EE"
+
+
+class TestLandsatDownloader(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.catalogue = Catalogue(os.path.join(self.tmp, "catalogue.sqlite"))
+        self.addCleanup(self.catalogue.close)
+        self.empty = EmptyScenes(os.path.join(self.tmp, "empty.sqlite"))
+        self.addCleanup(self.empty.close)
+
+    def download(self, server):
+        with mock.patch.object(landsat_downloader, "BASE_URL",
+                               server.url + "/download/"), \
+                mock.patch.object(landsat_downloader, "LOGIN_URL",
+                                  server.url + "/login"):
+            return landsat_downloader.get_landsat_files(
+                "LC8", [(193, 30), (202, 32)], datetime.datetime(2015, 1, 1),
+                datetime.datetime(2015, 2, 28), self.tmp, "user", "secret",
+                catalogue=self.catalogue, stations=["LGN", "MTI"],
+                empty=self.empty)
+
+    def test_download(self):
+        with StandinServer() as server:
+            # Four overpasses per path/row, with the first date of 193/030
+            # having nothing, and scenes from two stations
+            scenes = ["LC81930302015020LGN01", "LC81930302015036MTI00",
+                      "LC81930302015052LGN00", "LC82020322015003LGN00",
+                      "LC82020322015019LGN02", "LC82020322015035MTI01",
+                      "LC82020322015051LGN00"]
+            for scene in scenes:
+                server.files[SCENE % scene] = scene.encode()
+            fnames = self.download(server)
+            self.assertEqual(sorted(os.path.basename(fname)
+                                    for fname in fnames),
+                             [scene + ".tar.gz" for scene in scenes])
+            for fname in fnames:
+                with open(fname, "rb") as fp:
+                    self.assertEqual(fp.read() + b".tar.gz",
+                                     os.path.basename(fname).encode())
+            self.assertEqual(server.logins, 1)
+            # The dates after the empty one are still looked at, and it is
+            # not probed again
+            self.assertEqual(
+                self.empty.empty(["LC81930302015004"], "MTI"),
+                {"LC81930302015004"})
+            n_requests = server.total_requests
+            self.assertEqual(self.download(server), [])
+            self.assertEqual(server.total_requests, n_requests + 1)
+            self.assertEqual(server.logins, 2)
+
+    def test_refused_probes(self):
+        with StandinServer() as server:
+            # As if the login didn't work: nothing is taken to be empty
+            server.errors[SCENE % "LC81930302015004LGN00"] = [403]
+            self.download(server)
+            for station in ("LGN", "MTI"):
+                self.assertEqual(self.empty.empty(["LC81930302015004"],
+                                                  station), set())
+            # That path/row is given up on, the others go on
+            self.assertEqual(self.empty.empty(["LC82020322015003"], "LGN"),
+                             {"LC82020322015003"})
@@ -0,0 +1,73 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from grabba_grabba_hey import get_laads, metrics
+from grabba_grabba_hey.catalogue import Catalogue
+
+from .standin import StandinServer
+
+GRANULE = "/archive/allData/61/MOD021KM/2017/001/MOD021KM.%d.hdf"
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(metrics.disable)
+
+    def download(self, server, n_files):
+        query = {"query": "standin"}
+        for i in range(n_files):
+            server.files[GRANULE % i] = os.urandom(1000 * (i + 1))
+            query[str(i)] = {"url": GRANULE % i}
+        query_file = os.path.join(self.tmp, "query.json")
+        with open(query_file, "w") as fp:
+            json.dump(query, fp)
+        catalogue = Catalogue(os.path.join(self.tmp, "catalogue.sqlite"))
+        self.addCleanup(catalogue.close)
+        with mock.patch.object(get_laads, "LAADS_URL", server.url + "/"):
+            return get_laads.get_laads_files(query_file, self.tmp,
+                                             n_threads=2, catalogue=catalogue)
+
+    def test_disabled(self):
+        self.assertFalse(metrics.enabled())
+        hook = mock.Mock()
+        metrics.record("http://example.com/a", 10, 1.)
+        metrics.add_hook(hook)
+        self.assertTrue(metrics.enabled())
+        metrics.remove_hook(hook)
+        metrics.record("http://example.com/a", 10, 1.)
+        hook.assert_not_called()
+
+    def test_transfers(self):
+        jsonl = os.path.join(self.tmp, "transfers.jsonl")
+        prom = os.path.join(self.tmp, "grabba.prom")
+        metrics.enable(jsonl=jsonl, prometheus=prom)
+        with StandinServer() as server:
+            server.retry_after = 0
+            server.errors[GRANULE % 1] = [503]
+            self.download(server, 3)
+            host = server.host
+        metrics.disable()
+        with open(jsonl) as fp:
+            transfers = sorted((json.loads(line) for line in fp),
+                               key=lambda t: t["bytes"])
+        self.assertEqual([t["bytes"] for t in transfers], [1000, 2000, 3000])
+        self.assertEqual([t["retries"] for t in transfers], [0, 1, 0])
+        for transfer in transfers:
+            self.assertEqual(transfer["host"], host)
+            self.assertIsNone(transfer["error"])
+            self.assertGreaterEqual(transfer["duration"], transfer["ttfb"])
+            self.assertGreaterEqual(transfer["queue_wait"], 0)
+            # Files are downloaded to a ``.partial`` file first
+            self.assertTrue(transfer["fname"].endswith(".hdf.partial"))
+        with open(prom) as fp:
+            text = fp.read()
+        self.assertIn('grabba_transfers_total{host="%s"} 3' % host, text)
+        self.assertIn('grabba_bytes_total{host="%s"} 6000' % host, text)
+        self.assertIn('grabba_retries_total{host="%s"} 1' % host, text)
+        self.assertIn('grabba_transfer_duration_seconds_count{host="%s"} 3' %
+                      host, text)
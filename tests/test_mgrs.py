@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+import numpy as np
+
+from grabba_grabba_hey import mgrs
+from grabba_grabba_hey.sentinel_downloader import get_mgrs
+
+
+class TestMGRS(TestCase):
+    def test_known_tiles(self):
+        # A Coruña, Barrax, Libya-4, Cape Town, Bergen, Longyearbyen
+        lat = [43.365, 39.0985, 28.55, -33.9, 60.0, 78.2]
+        lon = [-8.41, -2.1082, 23.39, 18.4, 5.3, 15.6]
+        self.assertEqual(mgrs.latlon_to_mgrs(lat, lon).tolist(),
+                         ["29TNJ", "30SWJ", "34RGS", "34HBH", "32VKM",
+                          "33XWG"])
+
+    def test_utm(self):
+        # Greenwich, in zone 30
+        easting, northing, zone = mgrs.latlon_to_utm(51.4778, -0.0014)
+        self.assertEqual(zone, 30)
+        self.assertAlmostEqual(float(easting), 708221, delta=1)
+        self.assertAlmostEqual(float(northing), 5707225, delta=1)
+
+    def test_overlapping_tiles(self):
+        tiles = mgrs.latlon_to_s2_tiles([43.365, 45.5, 43.0],
+                                        [-8.41, 3.0, -6.01])
+        self.assertEqual(tiles[0], ["29TNJ"])
+        # Close to the western edge of the square
+        self.assertEqual(tiles[1], ["31TEL", "31TDL"])
+        # Just across the zone 29/30 boundary
+        self.assertEqual(tiles[2], ["29TQH", "30TTN"])
+
+    def test_wide_zones(self):
+        # Western Norway and Svalbard, in zones wider than 6 degrees
+        tiles = mgrs.latlon_to_s2_tiles([60.0, 78.2], [5.3, 15.6])
+        self.assertEqual([t[0] for t in tiles], ["32VKM", "33XWG"])
+
+    def test_batch(self):
+        rng = np.random.default_rng(42)
+        lat = rng.uniform(-60, 80, 5000)
+        lon = rng.uniform(-180, 180, 5000)
+        tiles = mgrs.latlon_to_s2_tiles(lat, lon)
+        self.assertEqual(len(tiles), 5000)
+        self.assertEqual([t[0] for t in tiles],
+                         mgrs.latlon_to_mgrs(lat, lon).tolist())
+
+    def test_get_mgrs(self):
+        self.assertEqual(get_mgrs(-8.41, 43.365), "29TNJ")
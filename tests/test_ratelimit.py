@@ -0,0 +1,59 @@
+import time
+from unittest import TestCase
+
+from grabba_grabba_hey import ratelimit
+from grabba_grabba_hey.sessions import new_session
+
+from .standin import StandinServer
+
+
+class TestRateLimit(TestCase):
+    def tearDown(self):
+        ratelimit.clear_limits()
+
+    def test_token_bucket(self):
+        bucket = ratelimit.TokenBucket(10e6, burst=1e6)
+        t0 = time.monotonic()
+        for i in range(6):
+            bucket.take(0.5e6)
+        # 1 MB of burst, then the remaining 2 MB at 10 MB/s
+        self.assertAlmostEqual(time.monotonic() - t0, 0.2, delta=0.05)
+        bucket.set_rate(None)
+        self.assertEqual(bucket.reserve(1e9), 0)
+
+    def test_rate_change_keeps_tokens(self):
+        bucket = ratelimit.TokenBucket(1000)
+        self.assertEqual(bucket.reserve(1000), 0)
+        # No new burst from changing the rate, debt included
+        bucket.set_rate(2000)
+        self.assertAlmostEqual(bucket.reserve(1000), 0.5, delta=0.01)
+        bucket.set_rate(4000)
+        self.assertAlmostEqual(bucket.reserve(), 0.25, delta=0.01)
+
+    def test_limits_per_host(self):
+        ratelimit.set_limit("a.example.com", bytes_per_second=1000)
+        throttle_a = ratelimit.get_throttle("http://a.example.com/x")
+        throttle_b = ratelimit.get_throttle("http://b.example.com/x")
+        self.assertEqual(throttle_a.reserve_bytes(1000), 0)
+        self.assertAlmostEqual(throttle_a.reserve_bytes(500), 0.5, delta=0.01)
+        self.assertEqual(throttle_b.reserve_bytes(10000), 0)
+        # The port doesn't make another host
+        self.assertAlmostEqual(
+            ratelimit.get_throttle("http://A.example.com:8080/y")
+            .reserve_bytes(0), 0.5, delta=0.01)
+        # Changing the limits affects throttles already handed out
+        ratelimit.set_limit(bytes_per_second=100)
+        self.assertGreater(throttle_b.reserve_bytes(1000), 8)
+        ratelimit.set_limit("a.example.com")
+        ratelimit.set_limit()
+        self.assertEqual(throttle_a.reserve_bytes(1e6), 0)
+
+    def test_session_requests(self):
+        with StandinServer() as server, new_session() as session:
+            server.files["/a"] = b"a"
+            ratelimit.set_limit("127.0.0.1", requests_per_second=50,
+                                burst_seconds=0.02)
+            t0 = time.monotonic()
+            for i in range(11):
+                self.assertTrue(session.get(server.url + "/a").ok)
+            self.assertGreater(time.monotonic() - t0, 0.19)
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from grabba_grabba_hey.cache import ResponseCache
+from grabba_grabba_hey.retry import RetryableError, check_response
+
+
+class FakeResponse(object):
+    def __init__(self, url, status_code, content=b"", headers=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.encoding = "utf-8"
+
+
+class FakeSession(object):
+    """Serves ``body`` with an ETag, and answers 304 to a matching
+    If-None-Match."""
+    def __init__(self, body=b"<html>listing</html>", delay=0):
+        self.body = body
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, **kwargs):
+        with self.lock:
+            self.calls.append((url, dict(headers or {})))
+        time.sleep(self.delay)
+        if (headers or {}).get("If-None-Match") == '"v1"':
+            return FakeResponse(url, 304)
+        return FakeResponse(url, 200, self.body, {"ETag": '"v1"'})
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.fname = os.path.join(self.tmp.name, "responses.sqlite")
+
+    def make_cache(self, **kwargs):
+        cache = ResponseCache(self.fname, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_fresh_response_is_reused(self):
+        cache = self.make_cache()
+        session = FakeSession()
+        r1 = cache.get("http://e4ftl01/MOLT/", session=session)
+        r2 = cache.get("http://e4ftl01/MOLT/", session=session)
+        self.assertEqual(r1.text, "<html>listing</html>")
+        self.assertTrue(r2.ok and r2.from_cache)
+        self.assertEqual(len(session.calls), 1)
+        # Another job on the same machine finds it on disk
+        r3 = self.make_cache().get("http://e4ftl01/MOLT/", session=session)
+        self.assertEqual(r3.text, r1.text)
+        self.assertEqual(len(session.calls), 1)
+        # Different query, different response
+        cache.get("http://e4ftl01/MOLT/", params={"a": 1}, session=session)
+        self.assertEqual(len(session.calls), 2)
+
+    def test_responses_per_user(self):
+        cache = self.make_cache()
+        session = FakeSession()
+        url = "https://scihub.copernicus.eu/dhus/search?q=*"
+        cache.get(url, session=session, auth=("alice", "secret"))
+        cache.get(url, session=session, auth=("alice", "secret"))
+        self.assertEqual(len(session.calls), 1)
+        cache.get(url, session=session, auth=("bob", "secret"))
+        self.assertEqual(len(session.calls), 2)
+        # Some other sort of auth isn't cached
+        auth = lambda request: request
+        cache.get(url, session=session, auth=auth)
+        cache.get(url, session=session, auth=auth)
+        self.assertEqual(len(session.calls), 4)
+
+    def test_stale_response_is_revalidated(self):
+        cache = self.make_cache()
+        session = FakeSession()
+        cache.get("http://e4ftl01/MOLT/", session=session)
+        r = cache.get("http://e4ftl01/MOLT/", session=session, ttl=0)
+        self.assertEqual(session.calls[-1][1], {"If-None-Match": '"v1"'})
+        self.assertEqual(r.text, "<html>listing</html>")
+        self.assertTrue(r.from_cache)
+
+    def test_errors_are_not_cached(self):
+        cache = self.make_cache()
+        session = FakeSession()
+        session.get = lambda url, **kwargs: FakeResponse(
+            url, 503, headers={"Retry-After": "7"})
+        r = cache.get("http://hub/q", session=session)
+        self.assertFalse(r.ok)
+        self.assertEqual(cache.db.execute(
+            "SELECT COUNT(*) FROM responses").fetchone()[0], 0)
+        # The server says when to come back
+        with self.assertRaises(RetryableError) as context:
+            check_response(r)
+        self.assertEqual(context.exception.retry_after, 7)
+
+    def test_single_flight(self):
+        cache = self.make_cache()
+        session = FakeSession(delay=0.2)
+        threads = [threading.Thread(target=cache.get,
+                                    args=("http://e4ftl01/MOLT/",),
+                                    kwargs={"session": session})
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(session.calls), 1)
+
+    def test_eviction(self):
+        cache = self.make_cache(memory_bytes=250, disk_bytes=250)
+        session = FakeSession(body=b"x" * 100)
+        for i in range(5):
+            cache.get("http://e4ftl01/%d" % i, session=session)
+        self.assertLessEqual(cache.memory_size, 250)
+        self.assertEqual(len(cache.memory), 2)
+        urls = [row[0] for row in cache.db.execute(
+            "SELECT url FROM responses ORDER BY url")]
+        self.assertEqual(urls, ["http://e4ftl01/3", "http://e4ftl01/4"])
@@ -0,0 +1,63 @@
+import threading
+from unittest import TestCase
+
+from grabba_grabba_hey import retry
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.url = "http://hub/q"
+        self.ok = status_code < 400
+
+
+class TestRetry(TestCase):
+    def test_retry_after(self):
+        with self.assertRaises(retry.RetryableError) as cm:
+            retry.check_response(FakeResponse(429, {"Retry-After": "7"}))
+        self.assertEqual(cm.exception.retry_after, 7)
+        policy = retry.RetryPolicy(base_wait=1, max_wait=60)
+        self.assertEqual(policy.wait(3, cm.exception), 7)
+        self.assertTrue(0 <= policy.wait(10) <= 60)
+        with self.assertRaises(IOError) as cm:
+            retry.check_response(FakeResponse(404))
+        self.assertNotIsInstance(cm.exception, retry.RetryableError)
+
+    def test_circuit_breaker(self):
+        breaker = retry.CircuitBreaker(threshold=2, reset_after=60)
+        breaker.failure("http://e4ftl01/a")
+        breaker.check("http://e4ftl01/b")
+        breaker.failure("http://e4ftl01/c")
+        with self.assertRaises(retry.CircuitOpenError):
+            breaker.check("http://e4ftl01/d")
+        # Other hosts are fine
+        breaker.check("http://ladsweb/a")
+        breaker.success("http://e4ftl01/e")
+        breaker.check("http://e4ftl01/f")
+
+    def test_requeue(self):
+        failures = {"http://host/b": 2, "http://host/c": 100}
+        lock = threading.Lock()
+
+        def get(url):
+            with lock:
+                if failures.get(url, 0) > 0:
+                    failures[url] -= 1
+                    raise retry.RetryableError("busy")
+            return url.upper()
+
+        stats = retry.RetryStats()
+        policy = retry.RetryPolicy(max_retries=3, base_wait=0.01)
+        done = list(retry.run_with_requeue(
+            get, ["http://host/a", "http://host/b", "http://host/c"],
+            n_threads=2, policy=policy, stats=stats,
+            breaker=retry.CircuitBreaker(threshold=100)))
+        results = {item: (result, err) for item, result, err in done}
+        self.assertEqual(results["http://host/a"], ("HTTP://HOST/A", None))
+        self.assertEqual(results["http://host/b"], ("HTTP://HOST/B", None))
+        self.assertIsInstance(results["http://host/c"][1],
+                              retry.RetryableError)
+        # The item that works isn't held up by the ones that don't
+        self.assertEqual(done[0][0], "http://host/a")
+        self.assertEqual(stats.summary()["host"]["retries"], 5)
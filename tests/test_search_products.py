@@ -0,0 +1,69 @@
+import datetime
+from unittest import TestCase, mock
+
+from grabba_grabba_hey import sentinel_downloader
+
+ENTRY = """<entry>
+<id>{0}</id>
+<link href="https://hub/odata/v1/Products('{0}')/$value"/>
+<link rel="icon" href="https://hub/odata/v1/Products('{0}')/Products('Quicklook')/$value"/>
+<str name="filename">S2A_{0}.SAFE</str>
+<int name="orbitnumber">8123</int>
+<date name="beginposition">2017-01-11T11:23:42.026Z</date>
+</entry>"""
+
+
+def make_page(names, total=None):
+    xml = '<feed xmlns="http://www.w3.org/2005/Atom" ' + \
+        'xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">'
+    if total is not None:
+        xml += "<opensearch:totalResults>%d</opensearch:totalResults>" % total
+    xml += "".join(ENTRY.format(name) for name in names)
+    return xml + "</feed>"
+
+
+class TestSearchProducts(TestCase):
+    def run_search(self, pages, rows, with_total=True):
+        total = sum(len(page) for page in pages)
+        queries = []
+
+        def fake_query(query, user="guest", passwd="guest"):
+            queries.append(query)
+            start = int(query.split("&start=")[1].split("&")[0])
+            page = pages[start // rows] if start // rows < len(pages) else []
+            return make_page(page, total=total if with_total else None)
+
+        with mock.patch.object(sentinel_downloader, "do_query", fake_query):
+            granules = list(sentinel_downloader.search_products(
+                "http://hub/search?q=foo", rows=rows))
+        return granules, queries
+
+    def test_walks_all_pages(self):
+        pages = [["a", "b"], ["c", "d"], ["e"]]
+        granules, queries = self.run_search(pages, rows=2)
+        self.assertEqual([g['id'] for g in granules],
+                         ["a", "b", "c", "d", "e"])
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(queries[-1].endswith("&start=4&rows=2"))
+
+    def test_no_total_stops_on_short_page(self):
+        pages = [["a", "b"], ["c"]]
+        granules, queries = self.run_search(pages, rows=2, with_total=False)
+        self.assertEqual([g['id'] for g in granules], ["a", "b", "c"])
+
+    def test_rows_limit(self):
+        with self.assertRaises(ValueError):
+            next(sentinel_downloader.search_products("q", rows=1000))
+
+
+class TestParseXML(TestCase):
+    def test_fields(self):
+        granule, = sentinel_downloader.parse_xml(make_page(["a"], total=1))
+        self.assertEqual(granule.id, "a")
+        self.assertEqual(granule.link, "https://hub/odata/v1/Products('a')/")
+        self.assertTrue(granule.quicklook.endswith("('Quicklook')/$value"))
+        self.assertEqual(granule['filename'], "S2A_a.SAFE")
+        self.assertEqual(granule.orbitnumber, 8123)
+        self.assertEqual(granule.beginposition,
+                         datetime.datetime(2017, 1, 11, 11, 23, 42, 26000))
+        self.assertIsNone(granule.endposition)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from grabba_grabba_hey import sentinel3_downloader
+from grabba_grabba_hey.catalogue import Catalogue
+
+from .standin import StandinServer
+
+CHECKSUM = "/odata/v1/Products('S3A_PRODUCT')//Checksum/Value/$value"
+PRODUCT = "/odata/v1/Products('S3A_PRODUCT')/$value"
+
+
+class TestSentinel3Downloader(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.target = os.path.join(self.tmp, "S3A_PRODUCT.zip")
+        self.catalogue = Catalogue(os.path.join(self.tmp, "catalogue.sqlite"))
+        self.addCleanup(self.catalogue.close)
+        self.data = os.urandom(300000)
+
+    def download(self, server, **kwargs):
+        sentinel3_downloader.download_product(
+            server.product_url("S3A_PRODUCT"), self.target,
+            catalogue=self.catalogue, **kwargs)
+
+    def test_resume(self):
+        with StandinServer() as server:
+            server.products["S3A_PRODUCT"] = self.data
+            server.retry_after = 0
+            server.errors[CHECKSUM] = [503]
+            server.cut["S3A_PRODUCT"] = 150000
+            self.download(server)
+            with open(self.target, "rb") as fp:
+                self.assertEqual(fp.read(), self.data)
+            self.assertFalse(os.path.exists(self.target + ".partial"))
+            self.assertEqual(server.requests[PRODUCT], 2)
+
+    def test_checksum_errors(self):
+        with StandinServer() as server:
+            server.products["S3A_PRODUCT"] = self.data
+            server.errors[CHECKSUM] = [401]
+            with self.assertRaises(IOError):
+                self.download(server)
+            self.assertNotIn(PRODUCT, server.requests)
+
+    def test_attempts(self):
+        with StandinServer() as server:
+            server.products["S3A_PRODUCT"] = self.data
+            server.retry_after = 0
+            server.errors[PRODUCT] = [503] * 10
+            with self.assertRaises(IOError):
+                self.download(server, max_retries=2)
+            # Errors and checksum mismatches share the attempts
+            self.assertEqual(server.requests[PRODUCT], 3)
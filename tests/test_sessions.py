@@ -0,0 +1,51 @@
+from unittest import TestCase, mock
+
+import requests
+
+from grabba_grabba_hey import sessions
+
+
+class TestSessions(TestCase):
+    def test_shared_session_pool_grows(self):
+        session = sessions.get_session()
+        self.assertIs(sessions.get_session(pool_size=4), session)
+        sessions.get_session(pool_size=sessions.POOL_SIZE + 10)
+        adapter = session.get_adapter("https://s3.amazonaws.com/")
+        self.assertEqual(adapter._pool_maxsize, sessions.POOL_SIZE + 10)
+
+    def test_new_session(self):
+        with sessions.new_session(pool_size=2, auth=("me", "secret")) as s:
+            self.assertIsNot(s, sessions.get_session())
+            self.assertEqual(s.auth, ("me", "secret"))
+            self.assertEqual(s.get_adapter("http://e4ftl01/")._pool_maxsize,
+                             sessions.POOL_SIZE)
+
+    def test_auth_kept_for_sign_on_hosts(self):
+        with sessions.new_session(auth=("me", "secret"),
+                                  auth_hosts=["urs.example.com"]) as s:
+            response = requests.Response()
+            response.request = requests.Request(
+                "GET", "https://archive.example.com/a.hdf",
+                auth=("me", "secret")).prepare()
+            for url, expected in [("https://urs.example.com/login", True),
+                                  ("https://other.example.com/", False)]:
+                prepared = requests.Request(
+                    "GET", url, headers=response.request.headers).prepare()
+                s.rebuild_auth(prepared, response)
+                self.assertEqual("Authorization" in prepared.headers,
+                                 expected)
+
+    def test_login_once_per_requested_host(self):
+        with sessions.new_session(auth=("me", "secret"),
+                                  auth_hosts=["urs.example.com"]) as s:
+            # The archive sends us somewhere else (not for good)
+            response = requests.Response()
+            response.status_code = 200
+            response.url = "https://data.example.com/a.hdf"
+            with mock.patch.object(s, "get", return_value=response) as get, \
+                    mock.patch.object(s, "login_lock") as lock:
+                s.login_get("https://archive.example.com/a.hdf")
+                s.login_get("https://archive.example.com/b.hdf")
+            self.assertEqual(get.call_count, 2)
+            # Only the first request waited for the login
+            self.assertEqual(lock.__enter__.call_count, 1)